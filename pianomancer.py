@@ -1,19 +1,33 @@
 import sys
 import time
+IMPORT_START = time.perf_counter()
 import os
 import curses
-import mido
 import logging
-import fluidsynth
 import threading
 import platform
 import random
 import math
-import urllib.request
+import heapq
+import bisect
+import argparse
+import collections
+import tracemalloc
+import hashlib
+import mmap
+import struct
+import tempfile
+import wave
+import ctypes
+import json
+import contextlib
+import select
+import re
+from array import array
 
 logging.basicConfig(
     filename='pianomancer.log',
-    filemode='w',
+    filemode='a' if __name__ == '__mp_main__' else 'w',
     level=logging.DEBUG,
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
@@ -52,6 +66,120 @@ NOTE_MIDI_NUMBERS = {
 MIN_HEIGHT = 30
 MIN_WIDTH = 80
 
+SCHEDULER_MAX_WAIT = 0.05
+INPUT_IDLE_WAIT = 0.25
+KEY_RELEASE_DELAY = 0.1
+PLAYBACK_REFRESH = 0.1
+DEFAULT_LIGHT_DENSITY = 0.2
+LIGHT_PULSE_FRACTION = 0.25
+PIANO_NOTE_RANGE = range(21, 109)
+DEFAULT_LOOKAHEAD = 4.0
+ROLL_COLORS = [1, 2, 3, 5, 6]
+KEYFRAME_INTERVAL = 1024
+CONTROLLER_UNSET = 0xFF
+PITCH_BEND_CENTER = 8192
+HOLD_PEDALS = (64, 66)
+NONZERO_BYTE = re.compile(rb'[^\x00]')
+SILENT_NOTES = bytes(16 * 128)
+
+CACHE_MAGIC = b'PMTL'
+CACHE_VERSION = 1
+CACHE_HEADER = struct.Struct('<4sHHQQd32s')
+CACHE_SUFFIX = '.pmtl'
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pianomancer', 'timelines')
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+DEFAULT_LIBRARY_DB = os.path.join(os.path.expanduser('~'), '.cache', 'pianomancer', 'library.sqlite3')
+LIBRARY_VERSION = 1
+LIBRARY_COMMIT_FILES = 256
+LIBRARY_CHUNK_FILES = 16
+LIBRARY_WORKER_NICE = 10
+MIDI_DEFAULT_TEMPO = 500000
+
+DEFAULT_SOUNDFONT = "Arachno.sf2"
+DEFAULT_SAMPLE_RATE = 44100
+DEFAULT_GAIN = 0.2
+RENDER_BLOCK_FRAMES = 1024
+RENDER_TAIL_SECONDS = 2.0
+BATCH_MANIFEST = '.pianomancer-batch.json'
+DEFAULT_SOUNDFONT_BUDGET = 512 * 1024 * 1024
+DEFAULT_RECORDINGS_DIR = "recordings"
+RECORDING_CHUNK_EVENTS = 4096
+RECORDING_TICKS_PER_BEAT = 960
+RECORDING_TEMPO = 500000
+DEFAULT_SOUNDFONT_URL = "https://theater.torbware.space/Arachno.sf2"
+DEFAULT_SOUNDFONT_SHA256 = None
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_TIMEOUT = 30
+DEFAULT_NET_HOST = '127.0.0.1'
+DEFAULT_NET_PORT = 5004
+NET_FRAME_MAGIC = b'PM'
+NET_FRAME_HEADER = struct.Struct('<2sHQ')
+NET_STATS_INTERVAL = 1.0
+AUDIO_RING_BYTES = 64 * 1024
+AUDIO_RING_DATA = 128
+AUDIO_RECORD = struct.Struct('<HB')
+AUDIO_COUNTER = struct.Struct('<Q')
+AUDIO_STATUS = struct.Struct('<IIdddQQQQiQddddIBIi160s96s')
+AUDIO_STATUS_OFFSET = AUDIO_RING_DATA + AUDIO_RING_BYTES
+AUDIO_NOTES_OFFSET = AUDIO_STATUS_OFFSET + 512
+AUDIO_SHARED_BYTES = AUDIO_NOTES_OFFSET + 16 * 128 + 128 + 64
+AUDIO_WAKE_OFFSET = AUDIO_SHARED_BYTES - 64
+AUDIO_STATUS_INTERVAL = 0.01
+AUDIO_STATS_INTERVAL = 1.0
+AUDIO_REPLY_TIMEOUT = 120.0
+AUDIO_FENCE_TIMEOUT = 1.0
+AUDIO_READY = 1
+AUDIO_FAILED = 2
+AUDIO_PLAYING = 4
+AUDIO_PAUSED = 8
+AUDIO_PAUSED_FOR_SOUNDFONT = 16
+AUDIO_SERVER_FAILED = 32
+AUDIO_PAD = 0
+AUDIO_NOTE_ON = 1
+AUDIO_RELEASE = 2
+AUDIO_PROGRAM_SELECT = 3
+AUDIO_SFLOAD = 4
+AUDIO_SFUNLOAD = 5
+AUDIO_PLAY = 6
+AUDIO_STOP = 7
+AUDIO_SEEK = 8
+AUDIO_OCTAVE = 9
+AUDIO_SPEED = 10
+AUDIO_LOOP = 11
+AUDIO_PAUSE = 12
+AUDIO_SOUNDFONT_PAUSE = 13
+AUDIO_SOUNDFONT_RESUME = 14
+AUDIO_SWITCH_SOUNDFONT = 15
+AUDIO_OVERRIDES = 16
+AUDIO_SERVER_SOUNDFONT = 17
+AUDIO_QUIT = 18
+AUDIO_PLAY_HEADER = struct.Struct('<IiidB16s')
+AUDIO_PROGRAM = struct.Struct('<BiHB')
+AUDIO_LOAD = struct.Struct('<IB')
+AUDIO_INT = struct.Struct('<i')
+AUDIO_DOUBLE = struct.Struct('<d')
+METRICS_OVERLAY_INTERVAL = 1.0
+DEFAULT_METRICS_INTERVAL = 5.0
+METRICS_OVERLAY_WIDTH = 36
+MIDI_DATA_LENGTHS = {0x80: 2, 0x90: 2, 0xA0: 2, 0xB0: 2, 0xC0: 1, 0xD0: 1, 0xE0: 2, 0xF1: 1, 0xF2: 2, 0xF3: 1}
+CHANNEL_MESSAGE_HANDLERS = {
+    0xA0: 'handle_key_pressure',
+    0xB0: 'handle_control_change',
+    0xC0: 'handle_program_change',
+    0xD0: 'handle_channel_pressure',
+    0xE0: 'handle_pitch_bend',
+}
+
+RIFF_CHUNK_HEADER = struct.Struct('<4sI')
+SF2_PRESET_HEADER = struct.Struct('<20sHHHIII')
+SF2_BAG = struct.Struct('<HH')
+SF2_GENERATOR = struct.Struct('<HH')
+SF2_INSTRUMENT = struct.Struct('<20sH')
+SF2_SAMPLE_HEADER = struct.Struct('<20sIIIIIBbHH')
+SF2_GEN_INSTRUMENT = 41
+SF2_GEN_SAMPLE_ID = 53
+
 class SuppressStderr:
     def __enter__(self):
         self.null_fds = os.open(os.devnull, os.O_RDWR)
@@ -63,6 +191,847 @@ class SuppressStderr:
         os.close(self.null_fds)
         os.close(self.old_stderr)
 
+class LatenessStats:
+    def __init__(self, max_samples=4096):
+        self.samples = collections.deque(maxlen=max_samples)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, lateness):
+        self.samples.append(lateness)
+        self.count += 1
+        self.total += lateness
+        if lateness > self.max:
+            self.max = lateness
+
+    def record_due(self, due_times, current_time, speed):
+        count = len(due_times)
+        if not count:
+            return
+        self.samples.extend([(current_time - due_time) / speed for due_time in due_times[-self.samples.maxlen:]])
+        self.count += count
+        self.total += (current_time * count - sum(due_times)) / speed
+        self.max = max(self.max, (current_time - min(due_times)) / speed)
+
+    def percentile(self, fraction):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(fraction * len(ordered)))
+        return ordered[index]
+
+    def summary(self):
+        mean = self.total / self.count if self.count else 0.0
+        return {
+            'count': self.count,
+            'mean_ms': mean * 1000.0,
+            'p50_ms': self.percentile(0.50) * 1000.0,
+            'p99_ms': self.percentile(0.99) * 1000.0,
+            'max_ms': self.max * 1000.0,
+        }
+
+    def __str__(self):
+        summary = self.summary()
+        return (f"{summary['count']} events, mean {summary['mean_ms']:.2f}ms, "
+                f"p50 {summary['p50_ms']:.2f}ms, p99 {summary['p99_ms']:.2f}ms, max {summary['max_ms']:.2f}ms")
+
+class ChannelState:
+    def __init__(self, programs=None, controllers=None, pitch_bends=None, notes=None):
+        self.programs = bytearray(programs) if programs is not None else bytearray(16)
+        self.controllers = bytearray(controllers) if controllers is not None else bytearray([CONTROLLER_UNSET]) * (16 * 128)
+        self.pitch_bends = array('H', pitch_bends) if pitch_bends is not None else array('H', [PITCH_BEND_CENTER] * 16)
+        self.notes = bytearray(notes) if notes is not None else bytearray(16 * 128)
+
+    def copy(self):
+        return ChannelState(self.programs, self.controllers, self.pitch_bends, self.notes)
+
+    def to_bytes(self):
+        return bytes(self.programs) + bytes(self.controllers) + self.pitch_bends.tobytes() + bytes(self.notes)
+
+    @classmethod
+    def from_bytes(cls, data):
+        pitch_bends = array('H')
+        pitch_bends.frombytes(bytes(data[2064:2096]))
+        return cls(data[0:16], data[16:2064], pitch_bends, data[2096:4144])
+
+    def apply(self, status, channel, data1, data2):
+        if status == 0x90 and data2 > 0:
+            self.notes[channel * 128 + data1] = data2
+        elif status == 0x80 or status == 0x90:
+            self.notes[channel * 128 + data1] = 0
+        elif status == 0xC0:
+            self.programs[channel] = data1
+        elif status == 0xB0:
+            self.controllers[channel * 128 + data1] = data2
+        elif status == 0xE0:
+            self.pitch_bends[channel] = (data2 << 7) | data1
+
+    def sounding_notes(self):
+        notes = bytes(self.notes)
+        for match in NONZERO_BYTE.finditer(notes):
+            index = match.start()
+            yield index >> 7, index & 0x7F, notes[index]
+
+    def restore(self, fs, restore_controllers=False, soundfont_id=None, skip_channels=()):
+        events = []
+        for channel in range(16):
+            if restore_controllers:
+                base = channel * 128
+                controllers = self.controllers[base:base + 120]
+                cached = fs.controllers[base:base + 120]
+                if controllers != cached:
+                    changed = [(controller, value) for controller, (value, old) in enumerate(zip(controllers, cached)) if value != old]
+                    if any(value == CONTROLLER_UNSET for controller, value in changed):
+                        events.append((0xB0, channel, 121, 0))
+                        changed = [(controller, value) for controller, value in enumerate(controllers) if value != CONTROLLER_UNSET]
+                    events.extend((0xB0, channel, controller, value) for controller, value in changed)
+                bend = self.pitch_bends[channel]
+                if bend != PITCH_BEND_CENTER or fs.pitch_bends[channel]:
+                    events.append((0xE0, channel, bend & 0x7F, bend >> 7))
+            events.append((0xC0, channel, self.programs[channel], 0))
+        fs.dispatch(events, soundfont_id, skip_channels)
+
+KEYFRAME_SIZE = 16 + 16 * 128 + 16 * 2 + 16 * 128
+
+class EventTimeline:
+    def __init__(self, times, statuses, channels, data1, data2, keyframe_data, total_length, buffer=None):
+        self.buffer = buffer
+        self.times = times
+        self.statuses = statuses
+        self.channels = channels
+        self.data1 = data1
+        self.data2 = data2
+        self.keyframe_data = keyframe_data
+        self.total_length = total_length
+        self.length = len(times)
+
+    @classmethod
+    def from_midi_file(cls, midi_file):
+        times = array('d')
+        statuses = array('B')
+        channels = array('B')
+        data1 = array('B')
+        data2 = array('B')
+        absolute_time = 0.0
+        import mido
+        for msg in mido.MidiFile(midi_file):
+            absolute_time += msg.time
+            if msg.is_meta or not hasattr(msg, 'channel'):
+                continue
+            data = msg.bytes()
+            times.append(absolute_time)
+            statuses.append(data[0] & 0xF0)
+            channels.append(data[0] & 0x0F)
+            data1.append(data[1])
+            data2.append(data[2] if len(data) > 2 else 0)
+        keyframe_data = cls.build_keyframes(statuses, channels, data1, data2)
+        return cls(times, statuses, channels, data1, data2, keyframe_data, absolute_time)
+
+    @staticmethod
+    def build_keyframes(statuses, channels, data1, data2):
+        keyframe_data = bytearray()
+        state = ChannelState()
+        for index in range(len(statuses)):
+            if index % KEYFRAME_INTERVAL == 0:
+                keyframe_data += state.to_bytes()
+            state.apply(statuses[index], channels[index], data1[index], data2[index])
+        return keyframe_data
+
+    def keyframe_count(self):
+        return len(self.keyframe_data) // KEYFRAME_SIZE
+
+    def state_at(self, index):
+        keyframe_index = min(index // KEYFRAME_INTERVAL, self.keyframe_count() - 1)
+        if keyframe_index < 0:
+            return ChannelState()
+        offset = keyframe_index * KEYFRAME_SIZE
+        state = ChannelState.from_bytes(self.keyframe_data[offset:offset + KEYFRAME_SIZE])
+        for event in range(keyframe_index * KEYFRAME_INTERVAL, index):
+            state.apply(self.statuses[event], self.channels[event], self.data1[event], self.data2[event])
+        return state
+
+    def index_at(self, logical_time):
+        return bisect.bisect_right(self.times, logical_time)
+
+    def nbytes(self):
+        return (self.times.itemsize * self.length + 4 * self.length + len(self.keyframe_data))
+
+    def write_to(self, file, content_digest):
+        file.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, KEYFRAME_INTERVAL, self.length,
+                                     len(self.keyframe_data), self.total_length, content_digest))
+        for column in (self.times, self.statuses, self.channels, self.data1, self.data2):
+            file.write(bytes(column) if isinstance(column, memoryview) else column.tobytes())
+        file.write(bytes(self.keyframe_data))
+
+    @classmethod
+    def from_buffer(cls, buffer, content_digest=None):
+        if len(buffer) < CACHE_HEADER.size:
+            return None
+        magic, version, interval, length, keyframe_bytes, total_length, digest = CACHE_HEADER.unpack_from(buffer)
+        if magic != CACHE_MAGIC or version != CACHE_VERSION or interval != KEYFRAME_INTERVAL:
+            return None
+        if content_digest is not None and digest != content_digest:
+            return None
+        if keyframe_bytes % KEYFRAME_SIZE or len(buffer) != CACHE_HEADER.size + 12 * length + keyframe_bytes:
+            return None
+        view = memoryview(buffer)
+        offset = CACHE_HEADER.size
+        times = view[offset:offset + 8 * length].cast('d')
+        offset += 8 * length
+        columns = []
+        for _ in range(4):
+            columns.append(view[offset:offset + length])
+            offset += length
+        keyframe_data = view[offset:offset + keyframe_bytes]
+        return cls(times, *columns, keyframe_data, total_length, buffer=buffer)
+
+class TimelineCache:
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def key_for(self, midi_file):
+        path = os.path.abspath(midi_file)
+        stat = os.stat(path)
+        with open(path, 'rb') as f:
+            content_digest = hashlib.sha256(f.read()).digest()
+        key = hashlib.sha256(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode('utf-8', 'surrogateescape') + content_digest)
+        return key.hexdigest(), content_digest
+
+    def cache_path(self, key):
+        return os.path.join(self.directory, key + CACHE_SUFFIX)
+
+    def load(self, midi_file):
+        key, content_digest = self.key_for(midi_file)
+        path = self.cache_path(key)
+        try:
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None, key, content_digest
+        timeline = EventTimeline.from_buffer(mapped, content_digest)
+        if timeline is None:
+            mapped.close()
+            logging.warning(f"Discarding invalid timeline cache entry {path}.")
+            self.remove(path)
+            return None, key, content_digest
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return timeline, key, content_digest
+
+    def store(self, key, content_digest, timeline):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                timeline.write_to(f, content_digest)
+            os.replace(temp_path, self.cache_path(key))
+        except:
+            self.remove(temp_path)
+            raise
+        self.evict()
+
+    def get(self, midi_file):
+        try:
+            timeline, key, content_digest = self.load(midi_file)
+        except OSError:
+            logging.exception(f"Error reading timeline cache for {midi_file}.")
+            return EventTimeline.from_midi_file(midi_file)
+        if timeline is not None:
+            self.hits += 1
+            return timeline
+        self.misses += 1
+        timeline = EventTimeline.from_midi_file(midi_file)
+        try:
+            self.store(key, content_digest, timeline)
+        except OSError:
+            logging.exception(f"Error writing timeline cache for {midi_file}.")
+        return timeline
+
+    def entries(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        entries = []
+        for name in names:
+            if not name.endswith(CACHE_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if self.remove(path):
+                total -= size
+                logging.info(f"Evicted timeline cache entry {path}.")
+
+    def clear(self):
+        for _, _, path in self.entries():
+            self.remove(path)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+def select_soundfont_programs(fs, soundfont_id, programs=None):
+    for channel in range(16):
+        program = programs[channel] if programs is not None and channel != 9 else 0
+        fs.program_select(channel, soundfont_id, 0, program)
+
+FRAME_TIME_BUCKETS_MS = (1, 2, 4, 8, 16, 33, 66, 100)
+
+class FrameStats:
+    def __init__(self):
+        self.counts = [0] * (len(FRAME_TIME_BUCKETS_MS) + 1)
+        self.rendered = 0
+        self.skipped = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        milliseconds = seconds * 1000.0
+        self.counts[bisect.bisect_left(FRAME_TIME_BUCKETS_MS, milliseconds)] += 1
+        self.rendered += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def histogram(self):
+        labels = [f"<={edge}ms" for edge in FRAME_TIME_BUCKETS_MS] + [f">{FRAME_TIME_BUCKETS_MS[-1]}ms"]
+        return list(zip(labels, self.counts))
+
+    def __str__(self):
+        mean = self.total / self.rendered if self.rendered else 0.0
+        buckets = ", ".join(f"{label}: {count}" for label, count in self.histogram() if count)
+        return (f"{self.rendered} rendered, {self.skipped} skipped, mean {mean * 1000.0:.2f}ms, "
+                f"max {self.max * 1000.0:.2f}ms [{buckets}]")
+
+class FrameGovernor:
+    def __init__(self, fps=None):
+        self.frame_interval = 1.0 / fps if fps else 0.0
+        self.last_frame = 0.0
+        self.last_signature = None
+        self.pending = False
+        self.stats = FrameStats()
+
+    def should_render(self, now, signature, force=False):
+        if now - self.last_frame < self.frame_interval:
+            self.pending = True
+            return False
+        self.pending = False
+        if not force and signature == self.last_signature:
+            self.stats.skipped += 1
+            return False
+        self.last_signature = signature
+        self.last_frame = now
+        return True
+
+    def frame_done(self, seconds):
+        self.stats.record(seconds)
+
+    def invalidate(self):
+        self.last_signature = None
+
+class StartupProfile:
+    def __init__(self, origin=IMPORT_START):
+        self.origin = origin
+        self.last = origin
+        self.phases = []
+        self.lock = threading.Lock()
+
+    def record(self, name, start, end=None):
+        end = time.perf_counter() if end is None else end
+        with self.lock:
+            self.phases.append((name, threading.current_thread().name, start - self.origin, end - self.origin))
+
+    def lap(self, name):
+        now = time.perf_counter()
+        self.record(name, self.last, now)
+        self.last = now
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.record(name, start, end)
+            if threading.current_thread() is threading.main_thread():
+                self.last = end
+
+    def total(self):
+        with self.lock:
+            return max((end for _, _, _, end in self.phases), default=0.0)
+
+    def report(self):
+        with self.lock:
+            phases = sorted(self.phases, key=lambda phase: phase[2])
+        lines = [f"{'Phase':<20} {'Thread':<14} {'Start ms':>9} {'End ms':>9} {'Took ms':>9}"]
+        for name, thread, start, end in phases:
+            lines.append(f"{name:<20} {thread[:14]:<14} {start * 1000:>9.1f} {end * 1000:>9.1f} {(end - start) * 1000:>9.1f}")
+        lines.append(f"Ready for input after {self.total() * 1000:.1f} ms")
+        return "\n".join(lines)
+
+def resident_memory_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def default_audio_driver(operating_system):
+    if operating_system == "Darwin":
+        return "coreaudio"
+    if operating_system == "Windows":
+        return "dsound"
+    return "alsa"
+
+def start_synth(fluidsynth, driver):
+    synth = fluidsynth.Synth()
+    with SuppressStderr():
+        try:
+            synth.start(driver=driver)
+        except:
+            if driver == "alsa":
+                synth.delete()
+                return None
+            synth.start(driver="alsa")
+    return synth
+
+def synth_voice_counter(fs):
+    library = getattr(sys.modules.get('fluidsynth'), '_fl', None)
+    function = getattr(library, 'fluid_synth_get_active_voice_count', None)
+    synth = getattr(fs, 'synth', None)
+    if function is None or not synth:
+        return None
+    function.restype = ctypes.c_int
+    function.argtypes = [ctypes.c_void_p]
+    return lambda: function(synth)
+
+class NoteState:
+    def __init__(self, refcounted=True, buffer=None):
+        if buffer is not None:
+            self.velocities = buffer[:16 * 128]
+            self.pitches = buffer[16 * 128:16 * 128 + 128] if refcounted else None
+        else:
+            self.velocities = bytearray(16 * 128)
+            self.pitches = bytearray(128) if refcounted else None
+        self.cached = (bytes(128), frozenset())
+
+    def press(self, channel, note, velocity):
+        index = channel * 128 + note
+        if not self.velocities[index] and self.pitches is not None:
+            self.pitches[note] += 1
+        self.velocities[index] = velocity
+
+    def release(self, channel, note):
+        index = channel * 128 + note
+        if not self.velocities[index]:
+            return False
+        self.velocities[index] = 0
+        if self.pitches is not None:
+            self.pitches[note] -= 1
+        return True
+
+    def clear_channel(self, channel):
+        base = channel * 128
+        if self.pitches is not None:
+            for match in NONZERO_BYTE.finditer(self.velocities, base, base + 128):
+                self.pitches[match.start() - base] -= 1
+        self.velocities[base:base + 128] = bytes(128)
+
+    def clear(self):
+        self.velocities[:] = bytes(16 * 128)
+        if self.pitches is not None:
+            self.pitches[:] = bytes(128)
+
+    def channel_count(self, channel):
+        return 128 - bytes(self.velocities[channel * 128:channel * 128 + 128]).count(0)
+
+    def sounding(self):
+        velocities = bytes(self.velocities)
+        for match in NONZERO_BYTE.finditer(velocities):
+            index = match.start()
+            yield index >> 7, index & 0x7F, velocities[index]
+
+    def snapshot(self):
+        if self.pitches is None:
+            return frozenset(note for channel, note, velocity in self.sounding())
+        pitches = bytes(self.pitches)
+        cached = self.cached
+        if cached[0] != pitches:
+            cached = (pitches, frozenset(match.start() for match in NONZERO_BYTE.finditer(pitches)))
+            self.cached = cached
+        return cached[1]
+
+    def __len__(self):
+        return len(self.velocities) - bytes(self.velocities).count(0)
+
+    def __bool__(self):
+        return self.velocities != SILENT_NOTES
+
+    def __contains__(self, note):
+        return note in self.snapshot()
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+class SynthDispatcher:
+    def __init__(self, target, notes=None):
+        self.target = target
+        self.lock = threading.RLock()
+        self.notes = notes if notes is not None else NoteState()
+        self.programs = [None] * 16
+        self.controllers = bytearray([CONTROLLER_UNSET]) * (16 * 128)
+        self.pitch_bends = [None] * 16
+        self.pressures = [None] * 16
+        self.soundfont_id = None
+        self.skip_programs = ()
+        self.note_offset = 0
+        self.source_notes = None
+        self.events = 0
+        self.calls = 0
+        self.batches = 0
+        self.handlers = [self.ignore_message] * 16
+        for status, name in CHANNEL_MESSAGE_HANDLERS.items():
+            self.handlers[status >> 4] = getattr(self, name)
+
+    @property
+    def saved(self):
+        return self.events - self.calls
+
+    def dispatch(self, events, soundfont_id=None, skip_programs=(), note_offset=0, active_notes=None, count=None):
+        noteon = self.target.noteon
+        noteoff = self.target.noteoff
+        velocities = self.notes.velocities
+        pitches = self.notes.pitches
+        handlers = self.handlers
+        source_velocities = active_notes.velocities if active_notes is not None else bytearray(16 * 128)
+        if count is None:
+            count = len(events)
+        saved = 0
+        loudest = 0
+        with self.lock:
+            self.soundfont_id = soundfont_id
+            self.skip_programs = skip_programs
+            self.note_offset = note_offset
+            self.source_notes = active_notes
+            for status, channel, data1, data2 in events:
+                if status == 0x90 and data2:
+                    index = channel * 128 + data1
+                    source_velocities[index] = data2
+                    if note_offset:
+                        data1 += note_offset
+                        if data1 >> 7:
+                            saved += 1
+                            continue
+                        index += note_offset
+                    noteon(channel, data1, data2)
+                    if not velocities[index]:
+                        pitches[data1] += 1
+                    velocities[index] = data2
+                    if data2 > loudest:
+                        loudest = data2
+                elif status == 0x80 or status == 0x90:
+                    index = channel * 128 + data1
+                    source_velocities[index] = 0
+                    if note_offset:
+                        data1 += note_offset
+                        if data1 >> 7:
+                            saved += 1
+                            continue
+                        index += note_offset
+                    if velocities[index]:
+                        noteoff(channel, data1)
+                        velocities[index] = 0
+                        pitches[data1] -= 1
+                    else:
+                        saved += 1
+                else:
+                    saved += 1 - handlers[status >> 4](channel, data1, data2)
+            self.events += count
+            self.calls += count - saved
+            self.batches += 1
+        return loudest
+
+    def ignore_message(self, channel, data1, data2):
+        return 0
+
+    def handle_key_pressure(self, channel, note, pressure):
+        midi_note = note + self.note_offset
+        if not 0 <= midi_note < 128 or not self.notes.velocities[channel * 128 + midi_note]:
+            return 0
+        key_pressure = getattr(self.target, 'key_pressure', None)
+        if key_pressure is None:
+            return 0
+        key_pressure(channel, midi_note, pressure)
+        return 1
+
+    def handle_control_change(self, channel, controller, value):
+        controllers = self.controllers
+        if controller >= 120:
+            self.target.cc(channel, controller, value)
+            if controller == 121:
+                controllers[channel * 128:channel * 128 + 128] = bytes([CONTROLLER_UNSET]) * 128
+                self.pitch_bends[channel] = None
+                self.pressures[channel] = None
+            elif controller != 122:
+                self.notes.clear_channel(channel)
+                if self.source_notes is not None:
+                    self.source_notes.clear_channel(channel)
+            return 1
+        if controllers[channel * 128 + controller] == value:
+            return 0
+        self.target.cc(channel, controller, value)
+        controllers[channel * 128 + controller] = value
+        if controller == 0 or controller == 32:
+            self.programs[channel] = None
+        return 1
+
+    def handle_program_change(self, channel, program, data2):
+        if channel == 9 or channel in self.skip_programs:
+            return 0
+        soundfont_id = self.soundfont_id
+        selected = (soundfont_id, 0, program)
+        if self.programs[channel] == selected:
+            return 0
+        if soundfont_id is None:
+            self.target.program_change(channel, program)
+        else:
+            self.target.program_select(channel, soundfont_id, 0, program)
+        self.programs[channel] = selected
+        return 1
+
+    def handle_channel_pressure(self, channel, pressure, data2):
+        if self.pressures[channel] == pressure:
+            return 0
+        channel_pressure = getattr(self.target, 'channel_pressure', None)
+        if channel_pressure is None:
+            return 0
+        channel_pressure(channel, pressure)
+        self.pressures[channel] = pressure
+        return 1
+
+    def handle_pitch_bend(self, channel, lsb, msb):
+        value = ((msb << 7) | lsb) - PITCH_BEND_CENTER
+        if self.pitch_bends[channel] == value:
+            return 0
+        self.target.pitch_bend(channel, value)
+        self.pitch_bends[channel] = value
+        return 1
+
+    def release(self, notes):
+        by_channel = collections.defaultdict(set)
+        for channel, note in notes:
+            by_channel[channel].add(note)
+        with self.lock:
+            notes = self.notes
+            for channel, channel_notes in by_channel.items():
+                base = channel * 128
+                playing = [note for note in channel_notes if 0 <= note < 128 and notes.velocities[base + note]]
+                self.events += len(channel_notes)
+                if len(playing) > 1 and len(playing) == notes.channel_count(channel):
+                    self.target.cc(channel, 123, 0)
+                    notes.clear_channel(channel)
+                    self.calls += 1
+                    continue
+                for note in playing:
+                    self.target.noteoff(channel, note)
+                    notes.release(channel, note)
+                self.calls += len(playing)
+            self.batches += 1
+
+    def release_pedals(self):
+        with self.lock:
+            for channel in range(16):
+                for pedal in HOLD_PEDALS:
+                    index = channel * 128 + pedal
+                    value = self.controllers[index]
+                    if value >= 64 and value != CONTROLLER_UNSET:
+                        self.target.cc(channel, pedal, 0)
+                        self.controllers[index] = 0
+                        self.events += 1
+                        self.calls += 1
+
+    def noteon(self, channel, note, velocity):
+        self.dispatch(((0x90, channel, note, velocity),))
+
+    def noteoff(self, channel, note):
+        self.dispatch(((0x80, channel, note, 0),))
+
+    def cc(self, channel, controller, value):
+        self.dispatch(((0xB0, channel, controller, value),))
+
+    def program_change(self, channel, program):
+        with self.lock:
+            self.events += 1
+            if self.programs[channel] != (None, 0, program):
+                self.programs[channel] = (None, 0, program)
+                self.calls += 1
+                self.target.program_change(channel, program)
+
+    def program_select(self, channel, soundfont_id, bank, program):
+        with self.lock:
+            self.events += 1
+            if self.programs[channel] != (soundfont_id, bank, program):
+                self.programs[channel] = (soundfont_id, bank, program)
+                self.calls += 1
+                self.target.program_select(channel, soundfont_id, bank, program)
+
+    def pitch_bend(self, channel, value):
+        value += PITCH_BEND_CENTER
+        self.dispatch(((0xE0, channel, value & 0x7F, value >> 7),))
+
+    def sfunload(self, soundfont_id, update_midi_preset=False):
+        with self.lock:
+            channels = [channel for channel, selected in enumerate(self.programs) if selected is not None and selected[0] == soundfont_id]
+            if channels:
+                logging.error(f"Unloading SoundFont {soundfont_id} while channels {channels} still use its presets.")
+                for channel in channels:
+                    self.programs[channel] = None
+            return self.target.sfunload(soundfont_id, update_midi_preset)
+
+    def __str__(self):
+        return f"{self.events} events, {self.calls} synth calls, {self.saved} saved, {self.batches} batches"
+
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+def flatten_metrics(snapshot, prefix='pianomancer'):
+    for key, value in snapshot.items():
+        name = f"{prefix}_{key}"
+        if isinstance(value, dict):
+            yield from flatten_metrics(value, name)
+        elif value is not None:
+            yield name, value
+
+def format_prometheus(snapshot):
+    lines = []
+    for name, value in flatten_metrics(snapshot):
+        kind = 'counter' if name.endswith(('_total', '_count')) else 'gauge'
+        lines.append(f"# TYPE {name} {kind}")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+class PerformanceMetrics:
+    def __init__(self, path=None, interval=DEFAULT_METRICS_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.prometheus = path is not None and path.lower().endswith(('.prom', '.txt'))
+        self.overlay = False
+        self.snapshot = None
+        self.generation = 0
+        self.last_sample = None
+        self.last_counts = None
+        self.last_export = 0.0
+
+    def sample_interval(self):
+        intervals = [METRICS_OVERLAY_INTERVAL] if self.overlay else []
+        if self.path:
+            intervals.append(self.interval)
+        return min(intervals, default=None)
+
+    def next_sample(self):
+        interval = self.sample_interval()
+        if interval is None:
+            return None
+        return (self.last_sample or 0.0) + interval
+
+    def due(self, now):
+        next_sample = self.next_sample()
+        return next_sample is not None and now >= next_sample
+
+    def sample(self, now, snapshot, export=False):
+        counts = (snapshot['events_dispatched']['total'], snapshot['synth_calls']['total'], snapshot['frames']['rendered_total'],
+                  snapshot['frames']['render_seconds_total'])
+        if self.last_counts is not None and now > self.last_sample:
+            elapsed = now - self.last_sample
+            snapshot['events_dispatched']['per_second'] = (counts[0] - self.last_counts[0]) / elapsed
+            snapshot['synth_calls']['per_second'] = (counts[1] - self.last_counts[1]) / elapsed
+            frames = counts[2] - self.last_counts[2]
+            snapshot['frames']['render_ms_mean'] = (counts[3] - self.last_counts[3]) * 1000.0 / frames if frames else 0.0
+        self.last_sample = now
+        self.last_counts = counts
+        self.snapshot = snapshot
+        self.generation += 1
+        if self.path and (export or now - self.last_export >= self.interval):
+            self.last_export = now
+            self.export()
+
+    def export(self):
+        temp_path = self.path + '.part'
+        try:
+            with open(temp_path, 'w') as f:
+                if self.prometheus:
+                    f.write(format_prometheus(self.snapshot))
+                else:
+                    json.dump(self.snapshot, f, indent=2)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logging.warning(f"Error writing metrics to {self.path}: {e}")
+
+    def overlay_lines(self):
+        snapshot = self.snapshot
+        if snapshot is None:
+            return ["Performance (7 to hide)", "collecting..."]
+        frames = snapshot['frames']
+        input_latency = snapshot['input_latency']
+        lateness = snapshot['scheduler_lateness']
+        voices = snapshot['active_voices']
+        memory = snapshot['resident_memory_bytes']
+        return [
+            "Performance (7 to hide)",
+            f"Frame     {frames.get('render_ms_mean', 0.0):6.2f} ms avg {frames['render_ms_max']:6.2f} max",
+            f"Input     {input_latency['p50_ms']:6.2f} ms p50 {input_latency['p99_ms']:6.2f} p99",
+            f"Schedule  {lateness['p50_ms']:6.2f} ms p50 {lateness['p99_ms']:6.2f} p99",
+            f"Events    {snapshot['events_dispatched'].get('per_second', 0.0):8.0f} /s",
+            f"Synth     {snapshot['synth_calls'].get('per_second', 0.0):8.0f} calls/s",
+            f"Coalesced {snapshot['synth_calls']['saved_total']:8} calls",
+            f"Voices    {voices if voices is not None else 'n/a':>8} ({snapshot['active_notes']} notes)",
+            f"Memory    {memory / (1024 * 1024) if memory else 0.0:8.1f} MB",
+        ]
+
+    def draw(self, stdscr, max_x):
+        lines = self.overlay_lines()
+        x = max(1, max_x - METRICS_OVERLAY_WIDTH - 2)
+        width = min(METRICS_OVERLAY_WIDTH, max_x - x - 1)
+        for row, line in enumerate(lines):
+            try:
+                stdscr.addstr(1 + row, x, f" {line}".ljust(width)[:width], curses.color_pair(8 if row == 0 else 7))
+            except:
+                pass
+        return len(lines) * width
+
+def note_column(note, max_x):
+    note_width = (max_x - 2) // len(PIANO_NOTE_RANGE)
+    if note_width == 0:
+        return 1 + (note - PIANO_NOTE_RANGE.start) * (max_x - 2) // len(PIANO_NOTE_RANGE)
+    return 1 + (note - PIANO_NOTE_RANGE.start) * note_width + note_width // 2
+
 def format_time(seconds):
     mm = int(seconds // 60)
     ss = int(seconds % 60)
@@ -133,9 +1102,9 @@ def display_scrollable_list(stdscr, items, selected, start_index, title):
             stdscr.move(row, 2)
             stdscr.clrtoeol()
             if (start_index + idx) == selected:
-                stdscr.addstr(row, 2, f"> {item}", curses.color_pair(8))
+                stdscr.addstr(row, 2, f"> {item}"[:max_x - 3], curses.color_pair(8))
             else:
-                stdscr.addstr(row, 2, f"  {item}", curses.color_pair(7))
+                stdscr.addstr(row, 2, f"  {item}"[:max_x - 3], curses.color_pair(7))
         instructions = "Up/Down: Move | PageUp/PageDown: Scroll | Enter: Select | Q: Cancel"
         if max_y - 3 >= 0:
             stdscr.move(max_y - 3, 2)
@@ -145,145 +1114,386 @@ def display_scrollable_list(stdscr, items, selected, start_index, title):
     except:
         pass
 
+def generate_tree_lines(height, max_width, light_density=DEFAULT_LIGHT_DENSITY, rng=random):
+    trunk_height = max(2, height // 8)
+    body_height = max(3, height - 1 - trunk_height)
+    width = max(5, min(2 * body_height - 1, max_width))
+    if width % 2 == 0:
+        width -= 1
+    lines = ['★'.center(width)]
+    for row in range(body_height):
+        row_width = 1 + 2 * (row * (width // 2) // (body_height - 1))
+        cells = ['O' if 0 < column < row_width - 1 and rng.random() < light_density else '*'
+                 for column in range(row_width)]
+        lines.append(''.join(cells).center(width))
+    trunk_width = max(3, (width // 8) | 1)
+    for _ in range(trunk_height):
+        lines.append(('*' * trunk_width).center(width))
+    return lines
+
 class ChristmasTreeDisplay:
-    def __init__(self, tree_lines, color_pairs, stdscr):
+    def __init__(self, tree_lines, color_pairs, stdscr, procedural=False, light_density=DEFAULT_LIGHT_DENSITY,
+                 light_pulse=False, reserved_rows=0):
         self.tree_lines = tree_lines
+        self.classic_tree_lines = tree_lines
         self.color_pairs = color_pairs
         self.stdscr = stdscr
+        self.procedural = procedural
+        self.light_density = light_density
+        self.light_pulse = light_pulse
+        self.reserved_rows = reserved_rows
+        self.pending_pulse = 0
         self.light_states = {}
+        self.light_heap = []
+        self.light_positions = []
         self.min_delay = 0.5
         self.max_delay = 2.0
         self.initialize_lights()
-        self.active_notes = set()
+        self.active_notes = NoteState()
         self.note_display_start_line = len(tree_lines) + 2
+        self.static_layer = None
+        self.static_size = None
+        self.needs_full_redraw = True
+        self.dirty_lights = set()
+        self.drawn_notes = {}
+        self.cells_written = 0
+        self.last_frame_cells = 0
+        self.drawn_counter = None
+        self.show_tree = True
 
     def initialize_lights(self):
         current_time = time.time()
+        self.light_states = {}
+        self.light_heap = []
         for line_idx, line in enumerate(self.tree_lines):
             for char_idx, char in enumerate(line):
                 if char == 'O':
-                    color = random.choice(self.color_pairs)
+                    color_index = random.randrange(len(self.color_pairs))
                     next_change = current_time + random.uniform(self.min_delay, self.max_delay)
-                    self.light_states[(line_idx, char_idx)] = {'color': color, 'next_change': next_change}
+                    self.light_states[(line_idx, char_idx)] = {'color': self.color_pairs[color_index],
+                                                               'color_index': color_index,
+                                                               'next_change': next_change}
+                    self.light_heap.append((next_change, (line_idx, char_idx)))
+        heapq.heapify(self.light_heap)
+        self.light_positions = list(self.light_states)
 
-    def update_lights(self):
-        current_time = time.time()
-        for position, state in self.light_states.items():
-            if current_time >= state['next_change']:
-                available_colors = [cp for cp in self.color_pairs if cp != state['color']]
-                if not available_colors:
-                    available_colors = self.color_pairs
-                new_color = random.choice(available_colors)
-                self.light_states[position]['color'] = new_color
-                self.light_states[position]['next_change'] = current_time + random.uniform(self.min_delay, self.max_delay)
+    def resize_tree(self, max_y, max_x):
+        if not self.procedural:
+            return
+        height = max(len(self.classic_tree_lines), max_y - self.reserved_rows)
+        self.tree_lines = generate_tree_lines(height, max_x - 4, self.light_density)
+        self.note_display_start_line = len(self.tree_lines) + 2
+        self.drawn_notes = {}
+        self.initialize_lights()
+
+    def change_light(self, position):
+        state = self.light_states[position]
+        count = len(self.color_pairs)
+        if count > 1:
+            state['color_index'] = (state['color_index'] + random.randrange(1, count)) % count
+        state['color'] = self.color_pairs[state['color_index']]
+        self.dirty_lights.add(position)
+
+    def schedule_light(self, position, next_change):
+        self.light_states[position]['next_change'] = next_change
+        heapq.heappush(self.light_heap, (next_change, position))
+
+    def update_lights(self, current_time=None):
+        if current_time is None:
+            current_time = time.time()
+        if self.pending_pulse:
+            self.apply_pulse(current_time)
+        heap = self.light_heap
+        states = self.light_states
+        color_pairs = self.color_pairs
+        count = len(color_pairs)
+        dirty_lights = self.dirty_lights
+        delay_span = self.max_delay - self.min_delay
+        base_delay = current_time + self.min_delay
+        while heap and heap[0][0] <= current_time:
+            next_change, position = heap[0]
+            state = states[position]
+            if state['next_change'] != next_change:
+                heapq.heappop(heap)
+                continue
+            if count > 1:
+                state['color_index'] = (state['color_index'] + random.randrange(1, count)) % count
+            state['color'] = color_pairs[state['color_index']]
+            dirty_lights.add(position)
+            state['next_change'] = next_change = base_delay + random.random() * delay_span
+            heapq.heapreplace(heap, (next_change, position))
+
+    def pulse(self, velocity):
+        if self.light_pulse and velocity > self.pending_pulse:
+            self.pending_pulse = velocity
+
+    def apply_pulse(self, current_time):
+        velocity = self.pending_pulse
+        self.pending_pulse = 0
+        if not self.light_positions:
+            return
+        count = max(1, round(len(self.light_positions) * LIGHT_PULSE_FRACTION * velocity / 127))
+        for position in random.sample(self.light_positions, min(count, len(self.light_positions))):
+            self.change_light(position)
+            self.schedule_light(position, current_time + random.uniform(self.min_delay, self.max_delay))
+
+    def invalidate(self):
+        self.needs_full_redraw = True
+
+    def next_light_change(self):
+        return self.light_heap[0][0] if self.light_heap else None
+
+    def lights_due(self):
+        return bool(self.pending_pulse) or (bool(self.light_heap) and self.light_heap[0][0] <= time.time())
+
+    def tree_origin(self, max_x):
+        tree_width = max(len(line) for line in self.tree_lines)
+        return (max_x - tree_width) // 2
+
+    def tree_cell_visible(self, line_idx, x_position, max_y, max_x):
+        y_position = line_idx + 1
+        return line_idx + 1 < max_y - 5 and 0 <= x_position < max_x - 1 and 0 <= y_position < max_y - 4
+
+    def build_static_layer(self, max_y, max_x):
+        pad = curses.newpad(max_y, max_x)
+        border = curses.color_pair(4)
+        for x in range(max_x):
+            pad.addch(0, x, '-', border)
+            pad.addch(max_y - 4, x, '-', border)
+        for y in range(max_y):
+            pad.addch(y, 0, '|', border)
+            try:
+                pad.addch(y, max_x - 1, '|', border)
+            except curses.error:
+                pass
+        for y, x in ((0, 0), (0, max_x - 1), (max_y - 4, 0), (max_y - 4, max_x - 1)):
+            pad.addch(y, x, '+', border)
+        start_x = self.tree_origin(max_x)
+        for line_idx, line in enumerate(self.tree_lines):
+            for char_idx, char in enumerate(line):
+                x_position = start_x + char_idx
+                if not self.show_tree or char in ' O' or not self.tree_cell_visible(line_idx, x_position, max_y, max_x):
+                    continue
+                if char == '★':
+                    pad.addstr(line_idx + 1, x_position, char, curses.color_pair(7) | curses.A_BOLD)
+                elif char == '*':
+                    pad.addstr(line_idx + 1, x_position, char, curses.color_pair(2))
+                else:
+                    pad.addstr(line_idx + 1, x_position, char, curses.color_pair(7))
+        self.static_layer = pad
+        self.static_size = (max_y, max_x)
+
+    def draw_light(self, position, max_y, max_x, start_x):
+        line_idx, char_idx = position
+        x_position = start_x + char_idx
+        if not self.tree_cell_visible(line_idx, x_position, max_y, max_x):
+            return
+        try:
+            self.stdscr.addstr(line_idx + 1, x_position, 'O', self.light_states[position]['color'])
+            self.cells_written += 1
+        except:
+            pass
 
     def draw_tree(self):
         max_y, max_x = self.stdscr.getmaxyx()
         if max_y < MIN_HEIGHT or max_x < MIN_WIDTH:
             return
         try:
-            for x in range(max_x):
-                if 0 <= x < max_x:
-                    if 0 < max_y:
-                        self.stdscr.move(0, x)
-                        self.stdscr.addch('-', curses.color_pair(4))
-                    if max_y - 4 < max_y and max_y - 4 >= 0:
-                        self.stdscr.move(max_y - 4, x)
-                        self.stdscr.addch('-', curses.color_pair(4))
-            for y in range(max_y):
-                if 0 <= y < max_y:
-                    self.stdscr.move(y, 0)
-                    self.stdscr.addch('|', curses.color_pair(4))
-                    self.stdscr.move(y, max_x - 1)
-                    self.stdscr.addch('|', curses.color_pair(4))
-            if max_y > 0 and max_x > 0:
-                self.stdscr.move(0, 0)
-                self.stdscr.addch('+', curses.color_pair(4))
-            if max_y > 0 and max_x - 1 >= 0:
-                self.stdscr.move(0, max_x - 1)
-                self.stdscr.addch('+', curses.color_pair(4))
-            if max_y - 4 >= 0:
-                self.stdscr.move(max_y - 4, 0)
-                self.stdscr.addch('+', curses.color_pair(4))
-            if max_y - 4 >= 0 and max_x - 1 >= 0:
-                self.stdscr.move(max_y - 4, max_x - 1)
-                self.stdscr.addch('+', curses.color_pair(4))
+            if self.static_size != (max_y, max_x):
+                self.resize_tree(max_y, max_x)
+                self.build_static_layer(max_y, max_x)
+                self.needs_full_redraw = True
+            if self.needs_full_redraw:
+                self.static_layer.overlay(self.stdscr, 0, 0, 0, 0, max_y - 1, max_x - 1)
+                self.cells_written += 2 * max_x + 2 * max_y + sum(len(line.strip()) for line in self.tree_lines)
+                self.dirty_lights = set(self.light_states)
+                self.drawn_notes = {}
+                self.drawn_counter = None
+                self.needs_full_redraw = False
         except:
             pass
-        tree_width = max(len(line) for line in self.tree_lines)
-        start_x = (max_x - tree_width) // 2
-        for line_idx, line in enumerate(self.tree_lines):
-            if line_idx + 1 >= max_y - 5:
-                break
-            for char_idx, char in enumerate(line):
-                x_position = start_x + char_idx
-                y_position = line_idx + 1
-                if 0 <= x_position < max_x - 1 and 0 <= y_position < max_y - 4:
-                    try:
-                        if char == '★':
-                            self.stdscr.move(y_position, x_position)
-                            self.stdscr.addstr(char, curses.color_pair(7) | curses.A_BOLD)
-                        elif char == 'O':
-                            if (line_idx, char_idx) in self.light_states:
-                                color = self.light_states[(line_idx, char_idx)]['color']
-                            else:
-                                color = curses.color_pair(7)
-                            self.stdscr.move(y_position, x_position)
-                            self.stdscr.addstr(char, color)
-                        elif char == '*':
-                            self.stdscr.move(y_position, x_position)
-                            self.stdscr.addstr(char, curses.color_pair(2))
-                        else:
-                            self.stdscr.move(y_position, x_position)
-                            self.stdscr.addstr(char, curses.color_pair(7))
-                    except:
-                        pass
+        start_x = self.tree_origin(max_x)
+        if self.show_tree:
+            for position in self.dirty_lights:
+                self.draw_light(position, max_y, max_x, start_x)
+        self.dirty_lights.clear()
         self.stdscr.noutrefresh()
 
     def draw_active_notes(self):
         max_y, max_x = self.stdscr.getmaxyx()
         if max_y < MIN_HEIGHT or max_x < MIN_WIDTH:
             return
+        active_notes = self.active_notes.snapshot()
+        for note in set(self.drawn_notes) - active_notes:
+            column = note_column(note, max_x)
+            try:
+                self.stdscr.addstr(self.note_display_start_line, column, ' ', curses.color_pair(7))
+                self.cells_written += 1
+            except:
+                pass
+            del self.drawn_notes[note]
+        for note in active_notes:
+            if note in self.drawn_notes or note not in PIANO_NOTE_RANGE:
+                continue
+            column = note_column(note, max_x)
+            color = curses.color_pair(random.choice([1, 2, 3, 5, 6]))
+            try:
+                self.stdscr.addstr(self.note_display_start_line, column, '█', color)
+                self.cells_written += 1
+            except:
+                pass
+            self.drawn_notes[note] = color
+        self.stdscr.noutrefresh()
+
+    def draw_cell_counter(self):
+        max_y, max_x = self.stdscr.getmaxyx()
+        counter = f" cells/frame: {self.last_frame_cells:>5} "
+        if counter == self.drawn_counter or max_x < len(counter) + 4:
+            return
         try:
-            self.stdscr.move(self.note_display_start_line, 1)
-            self.stdscr.clrtoeol()
-            for x in range(1, max_x - 1):
-                self.stdscr.move(self.note_display_start_line, x)
-                self.stdscr.addch(' ', curses.color_pair(7))
+            self.stdscr.addstr(max_y - 4, max_x - len(counter) - 2, counter, curses.color_pair(4))
         except:
             pass
-        note_range = list(range(21, 109))
-        max_display_x = max_x - 2
-        num_notes = len(note_range)
-        if num_notes == 0:
-            return
-        note_width = max_display_x // num_notes
-        for idx, note in enumerate(note_range):
-            column = 1 + idx * note_width + note_width // 2
-            if note in self.active_notes:
-                try:
-                    self.stdscr.move(self.note_display_start_line, column)
-                    self.stdscr.addstr('█', curses.color_pair(random.choice([1, 2, 3, 5, 6])))
-                except:
-                    pass
-        self.stdscr.noutrefresh()
+        self.drawn_counter = counter
 
-    def update_display(self):
+    def set_tree_visible(self, visible):
+        self.show_tree = visible
+        self.static_size = None
+
+    def update_display(self, overlays=()):
+        self.cells_written = 0
         self.update_lights()
         self.draw_tree()
         self.draw_active_notes()
+        for overlay in overlays:
+            self.cells_written += overlay()
+        self.last_frame_cells = self.cells_written
+        self.draw_cell_counter()
+
+class PianoRollView:
+    def __init__(self, stdscr, lookahead=DEFAULT_LOOKAHEAD):
+        self.stdscr = stdscr
+        self.lookahead = lookahead
+        self.window = None
+        self.geometry = None
+        self.reset_key = None
+        self.bottom_time = 0.0
+        self.row_span = 0.0
+        self.horizon_index = 0
+        self.sounding = {}
+        self.struck = {}
+
+    def invalidate(self):
+        self.reset_key = None
+
+    def layout(self, height, width):
+        if self.geometry != (height, width):
+            self.window = self.stdscr.derwin(height, width, 1, 1)
+            self.window.scrollok(True)
+            self.window.idlok(True)
+            self.geometry = (height, width)
+            self.reset_key = None
+
+    def advance(self, timeline, logical_time):
+        index = self.horizon_index
+        times = timeline.times
+        while index < timeline.length and times[index] <= logical_time:
+            status = timeline.statuses[index]
+            key = (timeline.channels[index], timeline.data1[index])
+            if status == 0x90 and timeline.data2[index] > 0:
+                self.sounding[key] = True
+                self.struck[key] = True
+            elif status == 0x80 or status == 0x90:
+                self.sounding.pop(key, None)
+            index += 1
+        self.horizon_index = index
+
+    def paint_row(self, row, note_offset, max_x):
+        cells = 0
+        notes = self.sounding.keys() | self.struck.keys()
+        self.struck = {}
+        for channel, note in notes:
+            pitch = note + note_offset
+            if pitch not in PIANO_NOTE_RANGE:
+                continue
+            try:
+                self.window.addstr(row, note_column(pitch, max_x) - 1, '█', curses.color_pair(ROLL_COLORS[channel % len(ROLL_COLORS)]))
+                cells += 1
+            except:
+                pass
+        return cells
+
+    def repaint(self, timeline, now, note_offset, max_x):
+        height = self.geometry[0]
+        self.window.erase()
+        self.bottom_time = now
+        self.horizon_index = timeline.index_at(now)
+        state = timeline.state_at(self.horizon_index)
+        self.sounding = {(channel, note): True for channel, note, _ in state.sounding_notes()}
+        self.struck = {}
+        cells = 0
+        for row in range(height - 1, -1, -1):
+            self.advance(timeline, now + (height - 1 - row) * self.row_span)
+            cells += self.paint_row(row, note_offset, max_x)
+        return cells + height * self.geometry[1]
+
+    def rows_due(self, player):
+        if self.reset_key is None or self.row_span <= 0:
+            return True
+        return player.get_current_logical_time() - self.bottom_time >= self.row_span
+
+    def draw(self, player, height, max_x):
+        if height < 2:
+            return 0
+        self.layout(height, max_x - 2)
+        if player is None or getattr(player, 'timeline', None) is None:
+            if self.reset_key is not None:
+                self.window.erase()
+                self.reset_key = None
+            return 0
+        timeline = player.timeline
+        note_offset = player.octave_shift * 12
+        now = player.get_current_logical_time()
+        reset_key = (id(timeline), player.playback_speed, note_offset, self.lookahead)
+        if reset_key != self.reset_key:
+            self.reset_key = reset_key
+            self.row_span = self.lookahead * player.playback_speed / (height - 1)
+            return self.repaint(timeline, now, note_offset, max_x)
+        rows = int((now - self.bottom_time) / self.row_span)
+        if rows < 0 or rows >= height:
+            return self.repaint(timeline, now, note_offset, max_x)
+        if rows == 0:
+            return 0
+        top_time = self.bottom_time + (height - 1) * self.row_span
+        self.window.scroll(-rows)
+        self.bottom_time += rows * self.row_span
+        cells = 0
+        for step in range(1, rows + 1):
+            self.advance(timeline, top_time + step * self.row_span)
+            cells += self.paint_row(rows - step, note_offset, max_x)
+        return cells
 
 class MIDIPlayer:
-    def __init__(self, midi_file, octave_shift, playback_speed, fs, global_active_notes, stdscr, loop_mode=False):
+    def __init__(self, midi_file, octave_shift, playback_speed, fs, global_active_notes, stdscr, loop_mode=False, use_scheduler_thread=False, timeline_cache=None, clock=None, note_listener=None, timeline=None, soundfont_id=None, preset_overrides=None):
+        self.timeline_cache = timeline_cache
+        self.timeline = timeline
+        self.note_listener = note_listener
+        self.soundfont_id = soundfont_id
+        self.preset_overrides = preset_overrides if preset_overrides is not None else {}
+        self.clock = clock if clock is not None else time.perf_counter
+        self.lock = threading.RLock()
+        self.wakeup = threading.Condition(self.lock)
+        self.lateness = LatenessStats()
+        self.dispatched = 0
+        self.scheduler_thread = None
         try:
-            self.midi = mido.MidiFile(midi_file)
+            self.midi_file = midi_file
             self.octave_shift = octave_shift
             self.playback_speed = playback_speed
-            self.fs = fs
+            self.fs = fs if isinstance(fs, SynthDispatcher) else SynthDispatcher(fs, global_active_notes)
             self.is_playing = True
             self.interrupted = False
-            self.active_notes = set()
-            self.global_active_notes = global_active_notes
+            self.active_notes = NoteState(refcounted=False)
             self.loop_mode = loop_mode
             self.stdscr = stdscr
             self.paused = False
@@ -293,29 +1503,61 @@ class MIDIPlayer:
             self.paused_logical_time = 0.0
             self.prepare_messages()
             logging.info(f"MIDIPlayer initialized for file: {midi_file}")
+            if use_scheduler_thread and self.is_playing:
+                self.start_scheduler()
         except:
             logging.exception("Error initializing MIDIPlayer.")
             self.is_playing = False
 
     def prepare_messages(self):
         try:
-            self.message_queue = []
-            absolute_time = 0
-            for msg in self.midi:
-                time_in_seconds = msg.time
-                absolute_time += time_in_seconds
-                self.message_queue.append((absolute_time, msg))
-            self.message_queue.sort(key=lambda x: x[0])
-            self.total_messages = len(self.message_queue)
+            if self.timeline is not None:
+                pass
+            elif self.timeline_cache is not None:
+                self.timeline = self.timeline_cache.get(self.midi_file)
+            else:
+                self.timeline = EventTimeline.from_midi_file(self.midi_file)
+            self.total_messages = self.timeline.length
             self.current_message_index = 0
-            self.start_time = time.perf_counter()
+            self.start_time = self.clock()
             self.pause_offset = 0.0
-            self.total_length = self.message_queue[-1][0] if self.message_queue else 0.0
-            logging.info("MIDI messages prepared for playback.")
+            self.total_length = self.timeline.total_length
+            logging.info(f"MIDI timeline compiled: {self.total_messages} events, {self.timeline.nbytes()} bytes.")
         except:
             logging.exception("Error preparing MIDI messages.")
             self.is_playing = False
 
+    def start_scheduler(self):
+        if self.scheduler_thread is not None:
+            return
+        self.scheduler_thread = threading.Thread(target=self.scheduler_loop, name="MIDIScheduler", daemon=True)
+        self.scheduler_thread.start()
+
+    def scheduler_loop(self):
+        try:
+            with self.wakeup:
+                while self.is_playing and not self.interrupted:
+                    if self.paused or self.paused_for_soundfont:
+                        self.wakeup.wait()
+                        continue
+                    delay = self.time_until_next_event()
+                    if delay > 0:
+                        self.wakeup.wait(min(delay, SCHEDULER_MAX_WAIT))
+                        continue
+                    self.update()
+        except:
+            logging.exception("Error in MIDI scheduler thread.")
+            self.is_playing = False
+
+    def time_until_next_event(self):
+        if self.current_message_index >= self.total_messages:
+            return 0.0 if not self.active_notes else SCHEDULER_MAX_WAIT
+        message_time = self.timeline.times[self.current_message_index]
+        return (message_time - self.get_current_logical_time()) / self.playback_speed
+
+    def notify_scheduler(self):
+        self.wakeup.notify_all()
+
     def get_total_length(self):
         return self.total_length
 
@@ -324,170 +1566,1745 @@ class MIDIPlayer:
             return self.paused_logical_time
         if not self.is_playing and not self.paused and not self.paused_for_soundfont:
             return self.total_length
-        current_real_time = time.perf_counter()
+        current_real_time = self.clock()
         return ((current_real_time - self.start_time) * self.playback_speed) - self.pause_offset
 
     def update(self):
         if self.interrupted or not self.is_playing or self.paused or self.paused_for_soundfont:
             return
-        try:
-            current_logical_time = self.get_current_logical_time()
-            while self.current_message_index < self.total_messages:
-                message_time, msg = self.message_queue[self.current_message_index]
-                if current_logical_time >= message_time:
-                    if not msg.is_meta:
-                        channel = msg.channel if hasattr(msg, 'channel') else 0
-                        if msg.type == 'note_on' and msg.velocity > 0:
-                            midi_note = msg.note + (self.octave_shift * 12)
-                            self.fs.noteon(channel, midi_note, msg.velocity)
-                            self.active_notes.add((channel, msg.note))
-                            self.global_active_notes.add(midi_note)
-                        elif (msg.type == 'note_off') or (msg.type == 'note_on' and msg.velocity == 0):
-                            midi_note = msg.note + (self.octave_shift * 12)
-                            self.fs.noteoff(channel, midi_note)
-                            if (channel, msg.note) in self.active_notes:
-                                self.active_notes.remove((channel, msg.note))
-                            if midi_note in self.global_active_notes:
-                                self.global_active_notes.remove(midi_note)
-                        elif msg.type == 'program_change':
-                            if channel != 9:
-                                self.fs.program_change(channel, msg.program)
-                    self.current_message_index += 1
-                else:
-                    break
-            if self.current_message_index >= self.total_messages and not self.active_notes:
-                if self.loop_mode and not self.interrupted:
-                    self.current_message_index = 0
-                    self.start_time = time.perf_counter()
-                    self.pause_offset = 0.0
-                else:
-                    self.is_playing = False
-        except:
-            logging.exception("Error during MIDIPlayer update.")
-            self.is_playing = False
+        with self.lock:
+            try:
+                current_logical_time = self.get_current_logical_time()
+                timeline = self.timeline
+                start = self.current_message_index
+                end = bisect.bisect_right(timeline.times, current_logical_time, start)
+                if end > start:
+                    loudest = self.fs.dispatch(zip(timeline.statuses[start:end], timeline.channels[start:end],
+                                                   timeline.data1[start:end], timeline.data2[start:end]),
+                                               self.soundfont_id, self.preset_overrides, self.octave_shift * 12,
+                                               self.active_notes, count=end - start)
+                    self.lateness.record_due(timeline.times[start:end], current_logical_time, self.playback_speed)
+                    self.dispatched += end - start
+                    if loudest and self.note_listener is not None:
+                        self.note_listener(loudest)
+                index = end
+                self.current_message_index = index
+                if self.current_message_index >= self.total_messages and not self.active_notes:
+                    if self.loop_mode and not self.interrupted:
+                        self.current_message_index = 0
+                        self.start_time = self.clock()
+                        self.pause_offset = 0.0
+                    else:
+                        self.is_playing = False
+                        logging.info(f"MIDI playback finished. Lateness: {self.lateness}")
+            except:
+                logging.exception("Error during MIDIPlayer update.")
+                self.is_playing = False
 
     def stop(self):
-        try:
-            for note_info in list(self.active_notes):
-                channel, orig_note = note_info
-                adjusted_note = orig_note + (self.octave_shift * 12)
-                self.fs.noteoff(channel, adjusted_note)
-                self.active_notes.remove(note_info)
-                self.global_active_notes.discard(adjusted_note)
-            self.is_playing = False
-            self.interrupted = True
-        except:
-            logging.exception("Error stopping MIDI playback.")
+        with self.lock:
+            try:
+                self.release_notes()
+                self.is_playing = False
+                self.interrupted = True
+                self.notify_scheduler()
+                logging.info(f"MIDI playback stopped. Lateness: {self.lateness}")
+            except:
+                logging.exception("Error stopping MIDI playback.")
+        if self.scheduler_thread is not None and self.scheduler_thread is not threading.current_thread():
+            self.scheduler_thread.join(timeout=1.0)
+
+    def release_notes(self):
+        note_offset = self.octave_shift * 12
+        self.fs.release([(channel, note + note_offset) for channel, note, velocity in self.active_notes.sounding()])
+        self.fs.release_pedals()
+        self.active_notes.clear()
+
+    def restore_pedals(self):
+        state = self.timeline.state_at(self.current_message_index)
+        self.fs.dispatch([(0xB0, channel, pedal, state.controllers[channel * 128 + pedal]) for channel in range(16)
+                          for pedal in HOLD_PEDALS if state.controllers[channel * 128 + pedal] != CONTROLLER_UNSET])
 
     def seek(self, seconds):
-        try:
-            current_time = self.get_current_logical_time()
-            new_time = current_time + seconds
-            new_time = max(0, min(new_time, self.total_length))
-            for (channel, note) in list(self.active_notes):
-                adjusted_note = note + (self.octave_shift * 12)
-                self.fs.noteoff(channel, adjusted_note)
-                self.global_active_notes.discard(adjusted_note)
-                self.active_notes.remove((channel, note))
-            idx = 0
-            while idx < self.total_messages and self.message_queue[idx][0] <= new_time:
-                idx += 1
-            self.current_message_index = idx
-            current_real_time = time.perf_counter()
-            self.start_time = current_real_time - ((new_time + self.pause_offset) / self.playback_speed)
-            if self.paused or self.paused_for_soundfont:
-                self.paused_logical_time = new_time
-        except:
-            logging.exception("Error during seeking.")
+        with self.lock:
+            try:
+                current_time = self.get_current_logical_time()
+                new_time = current_time + seconds
+                new_time = max(0, min(new_time, self.total_length))
+                self.release_notes()
+                idx = self.timeline.index_at(new_time)
+                self.current_message_index = idx
+                state = self.timeline.state_at(idx)
+                state.restore(self.fs, restore_controllers=True, soundfont_id=self.soundfont_id, skip_channels=self.preset_overrides)
+                if not (self.paused or self.paused_for_soundfont):
+                    self.fs.dispatch([(0x90, channel, note, velocity) for channel, note, velocity in state.sounding_notes()],
+                                     note_offset=self.octave_shift * 12, active_notes=self.active_notes)
+                current_real_time = self.clock()
+                self.start_time = current_real_time - ((new_time + self.pause_offset) / self.playback_speed)
+                if self.paused or self.paused_for_soundfont:
+                    self.paused_logical_time = new_time
+                self.notify_scheduler()
+            except:
+                logging.exception("Error during seeking.")
 
     def set_octave_shift(self, new_shift):
-        try:
-            old_shift = self.octave_shift
-            self.octave_shift = new_shift
-            for (channel, note) in list(self.active_notes):
-                old_midi = note + (old_shift * 12)
-                self.fs.noteoff(channel, old_midi)
-                self.global_active_notes.discard(old_midi)
-                self.active_notes.remove((channel, note))
-        except:
-            logging.exception("Error changing octave shift.")
+        with self.lock:
+            try:
+                self.release_notes()
+                self.octave_shift = new_shift
+                self.restore_pedals()
+            except:
+                logging.exception("Error changing octave shift.")
 
     def set_playback_speed(self, new_speed):
-        try:
-            current_logical_time = self.get_current_logical_time()
-            self.playback_speed = new_speed
-            self.start_time = time.perf_counter() - (current_logical_time / self.playback_speed)
-            if self.paused or self.paused_for_soundfont:
-                self.paused_logical_time = current_logical_time
-        except:
-            logging.exception("Error changing playback speed.")
+        with self.lock:
+            try:
+                current_logical_time = self.get_current_logical_time()
+                self.playback_speed = new_speed
+                self.start_time = self.clock() - (current_logical_time / self.playback_speed)
+                if self.paused or self.paused_for_soundfont:
+                    self.paused_logical_time = current_logical_time
+                self.notify_scheduler()
+            except:
+                logging.exception("Error changing playback speed.")
 
     def toggle_pause(self):
-        try:
-            if self.paused:
-                current_real_time = time.perf_counter()
-                self.pause_offset += (current_real_time - self.pause_start) * self.playback_speed
-                self.paused = False
-            else:
-                self.paused_logical_time = self.get_current_logical_time()
-                self.pause_start = time.perf_counter()
-                self.paused = True
-                for (channel, note) in list(self.active_notes):
-                    adjusted_note = note + (self.octave_shift * 12)
-                    self.fs.noteoff(channel, adjusted_note)
-                    self.global_active_notes.discard(adjusted_note)
-                    self.active_notes.remove((channel, note))
-        except:
-            logging.exception("Error toggling pause.")
+        with self.lock:
+            try:
+                if self.paused:
+                    current_real_time = self.clock()
+                    self.pause_offset += (current_real_time - self.pause_start) * self.playback_speed
+                    self.paused = False
+                    self.restore_pedals()
+                else:
+                    self.paused_logical_time = self.get_current_logical_time()
+                    self.pause_start = self.clock()
+                    self.paused = True
+                    self.release_notes()
+                self.notify_scheduler()
+            except:
+                logging.exception("Error toggling pause.")
+
+    def current_programs(self):
+        with self.lock:
+            return self.timeline.state_at(self.current_message_index).programs
+
+    def switch_soundfont(self, soundfont_id):
+        with self.lock:
+            try:
+                self.soundfont_id = soundfont_id
+                programs = self.current_programs()
+                select_soundfont_programs(self.fs, soundfont_id, programs)
+            except:
+                logging.exception("Error switching SoundFont.")
 
     def pause_for_soundfont_change(self):
+        with self.lock:
+            try:
+                if not self.paused_for_soundfont:
+                    self.paused_logical_time = self.get_current_logical_time()
+                    self.pause_start = self.clock()
+                    self.paused_for_soundfont = True
+                    self.release_notes()
+                    self.notify_scheduler()
+            except:
+                logging.exception("Error pausing for SoundFont change.")
+
+    def resume_after_soundfont_change(self):
+        with self.lock:
+            try:
+                if self.paused_for_soundfont:
+                    current_real_time = self.clock()
+                    self.pause_offset += (current_real_time - self.pause_start) * self.playback_speed
+                    self.paused_for_soundfont = False
+                    self.restore_pedals()
+                    self.notify_scheduler()
+            except:
+                logging.exception("Error resuming after SoundFont change.")
+
+SoundFontPreset = collections.namedtuple('SoundFontPreset', ['name', 'bank', 'program', 'sample_bytes'])
+
+def read_riff_chunks(f, start, end):
+    position = start
+    while position + RIFF_CHUNK_HEADER.size <= end:
+        f.seek(position)
+        chunk_id, size = RIFF_CHUNK_HEADER.unpack(f.read(RIFF_CHUNK_HEADER.size))
+        yield chunk_id, position + RIFF_CHUNK_HEADER.size, size
+        position += RIFF_CHUNK_HEADER.size + size + (size & 1)
+
+def decode_sf2_name(raw):
+    return raw.split(b'\0', 1)[0].decode('latin-1').strip()
+
+def zone_targets(bags, generators, first_bag, last_bag, operator):
+    targets = set()
+    for bag_index in range(first_bag, min(last_bag, len(bags) - 1)):
+        for gen_index in range(bags[bag_index][0], min(bags[bag_index + 1][0], len(generators))):
+            if generators[gen_index][0] == operator:
+                targets.add(generators[gen_index][1])
+    return targets
+
+class SoundFontInfo:
+    def __init__(self, path, name, presets, sample_bytes, sample_count, file_size):
+        self.path = path
+        self.name = name
+        self.presets = presets
+        self.sample_bytes = sample_bytes
+        self.sample_count = sample_count
+        self.file_size = file_size
+
+    @classmethod
+    def scan(cls, path):
+        file_size = os.path.getsize(path)
+        name = os.path.splitext(os.path.basename(path))[0]
+        sample_bytes = 0
+        pdta = {}
+        with open(path, 'rb') as f:
+            riff_id, riff_size = RIFF_CHUNK_HEADER.unpack(f.read(RIFF_CHUNK_HEADER.size))
+            if riff_id != b'RIFF' or f.read(4) != b'sfbk':
+                raise ValueError(f"'{path}' is not a SoundFont 2 file.")
+            for chunk_id, offset, size in read_riff_chunks(f, 12, min(8 + riff_size, file_size)):
+                if chunk_id != b'LIST':
+                    continue
+                f.seek(offset)
+                list_type = f.read(4)
+                for sub_id, sub_offset, sub_size in read_riff_chunks(f, offset + 4, offset + size):
+                    if list_type == b'sdta' and sub_id in (b'smpl', b'sm24'):
+                        sample_bytes += sub_size
+                    elif list_type == b'INFO' and sub_id == b'INAM':
+                        f.seek(sub_offset)
+                        name = decode_sf2_name(f.read(sub_size)) or name
+                    elif list_type == b'pdta':
+                        f.seek(sub_offset)
+                        pdta[sub_id] = f.read(sub_size)
+        if b'phdr' not in pdta:
+            raise ValueError(f"'{path}' has no preset headers.")
+        preset_headers = list(SF2_PRESET_HEADER.iter_unpack(pdta[b'phdr'][:len(pdta[b'phdr']) // SF2_PRESET_HEADER.size * SF2_PRESET_HEADER.size]))
+        tables = {}
+        for chunk_id, layout in ((b'pbag', SF2_BAG), (b'pgen', SF2_GENERATOR), (b'inst', SF2_INSTRUMENT),
+                                 (b'ibag', SF2_BAG), (b'igen', SF2_GENERATOR), (b'shdr', SF2_SAMPLE_HEADER)):
+            data = pdta.get(chunk_id, b'')
+            tables[chunk_id] = list(layout.iter_unpack(data[:len(data) // layout.size * layout.size]))
+        samples = tables[b'shdr']
+        instrument_samples = {}
+        for index in range(len(tables[b'inst']) - 1):
+            instrument_samples[index] = zone_targets(tables[b'ibag'], tables[b'igen'], tables[b'inst'][index][1],
+                                                     tables[b'inst'][index + 1][1], SF2_GEN_SAMPLE_ID)
+        presets = []
+        for index in range(len(preset_headers) - 1):
+            preset_name, program, bank, bag_index = preset_headers[index][:4]
+            sample_ids = set()
+            for instrument in zone_targets(tables[b'pbag'], tables[b'pgen'], bag_index,
+                                           preset_headers[index + 1][3], SF2_GEN_INSTRUMENT):
+                sample_ids.update(instrument_samples.get(instrument, ()))
+            preset_bytes = sum(max(0, samples[i][2] - samples[i][1]) * 2 for i in sample_ids if i < len(samples))
+            presets.append(SoundFontPreset(decode_sf2_name(preset_name), bank, program, preset_bytes))
+        presets.sort(key=lambda preset: (preset.bank, preset.program))
+        return cls(path, name, presets, sample_bytes, max(0, len(samples) - 1), file_size)
+
+    def preset(self, bank, program):
+        for preset in self.presets:
+            if preset.bank == bank and preset.program == program:
+                return preset
+        return None
+
+    def describe(self):
+        return f"{self.name}, {len(self.presets)} presets, {self.sample_bytes / (1024 * 1024):.1f} MB of samples"
+
+class SoundFontIndex:
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, path):
+        st = os.stat(path)
+        key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+        info = self.entries.get(key)
+        if info is None:
+            info = SoundFontInfo.scan(path)
+            self.entries[key] = info
+        return info
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class SoundFontDownload:
+    def __init__(self, url, path, sha256=None, chunk_size=DOWNLOAD_CHUNK_BYTES,
+                 retries=DOWNLOAD_RETRIES, timeout=DOWNLOAD_TIMEOUT):
+        self.url = url
+        self.path = path
+        self.part_path = path + '.part'
+        if sha256 is None and url == DEFAULT_SOUNDFONT_URL:
+            sha256 = DEFAULT_SOUNDFONT_SHA256
+        self.sha256 = sha256.lower() if sha256 else None
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.timeout = timeout
+        self.downloaded = 0
+        self.total = None
+        self.done = False
+        self.error = None
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="SoundFontDownload", daemon=True)
+        self.thread.start()
+        return self
+
+    def progress(self):
+        if not self.total:
+            return None
+        return min(1.0, self.downloaded / self.total)
+
+    def run(self):
+        import urllib.error
+        import http.client
+        start = time.perf_counter()
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    self.fetch()
+                    break
+                except urllib.error.HTTPError as e:
+                    if e.code < 500 or attempt == self.retries:
+                        raise
+                    logging.warning(f"SoundFont download failed with HTTP {e.code}, retrying.")
+                except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+                    if attempt == self.retries:
+                        raise
+                    logging.warning(f"SoundFont download interrupted at {self.downloaded} bytes ({e}), resuming.")
+                time.sleep(min(2 ** attempt, 30))
+            self.verify()
+            os.replace(self.part_path, self.path)
+            logging.info(f"Downloaded {self.url} to {self.path} ({self.downloaded} bytes) in {time.perf_counter() - start:.1f}s.")
+        except Exception as e:
+            logging.exception(f"Error downloading SoundFont from {self.url}.")
+            self.error = str(e)
+        finally:
+            self.done = True
+
+    def fetch(self):
+        import urllib.request
+        import urllib.error
+        offset = os.path.getsize(self.part_path) if os.path.exists(self.part_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        try:
+            response = urllib.request.urlopen(urllib.request.Request(self.url, headers=headers), timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            if e.code != 416 or not offset:
+                raise
+            content_range = e.headers.get('Content-Range', '')
+            if content_range.endswith(f'/{offset}'):
+                self.downloaded = self.total = offset
+                return
+            os.remove(self.part_path)
+            raise OSError("partial download does not match the remote file, starting over")
+        with response:
+            content_range = response.headers.get('Content-Range')
+            if response.status == 206 and content_range and content_range.startswith(f'bytes {offset}-'):
+                mode = 'ab'
+                total = content_range.rsplit('/', 1)[-1]
+                self.total = int(total) if total.isdigit() else None
+            else:
+                mode = 'wb'
+                offset = 0
+                length = response.headers.get('Content-Length')
+                self.total = int(length) if length and length.isdigit() else None
+            self.downloaded = offset
+            if offset:
+                logging.info(f"Resuming SoundFont download at byte {offset}.")
+            with open(self.part_path, mode) as f:
+                while True:
+                    chunk = response.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    self.downloaded += len(chunk)
+        if self.total is not None and self.downloaded < self.total:
+            raise OSError(f"connection closed after {self.downloaded} of {self.total} bytes")
+
+    def verify(self):
+        size = os.path.getsize(self.part_path)
+        if self.total is not None and size != self.total:
+            raise ValueError(f"Downloaded {size} bytes, expected {self.total}.")
+        digest = file_sha256(self.part_path)
+        if self.sha256 and digest != self.sha256:
+            os.remove(self.part_path)
+            raise ValueError(f"Checksum mismatch for {self.url}: expected {self.sha256}, got {digest}.")
         try:
-            if not self.paused_for_soundfont:
-                self.paused_logical_time = self.get_current_logical_time()
-                self.pause_start = time.perf_counter()
-                self.paused_for_soundfont = True
-                for (channel, note) in list(self.active_notes):
-                    adjusted_note = note + (self.octave_shift * 12)
-                    self.fs.noteoff(channel, adjusted_note)
-                    self.global_active_notes.discard(adjusted_note)
-                    self.active_notes.remove((channel, note))
+            SoundFontInfo.scan(self.part_path)
         except:
-            logging.exception("Error pausing for SoundFont change.")
+            os.remove(self.part_path)
+            raise
+        logging.info(f"SoundFont download verified, sha256 {digest}.")
 
-    def resume_after_soundfont_change(self):
+def encode_variable_length(value):
+    encoded = bytearray((value & 0x7F,))
+    value >>= 7
+    while value:
+        encoded.insert(0, (value & 0x7F) | 0x80)
+        value >>= 7
+    return encoded
+
+class RecordingBuffer:
+    def __init__(self, path, chunk_events=RECORDING_CHUNK_EVENTS):
+        self.path = path
+        self.part_path = path + '.part'
+        self.chunk_events = chunk_events
+        self.times = array('d')
+        self.statuses = array('B')
+        self.notes = array('B')
+        self.velocities = array('B')
+        self.start_time = None
+        self.event_count = 0
+        self.track_count = 0
+        self.ticks_per_second = RECORDING_TICKS_PER_BEAT * 1000000 / RECORDING_TEMPO
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(self.part_path, 'wb')
+        self.file.write(b'MThd' + struct.pack('>IHHH', 6, 1, 0, RECORDING_TICKS_PER_BEAT))
+
+    def __len__(self):
+        return self.event_count
+
+    def append(self, event):
+        event_type, midi_note, event_time = event
+        if not 0 <= midi_note < 128:
+            return
+        if self.start_time is None:
+            self.start_time = event_time
+        self.times.append(event_time)
+        if event_type == 'note_on':
+            self.statuses.append(0x90)
+            self.velocities.append(127)
+        else:
+            self.statuses.append(0x80)
+            self.velocities.append(0)
+        self.notes.append(midi_note)
+        self.event_count += 1
+        if len(self.times) >= self.chunk_events:
+            self.flush()
+
+    def flush(self):
+        if not self.times:
+            return
+        track = bytearray()
+        if self.track_count == 0:
+            track += b'\x00\xff\x51\x03' + RECORDING_TEMPO.to_bytes(3, 'big')
+        previous_tick = 0
+        for event_time, status, note, velocity in zip(self.times, self.statuses, self.notes, self.velocities):
+            tick = max(previous_tick, round((event_time - self.start_time) * self.ticks_per_second))
+            track += encode_variable_length(tick - previous_tick)
+            track += bytes((status, note, velocity))
+            previous_tick = tick
+        track += b'\x00\xff\x2f\x00'
+        self.file.write(b'MTrk' + struct.pack('>I', len(track)) + track)
+        self.track_count += 1
+        self.file.seek(10)
+        self.file.write(struct.pack('>H', self.track_count))
+        self.file.seek(0, os.SEEK_END)
+        self.file.flush()
+        del self.times[:], self.statuses[:], self.notes[:], self.velocities[:]
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        if not self.event_count:
+            os.remove(self.part_path)
+            return None
+        os.replace(self.part_path, self.path)
+        logging.info(f"Saved recording {self.path}: {self.event_count} events in {self.track_count} chunks.")
+        return self.path
+
+LibraryEntry = collections.namedtuple('LibraryEntry', ['path', 'size', 'mtime_ns', 'duration', 'tracks', 'channels', 'notes',
+                                                       'note_density', 'tempo_min', 'tempo_max', 'error'],
+                                      defaults=(None,) * 10)
+
+def analyze_midi_file(path):
+    try:
+        import mido
+        midi = mido.MidiFile(path)
+        tempos = set()
+        channels = set()
+        notes = 0
+        for track in midi.tracks:
+            for msg in track:
+                if msg.type == 'note_on' and msg.velocity:
+                    notes += 1
+                    channels.add(msg.channel)
+                elif msg.type == 'set_tempo':
+                    tempos.add(msg.tempo)
+        duration = midi.length if midi.type != 2 else 0.0
+        bpms = [mido.tempo2bpm(tempo) for tempo in tempos or (MIDI_DEFAULT_TEMPO,)]
+        return duration, len(midi.tracks), len(channels), notes, notes / duration if duration > 0 else 0.0, min(bpms), max(bpms), None
+    except Exception as e:
+        return (None,) * 7 + (str(e) or type(e).__name__,)
+
+def init_library_worker():
+    if hasattr(os, 'nice'):
+        os.nice(LIBRARY_WORKER_NICE)
+
+def scan_midi_files(root, recursive):
+    pending = [root]
+    while pending:
+        try:
+            with os.scandir(pending.pop()) as entries:
+                entries = list(entries)
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    if recursive and not entry.is_symlink():
+                        pending.append(entry.path)
+                elif entry.name.lower().endswith(('.mid', '.midi')):
+                    stat = entry.stat()
+                    yield entry.path, stat.st_size, stat.st_mtime_ns
+            except OSError:
+                pass
+
+def describe_midi_entry(entry):
+    if entry.error:
+        return "unreadable"
+    if entry.duration is None:
+        return "not indexed yet"
+    tempo = f"{entry.tempo_min:.0f}" if round(entry.tempo_min) == round(entry.tempo_max) else f"{entry.tempo_min:.0f}-{entry.tempo_max:.0f}"
+    return (f"{format_time(entry.duration)}, {entry.tracks} tracks, {entry.channels} channels, "
+            f"{entry.note_density:.1f} notes/s, {tempo} BPM")
+
+def describe_library_scan(stats):
+    return (f"{stats['files']} files, {stats['analyzed']} analyzed, {stats['unchanged']} unchanged, "
+            f"{stats['removed']} removed, {stats['failed']} unreadable in {stats['seconds']:.2f}s")
+
+class MidiLibrary:
+    def __init__(self, path=DEFAULT_LIBRARY_DB):
+        import sqlite3
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] != LIBRARY_VERSION:
+            with self.connection:
+                self.connection.execute("DROP TABLE IF EXISTS midi_files")
+                self.connection.execute("CREATE TABLE midi_files (path TEXT PRIMARY KEY, directory TEXT NOT NULL, "
+                                        "size INTEGER, mtime_ns INTEGER, duration REAL, tracks INTEGER, channels INTEGER, "
+                                        "notes INTEGER, note_density REAL, tempo_min REAL, tempo_max REAL, error TEXT)")
+                self.connection.execute("CREATE INDEX midi_files_directory ON midi_files (directory)")
+                self.connection.execute(f"PRAGMA user_version = {LIBRARY_VERSION}")
+
+    def where_roots(self, roots):
+        clauses = []
+        params = []
+        for root, recursive in roots:
+            if recursive:
+                prefix = os.path.join(root, '')
+                clauses.append("directory = ? OR substr(directory, 1, ?) = ?")
+                params += [root, len(prefix), prefix]
+            else:
+                clauses.append("directory = ?")
+                params.append(root)
+        return " OR ".join(clauses) or "0", params
+
+    def entries(self, roots):
+        clause, params = self.where_roots(roots)
+        rows = self.connection.execute(f"SELECT path, size, mtime_ns, duration, tracks, channels, notes, note_density, "
+                                       f"tempo_min, tempo_max, error FROM midi_files WHERE {clause} ORDER BY path", params)
+        return [LibraryEntry._make(row) for row in rows]
+
+    def scan(self, roots, jobs=None, stop=None):
+        start = time.perf_counter()
+        clause, params = self.where_roots(roots)
+        known = {path: (size, mtime_ns) for path, size, mtime_ns in
+                 self.connection.execute(f"SELECT path, size, mtime_ns FROM midi_files WHERE {clause}", params)}
+        found = {}
+        for root, recursive in roots:
+            for path, size, mtime_ns in scan_midi_files(root, recursive):
+                found[path] = (size, mtime_ns)
+        changed = [path for path, stamp in found.items() if known.get(path) != stamp]
+        removed = [path for path in known if path not in found]
+        with self.connection:
+            self.connection.executemany("DELETE FROM midi_files WHERE path = ?", ((path,) for path in removed))
+        analyzed = 0
+        failed = 0
+        rows = []
+        results = self.analyze(changed, jobs)
+        try:
+            for path, metadata in zip(changed, results):
+                rows.append((path, os.path.dirname(path)) + found[path] + metadata)
+                analyzed += 1
+                failed += metadata[-1] is not None
+                if len(rows) >= LIBRARY_COMMIT_FILES:
+                    self.store(rows)
+                    rows = []
+                if stop is not None and stop.is_set():
+                    break
+        finally:
+            results.close()
+            self.store(rows)
+        return {'files': len(found), 'analyzed': analyzed, 'unchanged': len(found) - len(changed), 'removed': len(removed),
+                'failed': failed, 'seconds': time.perf_counter() - start}
+
+    def analyze(self, paths, jobs=None):
+        workers = min(jobs or os.cpu_count() or 1, len(paths))
+        if workers <= 1:
+            yield from map(analyze_midi_file, paths)
+            return
+        import concurrent.futures
+        import multiprocessing
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_library_worker)
+        try:
+            yield from executor.map(analyze_midi_file, paths, chunksize=LIBRARY_CHUNK_FILES)
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def store(self, rows):
+        if rows:
+            with self.connection:
+                self.connection.executemany("INSERT OR REPLACE INTO midi_files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def close(self):
+        self.connection.close()
+
+class SoundFontManager:
+    def __init__(self, fs, budget_bytes=DEFAULT_SOUNDFONT_BUDGET):
+        self.fs = fs
+        self.budget_bytes = budget_bytes
+        self.lock = threading.Lock()
+        self.resident = collections.OrderedDict()
+        self.active_path = None
+        self.loading_path = None
+        self.pending_path = None
+        self.ready_path = None
+        self.errors = []
+        self.loader_thread = None
+
+    def adopt(self, path, soundfont_id):
+        with self.lock:
+            self.resident[path] = (soundfont_id, self.estimate_size(path))
+            self.resident.move_to_end(path)
+            self.active_path = path
+
+    def estimate_size(self, path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def active_id(self):
+        with self.lock:
+            if self.active_path is None:
+                return None
+            return self.resident[self.active_path][0]
+
+    def request(self, path):
+        with self.lock:
+            if path in self.resident:
+                self.ready_path = path
+                self.pending_path = None
+                return
+            if self.loading_path is not None:
+                self.pending_path = path
+                return
+            self.start_loader(path)
+
+    def start_loader(self, path):
+        self.loading_path = path
+        self.loader_thread = threading.Thread(target=self.load_worker, args=(path,), name="SoundFontLoader", daemon=True)
+        self.loader_thread.start()
+
+    def load_worker(self, path):
+        start = time.perf_counter()
+        try:
+            with SuppressStderr():
+                soundfont_id = self.fs.sfload(path, False)
+        except:
+            logging.exception(f"Error loading SoundFont '{path}'.")
+            soundfont_id = -1
+        with self.lock:
+            if soundfont_id == -1:
+                self.errors.append(f"Error loading SoundFont '{path}'.")
+            else:
+                self.resident[path] = (soundfont_id, self.estimate_size(path))
+                self.ready_path = path
+                logging.info(f"SoundFont '{path}' loaded in the background in {time.perf_counter() - start:.2f}s.")
+            self.loading_path = None
+            if self.pending_path is not None:
+                next_path, self.pending_path = self.pending_path, None
+                if next_path in self.resident:
+                    self.ready_path = next_path
+                else:
+                    self.start_loader(next_path)
+
+    def poll(self):
+        with self.lock:
+            path, self.ready_path = self.ready_path, None
+            errors, self.errors = self.errors, []
+            if path is None:
+                return None, [], errors
+            self.resident.move_to_end(path)
+            self.active_path = path
+            soundfont_id = self.resident[path][0]
+            evicted = self.evict()
+        return soundfont_id, evicted, errors
+
+    def unload(self, evicted):
+        for old_path, old_id in evicted:
+            try:
+                self.fs.sfunload(old_id, False)
+                logging.info(f"Unloaded SoundFont '{old_path}' to stay within the memory budget.")
+            except:
+                logging.exception(f"Error unloading SoundFont '{old_path}'.")
+
+    def evict(self):
+        evicted = []
+        total = sum(size for _, size in self.resident.values())
+        for path in list(self.resident):
+            if total <= self.budget_bytes:
+                break
+            if path == self.active_path:
+                continue
+            soundfont_id, size = self.resident.pop(path)
+            total -= size
+            evicted.append((path, soundfont_id))
+        return evicted
+
+    def status(self):
+        with self.lock:
+            if self.loading_path is not None:
+                return f"loading {os.path.basename(self.loading_path)}..."
+            if self.active_path is not None:
+                return os.path.basename(self.active_path)
+            return "none"
+
+class OfflineRenderer:
+    def __init__(self, soundfont, sample_rate=DEFAULT_SAMPLE_RATE, gain=DEFAULT_GAIN, block_frames=RENDER_BLOCK_FRAMES):
+        self.soundfont = soundfont
+        self.sample_rate = sample_rate
+        self.block_frames = block_frames
+        import fluidsynth
+        self.fs = fluidsynth.Synth(gain=gain, samplerate=float(sample_rate))
+        self.write_s16 = fluidsynth.fluid_synth_write_s16
+        with SuppressStderr():
+            self.soundfont_id = self.fs.sfload(soundfont, True)
+        if self.soundfont_id == -1:
+            self.fs.delete()
+            raise RuntimeError(f"Error loading SoundFont '{soundfont}'.")
+        self.buffer = ctypes.create_string_buffer(block_frames * 4)
+        self.rendered_frames = 0
+        self.reset()
+
+    def reset(self):
+        for channel in range(16):
+            self.fs.cc(channel, 123, 0)
+            self.fs.cc(channel, 121, 0)
+            self.fs.pitch_bend(channel, 0)
+        select_soundfont_programs(self.fs, self.soundfont_id)
+        self.rendered_frames = 0
+
+    def clock(self):
+        return self.rendered_frames / self.sample_rate
+
+    def write_frames(self, frames, output):
+        while frames > 0:
+            block = min(frames, self.block_frames)
+            self.write_s16(self.fs.synth, block, self.buffer, 0, 2, self.buffer, 1, 2)
+            output.write(self.buffer.raw[:block * 4])
+            self.rendered_frames += block
+            frames -= block
+
+    def render(self, midi_file, output, octave_shift=0, playback_speed=1.0, tail_seconds=RENDER_TAIL_SECONDS, timeline_cache=None):
+        self.reset()
+        player = MIDIPlayer(midi_file, octave_shift, playback_speed, self.fs, None, None,
+                            timeline_cache=timeline_cache, clock=self.clock)
+        if getattr(player, 'timeline', None) is None:
+            raise RuntimeError(f"Error reading MIDI file '{midi_file}'.")
+        times = player.timeline.times
+        while player.current_message_index < player.total_messages and player.is_playing:
+            index = player.current_message_index
+            target_frame = math.ceil((player.start_time + times[index] / playback_speed) * self.sample_rate)
+            self.write_frames(target_frame - self.rendered_frames, output)
+            player.update()
+            if player.current_message_index == index:
+                self.write_frames(1, output)
+        self.write_frames(int(tail_seconds * self.sample_rate), output)
+        player.stop()
+        return self.rendered_frames / self.sample_rate
+
+    def render_to_file(self, midi_file, output_path, output_format=None, **kwargs):
+        if output_format is None:
+            output_format = 'raw' if output_path.lower().endswith(('.raw', '.pcm')) else 'wav'
+        temp_path = output_path + '.part'
+        try:
+            with open(temp_path, 'wb') as f:
+                if output_format == 'wav':
+                    with wave.open(f, 'wb') as wav:
+                        wav.setnchannels(2)
+                        wav.setsampwidth(2)
+                        wav.setframerate(self.sample_rate)
+                        seconds = self.render(midi_file, WaveFrameWriter(wav), **kwargs)
+                else:
+                    seconds = self.render(midi_file, f, **kwargs)
+            os.replace(temp_path, output_path)
+        except:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        return seconds
+
+    def delete(self):
+        self.fs.delete()
+
+class WaveFrameWriter:
+    def __init__(self, wav):
+        self.wav = wav
+
+    def write(self, data):
+        self.wav.writeframesraw(data)
+
+class MidiByteParser:
+    def __init__(self):
+        self.running_status = 0
+        self.needed = 0
+        self.data = []
+        self.in_sysex = False
+
+    def feed(self, payload, events):
+        running_status = self.running_status
+        needed = self.needed
+        data = self.data
+        in_sysex = self.in_sysex
+        for byte in payload:
+            if byte >= 0xF8:
+                continue
+            if byte >= 0x80:
+                data.clear()
+                in_sysex = byte == 0xF0
+                needed = MIDI_DATA_LENGTHS.get(byte & 0xF0 if byte < 0xF0 else byte, 0)
+                running_status = byte if needed else 0
+                continue
+            if in_sysex or not running_status:
+                continue
+            data.append(byte)
+            if len(data) == needed:
+                if running_status < 0xF0:
+                    events.append((running_status & 0xF0, running_status & 0x0F, data[0], data[1] if needed == 2 else 0))
+                else:
+                    running_status = 0
+                data.clear()
+        self.running_status = running_status
+        self.needed = needed
+        self.in_sysex = in_sysex
+
+def decode_net_frames(buffer, parser, received, events, sent_times):
+    offset = 0
+    while len(buffer) - offset >= NET_FRAME_HEADER.size:
+        magic, length, sent_ns = NET_FRAME_HEADER.unpack_from(buffer, offset)
+        if magic != NET_FRAME_MAGIC:
+            raise ValueError("bad network MIDI frame header")
+        end = offset + NET_FRAME_HEADER.size + length
+        if end > len(buffer):
+            break
+        count = len(events)
+        parser.feed(buffer[offset + NET_FRAME_HEADER.size:end], events)
+        sent_times.extend([sent_ns / 1e9 if sent_ns else received] * (len(events) - count))
+        offset = end
+    return offset
+
+class MidiStreamProtocol:
+    def __init__(self, server):
+        self.server = server
+        self.parser = MidiByteParser()
+        self.buffer = bytearray()
+        self.framed = None
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.connections += 1
+        self.server.clients += 1
+
+    def data_received(self, data):
+        received = time.monotonic()
+        events = []
+        sent_times = []
+        if self.framed is None:
+            self.buffer += data
+            if len(self.buffer) < len(NET_FRAME_MAGIC):
+                return
+            self.framed = self.buffer.startswith(NET_FRAME_MAGIC)
+            data = bytes(self.buffer)
+            self.buffer.clear()
+        try:
+            if self.framed:
+                self.buffer += data
+                consumed = decode_net_frames(self.buffer, self.parser, received, events, sent_times)
+                del self.buffer[:consumed]
+            else:
+                self.parser.feed(data, events)
+                sent_times = [received] * len(events)
+        except ValueError as e:
+            logging.warning(f"Closing network MIDI connection: {e}")
+            self.transport.close()
+        self.server.dispatch(events, sent_times, len(data))
+
+    def eof_received(self):
+        return None
+
+    def connection_lost(self, exc):
+        self.server.clients -= 1
+
+class MidiDatagramProtocol:
+    def __init__(self, server):
+        self.server = server
+
+    def connection_made(self, transport):
+        pass
+
+    def datagram_received(self, data, addr):
+        received = time.monotonic()
+        events = []
+        sent_times = []
+        parser = MidiByteParser()
+        try:
+            if data.startswith(NET_FRAME_MAGIC):
+                decode_net_frames(data, parser, received, events, sent_times)
+            else:
+                parser.feed(data, events)
+                sent_times = [received] * len(events)
+        except ValueError as e:
+            logging.warning(f"Dropping network MIDI datagram from {addr}: {e}")
+        self.server.dispatch(events, sent_times, len(data))
+
+    def error_received(self, exc):
+        logging.warning(f"Network MIDI socket error: {exc}")
+
+    def connection_lost(self, exc):
+        pass
+
+class MidiNetworkServer:
+    def __init__(self, fs, udp_address=None, tcp_address=None, unix_path=None, global_active_notes=None, note_listener=None):
+        self.fs = fs if isinstance(fs, SynthDispatcher) else SynthDispatcher(fs, global_active_notes)
+        self.udp_address = udp_address
+        self.tcp_address = tcp_address
+        self.unix_path = unix_path
+        self.note_listener = note_listener
+        self.soundfont_id = None
+        self.preset_overrides = {}
+        self.active_notes = NoteState(refcounted=False)
+        self.latency = LatenessStats()
+        self.reads = 0
+        self.events = 0
+        self.bytes = 0
+        self.clients = 0
+        self.connections = 0
+        self.error = None
+        self.loop = None
+        self.stopping = None
+        self.thread = None
+        self.ready = threading.Event()
+        self.wake_read, self.wake_write = os.pipe()
+        os.set_blocking(self.wake_read, False)
+        os.set_blocking(self.wake_write, False)
+        self.wake_pending = False
+        self.stats_time = 0.0
+        self.stats_text = ""
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="MidiServer", daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        return self
+
+    def run(self):
+        import asyncio
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.serve())
+        except Exception as e:
+            logging.exception("Error in network MIDI server.")
+            self.error = str(e)
+        finally:
+            self.loop.close()
+            self.ready.set()
+
+    async def serve(self):
+        loop = self.loop
+        self.stopping = loop.create_future()
+        endpoints = []
+        try:
+            if self.udp_address:
+                transport, _ = await loop.create_datagram_endpoint(lambda: MidiDatagramProtocol(self), local_addr=self.udp_address)
+                endpoints.append(transport)
+            if self.tcp_address:
+                endpoints.append(await loop.create_server(lambda: MidiStreamProtocol(self), *self.tcp_address))
+            if self.unix_path:
+                if os.path.exists(self.unix_path):
+                    os.remove(self.unix_path)
+                endpoints.append(await loop.create_unix_server(lambda: MidiStreamProtocol(self), self.unix_path))
+            logging.info(f"Network MIDI server listening on {self.describe()}.")
+            self.ready.set()
+            await self.stopping
+        finally:
+            for endpoint in endpoints:
+                endpoint.close()
+            if self.unix_path and os.path.exists(self.unix_path):
+                os.remove(self.unix_path)
+
+    def dispatch(self, events, sent_times, byte_count):
+        self.reads += 1
+        self.bytes += byte_count
+        if not events:
+            return
+        loudest = self.fs.dispatch(events, self.soundfont_id, self.preset_overrides, 0, self.active_notes)
+        notes_changed = any(event[0] == 0x80 or event[0] == 0x90 for event in events)
+        self.latency.record_due(sent_times, time.monotonic(), 1.0)
+        self.events += len(events)
+        if loudest and self.note_listener is not None:
+            self.note_listener(loudest)
+        if notes_changed and not self.wake_pending:
+            self.wake_pending = True
+            try:
+                os.write(self.wake_write, b'\0')
+            except BlockingIOError:
+                pass
+
+    def acknowledge(self):
+        try:
+            os.read(self.wake_read, 4096)
+        except BlockingIOError:
+            pass
+        self.wake_pending = False
+
+    def describe(self):
+        endpoints = []
+        if self.udp_address:
+            endpoints.append(f"UDP {self.udp_address[0]}:{self.udp_address[1]}")
+        if self.tcp_address:
+            endpoints.append(f"TCP {self.tcp_address[0]}:{self.tcp_address[1]}")
+        if self.unix_path:
+            endpoints.append(f"Unix {self.unix_path}")
+        return ", ".join(endpoints)
+
+    def status(self):
+        now = time.monotonic()
+        if now - self.stats_time >= NET_STATS_INTERVAL:
+            self.stats_time = now
+            summary = self.latency.summary()
+            self.stats_text = (f"{self.describe()}, {self.clients} clients, {self.events} events in {self.reads} reads, "
+                               f"latency p50 {summary['p50_ms']:.2f}ms p99 {summary['p99_ms']:.2f}ms")
+        return self.stats_text
+
+    def stop(self):
+        if self.loop is not None and self.stopping is not None and not self.loop.is_closed():
+            try:
+                self.loop.call_soon_threadsafe(self.stopping.set_result, None)
+            except RuntimeError:
+                pass
+        if self.thread is not None:
+            self.thread.join(timeout=1.0)
+        self.fs.release([(channel, note) for channel, note, velocity in self.active_notes.sounding()])
+        self.active_notes.clear()
+        os.close(self.wake_read)
+        os.close(self.wake_write)
+        logging.info(f"Network MIDI server: {self.events} events in {self.reads} reads ({self.bytes} bytes) "
+                     f"from {self.connections} connections. Latency: {self.latency}")
+
+AudioStatus = collections.namedtuple('AudioStatus', [
+    'generation', 'flags', 'stamp', 'position', 'total_length', 'dispatched', 'events', 'calls', 'server_events',
+    'voices', 'lateness_count', 'lateness_mean_ms', 'lateness_p50_ms', 'lateness_p99_ms', 'lateness_max_ms',
+    'pulses', 'pulse_velocity', 'reply_id', 'reply_value', 'server_status', 'error'])
+
+def memory_barrier(fence):
+    if fence.acquire(timeout=AUDIO_FENCE_TIMEOUT):
+        fence.release()
+
+def preset_override_mask(preset_overrides):
+    return bytes(channel in preset_overrides for channel in range(16))
+
+def start_default_synth():
+    import fluidsynth
+    return start_synth(fluidsynth, default_audio_driver(platform.system()))
+
+class SharedRing:
+    def __init__(self, memory, fence, capacity=AUDIO_RING_BYTES):
+        self.memory = memory
+        self.fence = fence
+        self.capacity = capacity
+
+    def push(self, opcode, payload=b''):
+        memory = self.memory
+        size = (AUDIO_RECORD.size + len(payload) + 3) & ~3
+        if size > self.capacity:
+            raise ValueError(f"A {len(payload)} byte command does not fit in the audio ring.")
+        head = AUDIO_COUNTER.unpack_from(memory, 0)[0]
+        tail = AUDIO_COUNTER.unpack_from(memory, 64)[0]
+        position = head % self.capacity
+        pad = self.capacity - position if position + size > self.capacity else 0
+        if head + pad + size - tail > self.capacity:
+            return False
+        if pad:
+            AUDIO_RECORD.pack_into(memory, AUDIO_RING_DATA + position, pad - AUDIO_RECORD.size, AUDIO_PAD)
+            position = 0
+        start = AUDIO_RING_DATA + position + AUDIO_RECORD.size
+        AUDIO_RECORD.pack_into(memory, start - AUDIO_RECORD.size, len(payload), opcode)
+        memory[start:start + len(payload)] = payload
+        memory_barrier(self.fence)
+        AUDIO_COUNTER.pack_into(memory, 0, head + pad + size)
+        return True
+
+    def pop(self):
+        memory = self.memory
+        while True:
+            tail = AUDIO_COUNTER.unpack_from(memory, 64)[0]
+            if tail == AUDIO_COUNTER.unpack_from(memory, 0)[0]:
+                return None
+            memory_barrier(self.fence)
+            start = AUDIO_RING_DATA + tail % self.capacity
+            length, opcode = AUDIO_RECORD.unpack_from(memory, start)
+            payload = memory[start + AUDIO_RECORD.size:start + AUDIO_RECORD.size + length]
+            memory_barrier(self.fence)
+            AUDIO_COUNTER.pack_into(memory, 64, tail + ((AUDIO_RECORD.size + length + 3) & ~3))
+            if opcode != AUDIO_PAD:
+                return opcode, payload
+
+class AudioProcess:
+    def __init__(self, synth_factory=None, timeline_cache=None, listen=None):
+        self.synth_factory = synth_factory if synth_factory is not None else start_default_synth
+        self.timeline_cache = timeline_cache
+        self.listen = listen if listen is not None else (None, None, None)
+        self.memory = mmap.mmap(-1, AUDIO_SHARED_BYTES)
+        self.fence = self.ring = None
+        self.notes = NoteState(buffer=memoryview(self.memory)[AUDIO_NOTES_OFFSET:AUDIO_NOTES_OFFSET + 16 * 128 + 128])
+        self.doorbell_read = self.doorbell_write = self.wake_read = self.wake_write = None
+        self.send_lock = threading.Lock()
+        self.request_lock = threading.Lock()
+        self.generation = 0
+        self.requests = 0
+        self.process = None
+        self.stopped = False
+
+    def start(self):
+        import multiprocessing
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            logging.warning("This platform cannot fork, so audio stays in the UI process.")
+            return None
+        context = multiprocessing.get_context('fork')
+        self.fence = context.Lock()
+        self.ring = SharedRing(self.memory, self.fence)
+        self.doorbell_read, self.doorbell_write = os.pipe()
+        self.wake_read, self.wake_write = os.pipe()
+        for fd in (self.doorbell_read, self.doorbell_write, self.wake_read, self.wake_write):
+            os.set_blocking(fd, False)
+        self.process = context.Process(target=self.run_engine, name="AudioEngine", daemon=True)
+        self.process.start()
+        logging.info(f"Audio process started with pid {self.process.pid}.")
+        return self
+
+    def run_engine(self):
+        AudioEngine(self).run()
+
+    def send(self, opcode, payload=b''):
+        with self.send_lock:
+            while not self.ring.push(opcode, payload):
+                if not self.process.is_alive():
+                    return False
+                time.sleep(0.001)
+        try:
+            os.write(self.doorbell_write, b'\0')
+        except BlockingIOError:
+            pass
+        return True
+
+    def status(self):
+        memory = self.memory
+        while True:
+            sequence = AUDIO_COUNTER.unpack_from(memory, AUDIO_STATUS_OFFSET)[0]
+            if sequence & 1:
+                time.sleep(0)
+                continue
+            memory_barrier(self.fence)
+            values = AUDIO_STATUS.unpack_from(memory, AUDIO_STATUS_OFFSET + AUDIO_COUNTER.size)
+            memory_barrier(self.fence)
+            if AUDIO_COUNTER.unpack_from(memory, AUDIO_STATUS_OFFSET)[0] == sequence:
+                break
+        status = AudioStatus._make(values)
+        return status._replace(server_status=status.server_status.rstrip(b'\0').decode('utf-8', 'ignore'),
+                               error=status.error.rstrip(b'\0').decode('utf-8', 'ignore'))
+
+    def wait_ready(self):
+        while True:
+            status = self.status()
+            if status.flags & AUDIO_FAILED:
+                return status.error or "Unexpected error initializing FluidSynth."
+            if status.flags & AUDIO_READY:
+                return None
+            if not self.process.is_alive():
+                return "The audio process exited during startup."
+            time.sleep(0.01)
+
+    def load_soundfont(self, path, update_midi_preset):
+        with self.request_lock:
+            self.requests += 1
+            request_id = self.requests
+            if not self.send(AUDIO_SFLOAD, AUDIO_LOAD.pack(request_id, update_midi_preset) + os.fsencode(path)):
+                return -1
+            deadline = time.monotonic() + AUDIO_REPLY_TIMEOUT
+            while time.monotonic() < deadline and self.process.is_alive():
+                status = self.status()
+                if status.reply_id == request_id:
+                    return status.reply_value
+                time.sleep(0.01)
+            logging.error(f"The audio process did not answer the request to load '{path}'.")
+            return -1
+
+    def play(self, midi_file, octave_shift, playback_speed, loop_mode, soundfont_id, preset_overrides):
+        self.generation += 1
+        header = AUDIO_PLAY_HEADER.pack(self.generation, -1 if soundfont_id is None else soundfont_id, octave_shift,
+                                        playback_speed, loop_mode, preset_override_mask(preset_overrides))
+        self.send(AUDIO_PLAY, header + os.fsencode(midi_file))
+        return self.generation
+
+    def set_preset_overrides(self, preset_overrides):
+        self.send(AUDIO_OVERRIDES, preset_override_mask(preset_overrides))
+
+    def voice_count(self):
+        voices = self.status().voices
+        return voices if voices >= 0 else None
+
+    def acknowledge(self):
+        self.memory[AUDIO_WAKE_OFFSET] = 0
+        try:
+            os.read(self.wake_read, 4096)
+        except BlockingIOError:
+            pass
+
+    def stop(self):
+        if self.stopped or self.process is None:
+            return
+        self.stopped = True
+        if self.process.is_alive():
+            self.send(AUDIO_QUIT)
+            self.process.join(timeout=2.0)
+            if self.process.is_alive():
+                logging.warning("The audio process did not exit, terminating it.")
+                self.process.terminate()
+                self.process.join(timeout=1.0)
+        logging.info(f"Audio process exited with code {self.process.exitcode}.")
+
+class AudioEngine:
+    def __init__(self, audio):
+        self.audio = audio
+        self.memory = audio.memory
+        self.parent_pid = os.getppid()
+        self.fs = None
+        self.voice_counter = None
+        self.player = None
+        self.server = None
+        self.generation = 0
+        self.preset_overrides = {}
+        self.flags = 0
+        self.error = ""
+        self.server_status = ""
+        self.pulses = 0
+        self.pulse_velocity = 0
+        self.reply = (0, 0)
+        self.sequence = 0
+        self.lateness = LatenessStats().summary()
+        self.stats_time = 0.0
+        self.published = None
+        self.running = True
+        self.readers = [audio.doorbell_read]
+        self.handlers = {
+            AUDIO_NOTE_ON: self.note_on,
+            AUDIO_RELEASE: self.release,
+            AUDIO_PROGRAM_SELECT: self.program_select,
+            AUDIO_SFLOAD: self.sfload,
+            AUDIO_SFUNLOAD: self.sfunload,
+            AUDIO_PLAY: self.play,
+            AUDIO_STOP: self.stop,
+            AUDIO_SEEK: self.seek,
+            AUDIO_OCTAVE: self.set_octave_shift,
+            AUDIO_SPEED: self.set_playback_speed,
+            AUDIO_LOOP: self.set_loop_mode,
+            AUDIO_PAUSE: self.toggle_pause,
+            AUDIO_SOUNDFONT_PAUSE: self.pause_for_soundfont_change,
+            AUDIO_SOUNDFONT_RESUME: self.resume_after_soundfont_change,
+            AUDIO_SWITCH_SOUNDFONT: self.switch_soundfont,
+            AUDIO_OVERRIDES: self.set_preset_overrides,
+            AUDIO_SERVER_SOUNDFONT: self.set_server_soundfont,
+            AUDIO_QUIT: self.quit,
+        }
+
+    def run(self):
         try:
-            if self.paused_for_soundfont:
-                current_real_time = time.perf_counter()
-                self.pause_offset += (current_real_time - self.pause_start) * self.playback_speed
-                self.paused_for_soundfont = False
+            if self.start():
+                while self.running and os.getppid() == self.parent_pid:
+                    self.drain()
+                    if self.player is not None:
+                        self.player.update()
+                    self.publish()
+                    select.select(self.readers, [], [], self.next_wakeup())
         except:
-            logging.exception("Error resuming after SoundFont change.")
+            logging.exception("Error in the audio process.")
+        finally:
+            self.shutdown()
+
+    def start(self):
+        error = "No audio driver available for FluidSynth."
+        try:
+            synth = self.audio.synth_factory()
+        except:
+            logging.exception("Error starting the synthesizer in the audio process.")
+            error = "Unexpected error initializing FluidSynth."
+            synth = None
+        if synth is None:
+            self.flags |= AUDIO_FAILED
+            self.error = error
+            self.publish()
+            return False
+        self.voice_counter = synth_voice_counter(synth)
+        self.fs = SynthDispatcher(synth, self.audio.notes)
+        udp_address, tcp_address, unix_path = self.audio.listen
+        if udp_address or tcp_address or unix_path:
+            server = MidiNetworkServer(self.fs, udp_address, tcp_address, unix_path, note_listener=self.pulse)
+            server.preset_overrides = self.preset_overrides
+            server.start()
+            if server.error:
+                server.stop()
+                self.flags |= AUDIO_SERVER_FAILED
+                self.server_status = server.error
+            else:
+                self.server = server
+                self.readers.append(server.wake_read)
+        self.flags |= AUDIO_READY
+        self.publish()
+        return True
+
+    def drain(self):
+        try:
+            os.read(self.audio.doorbell_read, 4096)
+        except BlockingIOError:
+            pass
+        if self.server is not None:
+            self.server.acknowledge()
+        while True:
+            command = self.audio.ring.pop()
+            if command is None:
+                return
+            opcode, payload = command
+            try:
+                self.handlers[opcode](payload)
+            except:
+                logging.exception(f"Error handling audio command {opcode}.")
+
+    def next_wakeup(self):
+        player = self.player
+        if player is not None and player.is_playing and not player.paused and not player.paused_for_soundfont:
+            return max(0.0, min(player.time_until_next_event(), AUDIO_STATUS_INTERVAL))
+        return INPUT_IDLE_WAIT
+
+    def publish(self):
+        now = time.perf_counter()
+        flags = self.flags
+        position = total_length = 0.0
+        dispatched = 0
+        player = self.player
+        if player is not None:
+            if player.is_playing:
+                flags |= AUDIO_PLAYING
+            if player.paused:
+                flags |= AUDIO_PAUSED
+            if player.paused_for_soundfont:
+                flags |= AUDIO_PAUSED_FOR_SOUNDFONT
+            if getattr(player, 'timeline', None) is not None:
+                position = player.get_current_logical_time()
+                total_length = player.total_length
+            dispatched = player.dispatched
+            lateness = player.lateness
+            if lateness.count != self.lateness['count'] and (not player.is_playing or now - self.stats_time >= AUDIO_STATS_INTERVAL):
+                self.lateness = lateness.summary()
+                self.stats_time = now
+        fs = self.fs
+        server = self.server
+        voices = self.voice_counter() if self.voice_counter is not None else -1
+        if server is not None:
+            self.server_status = server.status()
+        lateness = self.lateness
+        values = (self.generation, flags, now, position, total_length, dispatched,
+                  fs.events if fs is not None else 0, fs.calls if fs is not None else 0,
+                  server.events if server is not None else 0, voices,
+                  lateness['count'], lateness['mean_ms'], lateness['p50_ms'], lateness['p99_ms'], lateness['max_ms'],
+                  self.pulses, self.pulse_velocity, self.reply[0], self.reply[1],
+                  self.server_status.encode('utf-8'), self.error.encode('utf-8'))
+        memory = self.memory
+        self.sequence += 1
+        AUDIO_COUNTER.pack_into(memory, AUDIO_STATUS_OFFSET, self.sequence)
+        memory_barrier(self.audio.fence)
+        AUDIO_STATUS.pack_into(memory, AUDIO_STATUS_OFFSET + AUDIO_COUNTER.size, *values)
+        memory_barrier(self.audio.fence)
+        self.sequence += 1
+        AUDIO_COUNTER.pack_into(memory, AUDIO_STATUS_OFFSET, self.sequence)
+        published = (flags, self.pulses, bytes(self.audio.notes.pitches))
+        if published != self.published and not memory[AUDIO_WAKE_OFFSET]:
+            memory[AUDIO_WAKE_OFFSET] = 1
+            try:
+                os.write(self.audio.wake_write, b'\0')
+            except BlockingIOError:
+                pass
+        self.published = published
+
+    def pulse(self, velocity):
+        self.pulse_velocity = velocity
+        self.pulses = (self.pulses + 1) & 0xFFFFFFFF
+
+    def note_on(self, payload):
+        channel, note, velocity = payload
+        self.fs.noteon(channel, note, velocity)
+
+    def release(self, payload):
+        self.fs.release(zip(payload[0::2], payload[1::2]))
+
+    def program_select(self, payload):
+        self.fs.program_select(*AUDIO_PROGRAM.unpack(payload))
+
+    def sfload(self, payload):
+        request_id, update_midi_preset = AUDIO_LOAD.unpack_from(payload)
+        path = os.fsdecode(payload[AUDIO_LOAD.size:])
+        threading.Thread(target=self.load_soundfont, args=(request_id, path, update_midi_preset),
+                         name="SoundFontLoader", daemon=True).start()
+
+    def load_soundfont(self, request_id, path, update_midi_preset):
+        try:
+            with SuppressStderr():
+                soundfont_id = self.fs.sfload(path, update_midi_preset)
+        except:
+            logging.exception(f"Error loading SoundFont '{path}' in the audio process.")
+            soundfont_id = -1
+        self.reply = (request_id, soundfont_id)
+        try:
+            os.write(self.audio.doorbell_write, b'\0')
+        except BlockingIOError:
+            pass
+
+    def sfunload(self, payload):
+        soundfont_id, update_midi_preset = AUDIO_LOAD.unpack(payload)
+        self.fs.sfunload(soundfont_id, update_midi_preset)
+
+    def play(self, payload):
+        generation, soundfont_id, octave_shift, playback_speed, loop_mode, mask = AUDIO_PLAY_HEADER.unpack_from(payload)
+        if self.player is not None:
+            self.player.stop()
+        self.set_preset_overrides(mask)
+        self.generation = generation
+        self.lateness = LatenessStats().summary()
+        self.player = MIDIPlayer(os.fsdecode(payload[AUDIO_PLAY_HEADER.size:]), octave_shift, playback_speed, self.fs, None, None,
+                                 bool(loop_mode), timeline_cache=self.audio.timeline_cache, note_listener=self.pulse,
+                                 soundfont_id=None if soundfont_id < 0 else soundfont_id,
+                                 preset_overrides=self.preset_overrides)
+
+    def stop(self, payload):
+        if self.player is not None:
+            self.player.stop()
+
+    def seek(self, payload):
+        if self.player is not None:
+            self.player.seek(AUDIO_DOUBLE.unpack(payload)[0])
+
+    def set_octave_shift(self, payload):
+        if self.player is not None:
+            self.player.set_octave_shift(AUDIO_INT.unpack(payload)[0])
+
+    def set_playback_speed(self, payload):
+        if self.player is not None:
+            self.player.set_playback_speed(AUDIO_DOUBLE.unpack(payload)[0])
+
+    def set_loop_mode(self, payload):
+        if self.player is not None:
+            self.player.loop_mode = bool(payload[0])
+
+    def toggle_pause(self, payload):
+        if self.player is not None:
+            self.player.toggle_pause()
+
+    def pause_for_soundfont_change(self, payload):
+        if self.player is not None:
+            self.player.pause_for_soundfont_change()
+
+    def resume_after_soundfont_change(self, payload):
+        if self.player is not None:
+            self.player.resume_after_soundfont_change()
+
+    def switch_soundfont(self, payload):
+        if self.player is not None:
+            self.player.switch_soundfont(AUDIO_INT.unpack(payload)[0])
+
+    def set_preset_overrides(self, payload):
+        self.preset_overrides.clear()
+        self.preset_overrides.update((channel, True) for channel in range(16) if payload[channel])
+
+    def set_server_soundfont(self, payload):
+        if self.server is not None:
+            self.server.soundfont_id = AUDIO_INT.unpack(payload)[0]
+
+    def quit(self, payload):
+        self.running = False
+
+    def shutdown(self):
+        if self.player is not None and self.player.is_playing:
+            self.player.stop()
+        if self.server is not None:
+            self.server.stop()
+        if self.fs is not None:
+            logging.info(f"Audio process synth dispatch: {self.fs}")
+            delete = getattr(self.fs.target, 'delete', None)
+            if delete is not None:
+                delete()
+
+class RemoteSynth:
+    def __init__(self, audio):
+        self.audio = audio
+        self.notes = audio.notes
+
+    @property
+    def calls(self):
+        return self.audio.status().calls
+
+    @property
+    def saved(self):
+        status = self.audio.status()
+        return status.events - status.calls
+
+    def noteon(self, channel, note, velocity):
+        if 0 <= note < 128:
+            self.audio.send(AUDIO_NOTE_ON, bytes((channel, note, velocity)))
+
+    def release(self, notes):
+        payload = bytes(value for channel, note in notes if 0 <= note < 128 for value in (channel, note))
+        if payload:
+            self.audio.send(AUDIO_RELEASE, payload)
+
+    def program_select(self, channel, soundfont_id, bank, program):
+        self.audio.send(AUDIO_PROGRAM_SELECT, AUDIO_PROGRAM.pack(channel, soundfont_id, bank, program))
+
+    def sfload(self, path, update_midi_preset=False):
+        return self.audio.load_soundfont(path, update_midi_preset)
+
+    def sfunload(self, soundfont_id, update_midi_preset=False):
+        self.audio.send(AUDIO_SFUNLOAD, AUDIO_LOAD.pack(soundfont_id, update_midi_preset))
+
+    def delete(self):
+        self.audio.stop()
+
+    def __str__(self):
+        status = self.audio.status()
+        return f"{status.events} events, {status.calls} synth calls, {status.events - status.calls} saved (in the audio process)"
+
+class RemoteLateness:
+    def __init__(self, audio):
+        self.audio = audio
+
+    def summary(self):
+        status = self.audio.status()
+        return {
+            'count': status.lateness_count,
+            'mean_ms': status.lateness_mean_ms,
+            'p50_ms': status.lateness_p50_ms,
+            'p99_ms': status.lateness_p99_ms,
+            'max_ms': status.lateness_max_ms,
+        }
+
+    def __str__(self):
+        summary = self.summary()
+        return (f"{summary['count']} events, mean {summary['mean_ms']:.2f}ms, "
+                f"p50 {summary['p50_ms']:.2f}ms, p99 {summary['p99_ms']:.2f}ms, max {summary['max_ms']:.2f}ms")
+
+class RemotePlayer:
+    def __init__(self, audio, midi_file, octave_shift, playback_speed, loop_mode, soundfont_id, preset_overrides,
+                 timeline_cache=None, timeline=None):
+        self.audio = audio
+        self.midi_file = midi_file
+        self.octave_shift = octave_shift
+        self.playback_speed = playback_speed
+        self.looping = loop_mode
+        self.timeline = timeline
+        self.lock = threading.RLock()
+        self.lateness = RemoteLateness(audio)
+        self.scheduler_thread = audio.process
+        self.generation = None
+        self.stopped = False
+        self.total_length = 0.0
+        try:
+            if self.timeline is None:
+                self.timeline = timeline_cache.get(midi_file) if timeline_cache is not None else EventTimeline.from_midi_file(midi_file)
+            self.total_length = self.timeline.total_length
+            self.generation = audio.play(midi_file, octave_shift, playback_speed, loop_mode, soundfont_id, preset_overrides)
+            logging.info(f"MIDI playback of {midi_file} handed to the audio process.")
+        except:
+            logging.exception("Error initializing MIDIPlayer.")
+            self.stopped = True
+
+    def state(self):
+        status = self.audio.status()
+        return status if status.generation == self.generation else None
+
+    @property
+    def is_playing(self):
+        if self.stopped:
+            return False
+        status = self.state()
+        return status is None or bool(status.flags & AUDIO_PLAYING)
+
+    @property
+    def paused(self):
+        status = self.state()
+        return status is not None and bool(status.flags & AUDIO_PAUSED)
+
+    @property
+    def paused_for_soundfont(self):
+        status = self.state()
+        return status is not None and bool(status.flags & AUDIO_PAUSED_FOR_SOUNDFONT)
+
+    @property
+    def dispatched(self):
+        status = self.state()
+        return status.dispatched if status is not None else 0
+
+    @property
+    def loop_mode(self):
+        return self.looping
+
+    @loop_mode.setter
+    def loop_mode(self, loop_mode):
+        self.looping = loop_mode
+        self.audio.send(AUDIO_LOOP, bytes((loop_mode,)))
+
+    def get_total_length(self):
+        return self.total_length
+
+    def get_current_logical_time(self):
+        status = self.state()
+        if status is None:
+            return 0.0
+        if status.flags & (AUDIO_PAUSED | AUDIO_PAUSED_FOR_SOUNDFONT) or not status.flags & AUDIO_PLAYING:
+            return status.position
+        return min(status.position + (time.perf_counter() - status.stamp) * self.playback_speed, self.total_length)
+
+    def stop(self):
+        self.stopped = True
+        self.audio.send(AUDIO_STOP)
+
+    def seek(self, seconds):
+        self.audio.send(AUDIO_SEEK, AUDIO_DOUBLE.pack(seconds))
+
+    def set_octave_shift(self, new_shift):
+        self.octave_shift = new_shift
+        self.audio.send(AUDIO_OCTAVE, AUDIO_INT.pack(new_shift))
+
+    def set_playback_speed(self, new_speed):
+        self.playback_speed = new_speed
+        self.audio.send(AUDIO_SPEED, AUDIO_DOUBLE.pack(new_speed))
+
+    def toggle_pause(self):
+        self.audio.send(AUDIO_PAUSE)
+
+    def pause_for_soundfont_change(self):
+        self.audio.send(AUDIO_SOUNDFONT_PAUSE)
+
+    def resume_after_soundfont_change(self):
+        self.audio.send(AUDIO_SOUNDFONT_RESUME)
+
+    def switch_soundfont(self, soundfont_id):
+        self.audio.send(AUDIO_SWITCH_SOUNDFONT, AUDIO_INT.pack(soundfont_id))
+
+    def current_programs(self):
+        timeline = self.timeline
+        return timeline.state_at(timeline.index_at(self.get_current_logical_time())).programs
+
+class RemoteServer:
+    def __init__(self, audio):
+        self.audio = audio
+        self.selected_soundfont_id = None
+
+    @property
+    def error(self):
+        status = self.audio.status()
+        return status.server_status if status.flags & AUDIO_SERVER_FAILED else None
+
+    @property
+    def events(self):
+        return self.audio.status().server_events
+
+    @property
+    def soundfont_id(self):
+        return self.selected_soundfont_id
+
+    @soundfont_id.setter
+    def soundfont_id(self, soundfont_id):
+        self.selected_soundfont_id = soundfont_id
+        self.audio.send(AUDIO_SERVER_SOUNDFONT, AUDIO_INT.pack(soundfont_id))
+
+    def status(self):
+        return self.audio.status().server_status
+
+    def stop(self):
+        pass
 
 class PianoApp:
-    def __init__(self, stdscr):
+    def __init__(self, stdscr, options=None, startup_profile=None, audio=None):
         self.stdscr = stdscr
+        self.audio = audio
+        self.options = options if options is not None else parse_arguments([])
+        self.startup_profile = startup_profile if startup_profile is not None else StartupProfile()
+        self.frame_governor = FrameGovernor(self.options.fps)
         self.octave_shift = 0
         self.playback_speed = 1.0
-        self.recording = []
+        self.recording = None
+        self.last_take = None
         self.is_recording = False
         self.pressed_keys = {}
         self.key_to_midi_note = {}
         self.midi_mode = False
         self.midi_player = None
+        self.midi_server = None
         self.loop_mode = False
         self.paused_for_soundfont = False
         self.operating_system = platform.system()
         self.fs = None
         self.selected_soundfont = None
         self.soundfont_id = None
-        self.active_notes = set()
+        self.soundfont_manager = None
+        self.soundfont_download = None
+        self.fallback_soundfont = None
+        self.soundfont_index = SoundFontIndex()
+        self.preset_overrides = {}
+        self.active_notes = audio.notes if audio is not None else NoteState()
+        self.audio_pulses = 0
+        self.synth_error = None
+        self.input_latency = LatenessStats()
+        self.key_events = 0
+        self.retired_events = 0
+        self.voice_counter = None
+        self.metrics = PerformanceMetrics(self.options.metrics_file, self.options.metrics_interval)
+        self.timeline_cache = create_timeline_cache(self.options)
+        self.library_roots = library_roots(self.options.library_root or ['.', self.options.recordings_dir],
+                                           bool(self.options.library_root))
+        self.midi_library = None
+        self.library_lock = threading.Lock()
+        self.library_thread = None
+        self.library_rescan = False
+        self.library_stop = threading.Event()
         self.initialize_ui_elements()
+        self.startup_profile.lap('curses init')
         self.ensure_soundfont()
-        sf = self.initialize_fluidsynth()
-        if sf is None:
-            self.running = False
-        else:
-            self.running = True
+        self.synth_thread = threading.Thread(target=self.initialize_fluidsynth, name="SynthStartup", daemon=True)
+        self.synth_thread.start()
+        self.running = True
         self.instructions = [
             "Pianomancer - Transform your keyboard into a piano!",
             "",
@@ -498,6 +3315,9 @@ class PianoApp:
             "'2' to change the SoundFont.",
             "'3' to toggle loop mode ON/OFF.",
             "'4' to play/pause current MIDI playback.",
+            "'5' to toggle the falling-notes view.",
+            "'6' to pick the preset of a MIDI channel.",
+            "'7' to show/hide the performance overlay.",
             "'<' to seek backward 5s, '>' to seek forward 5s.",
             "'[' or ']' to decrease/increase the octave.",
             "'-' or '+' to decrease/increase playback speed.",
@@ -522,79 +3342,184 @@ class PianoApp:
             color_pairs=[curses.color_pair(1), curses.color_pair(2),
                          curses.color_pair(3), curses.color_pair(5),
                          curses.color_pair(6)],
-            stdscr=self.stdscr
+            stdscr=self.stdscr,
+            procedural=self.options.procedural_tree,
+            light_density=self.options.light_density,
+            light_pulse=self.options.light_pulse,
+            reserved_rows=len(self.instructions) + 16
         )
         self.virtual_keyboard = ' '.join(NOTE_MIDI_NUMBERS.keys())
+        self.piano_roll = PianoRollView(self.stdscr, self.options.lookahead)
+        self.waterfall = self.options.waterfall
+        self.tree_display.set_tree_visible(not self.waterfall)
+        self.startup_profile.lap('ui setup')
 
     def ensure_soundfont(self):
-        if not os.path.exists("Arachno.sf2"):
-            self.download_soundfont("https://theater.torbware.space/Arachno.sf2", "Arachno.sf2")
-
-    def download_soundfont(self, url, filename):
-        max_y, max_x = self.stdscr.getmaxyx()
-        self.stdscr.erase()
-        try:
-            self.stdscr.addstr(max_y//2, max_x//2 - 15, "Downloading SoundFont...", curses.color_pair(7))
-            self.stdscr.refresh()
-        except:
-            pass
-        def report(block_num, block_size, total_size):
-            downloaded = block_num * block_size
-            perc = 0
-            if total_size > 0:
-                perc = downloaded / total_size * 100
-            max_y, max_x = self.stdscr.getmaxyx()
+        if os.path.exists(DEFAULT_SOUNDFONT):
             try:
-                self.stdscr.move(max_y//2 + 1, max_x//2 - 20)
-                self.stdscr.clrtoeol()
-                bar_length = 30
-                filled_length = int(bar_length * perc // 100)
-                bar_str = "[" + ("█" * filled_length) + (" " * (bar_length - filled_length)) + "]"
-                self.stdscr.addstr(max_y//2 + 1, max_x//2 - 20, f"{bar_str} {perc:5.1f}%")
-                self.stdscr.refresh()
-            except:
-                pass
-        urllib.request.urlretrieve(url, filename, reporthook=report)
+                SoundFontInfo.scan(DEFAULT_SOUNDFONT)
+                return
+            except Exception as e:
+                logging.warning(f"{DEFAULT_SOUNDFONT} is not a valid SoundFont ({e}), moving it to {DEFAULT_SOUNDFONT}.bad and downloading it again.")
+                os.replace(DEFAULT_SOUNDFONT, DEFAULT_SOUNDFONT + '.bad')
+        self.soundfont_download = SoundFontDownload(self.options.soundfont_url, DEFAULT_SOUNDFONT,
+                                                    self.options.soundfont_sha256).start()
+
+    def poll_download(self):
+        download = self.soundfont_download
+        if download is None or not download.done:
+            return
+        self.soundfont_download = None
+        if download.error:
+            self.display_error(f"SoundFont download failed: {download.error}"[:self.stdscr.getmaxyx()[1] - 1])
+        elif self.soundfont_manager.active_path in (None, self.fallback_soundfont):
+            self.soundfont_manager.request(download.path)
+
+    def soundfont_status(self):
+        if self.soundfont_manager is None:
+            return "starting synthesizer..."
+        status = self.soundfont_manager.status()
+        download = self.soundfont_download
+        if download is not None:
+            progress = download.progress()
+            detail = f"{progress * 100:.0f}%" if progress is not None else f"{download.downloaded // (1024 * 1024)} MB"
+            status += f" (downloading {os.path.basename(download.path)}, {detail})"
+        return status
 
     def initialize_fluidsynth(self):
         try:
-            if self.operating_system == "Linux":
-                driver = "alsa"
-            elif self.operating_system == "Darwin":
-                driver = "coreaudio"
-            elif self.operating_system == "Windows":
-                driver = "dsound"
-            else:
-                driver = "alsa"
-            self.fs = fluidsynth.Synth()
-            with SuppressStderr():
-                try:
-                    self.fs.start(driver=driver)
-                except:
-                    if driver != "alsa":
-                        alternative_driver = "alsa"
-                        self.fs.start(driver=alternative_driver)
-                        driver = alternative_driver
-                    else:
-                        self.display_error("No audio driver available for FluidSynth.")
+            if self.audio is not None:
+                with self.startup_profile.phase('audio process start'):
+                    error = self.audio.wait_ready()
+                if error:
+                    self.synth_error = error
+                    return None
+                self.fs = RemoteSynth(self.audio)
+                self.voice_counter = self.audio.voice_count
+            else:
+                driver = default_audio_driver(self.operating_system)
+                with self.startup_profile.phase('import fluidsynth'):
+                    import fluidsynth
+                with self.startup_profile.phase('driver start'):
+                    synth = start_synth(fluidsynth, driver)
+                    if synth is None:
+                        self.synth_error = "No audio driver available for FluidSynth."
                         return None
-            if not os.path.exists("Arachno.sf2"):
-                self.display_error("Arachno.sf2 was not found.")
-                return None
-            new_sf = "Arachno.sf2"
-            with SuppressStderr():
+                    self.voice_counter = synth_voice_counter(synth)
+                    self.fs = SynthDispatcher(synth, self.active_notes)
+            self.soundfont_manager = SoundFontManager(self.fs, int(self.options.soundfont_budget * 1024 * 1024))
+            if os.path.exists(DEFAULT_SOUNDFONT):
+                new_sf = DEFAULT_SOUNDFONT
+            else:
+                soundfonts = sorted(f for f in os.listdir('.') if f.lower().endswith('.sf2'))
+                if not soundfonts:
+                    if self.soundfont_download is not None:
+                        return DEFAULT_SOUNDFONT
+                    self.synth_error = f"{DEFAULT_SOUNDFONT} was not found."
+                    return None
+                new_sf = soundfonts[0]
+                self.fallback_soundfont = new_sf
+            with self.startup_profile.phase('sfload'), SuppressStderr():
                 try:
                     self.soundfont_id = self.fs.sfload(new_sf, True)
-                    for channel in range(16):
-                        self.fs.program_select(channel, self.soundfont_id, 0, 0)
+                    select_soundfont_programs(self.fs, self.soundfont_id)
                 except:
-                    self.display_error(f"Error loading SoundFont '{new_sf}'.")
+                    self.synth_error = f"Error loading SoundFont '{new_sf}'."
                     return None
+            self.soundfont_manager.adopt(new_sf, self.soundfont_id)
             return new_sf
         except:
             logging.exception("Error initializing FluidSynth.")
-            self.display_error("Unexpected error initializing FluidSynth.")
+            self.synth_error = "Unexpected error initializing FluidSynth."
+            return None
+
+    def finish_startup(self):
+        with self.startup_profile.phase('wait for synth'):
+            self.synth_thread.join()
+        self.synth_thread = None
+        logging.info(f"Startup profile:\n{self.startup_profile.report()}")
+        if self.synth_error:
+            self.display_error(self.synth_error)
+            return False
+        if self.options.listen_udp or self.options.listen_tcp or self.options.listen_unix:
+            self.start_midi_server()
+        try:
+            self.midi_library = MidiLibrary(self.options.library_db)
+        except:
+            logging.exception(f"Error opening the MIDI library {self.options.library_db}.")
+        self.request_library_scan()
+        return True
+
+    def request_library_scan(self):
+        if self.midi_library is None:
+            return
+        with self.library_lock:
+            self.library_rescan = True
+            if self.library_thread is not None:
+                return
+            self.library_thread = threading.Thread(target=self.scan_library, name="LibraryScan", daemon=True)
+            self.library_thread.start()
+
+    def scan_library(self):
+        while True:
+            with self.library_lock:
+                if not self.library_rescan or self.library_stop.is_set():
+                    self.library_thread = None
+                    return
+                self.library_rescan = False
+            try:
+                library = MidiLibrary(self.options.library_db)
+                try:
+                    stats = library.scan(self.library_roots, stop=self.library_stop)
+                finally:
+                    library.close()
+                logging.info(f"MIDI library scan: {describe_library_scan(stats)}")
+            except:
+                logging.exception("Error scanning the MIDI library.")
+
+    def midi_library_entries(self):
+        if self.midi_library is not None:
+            try:
+                return self.midi_library.entries(self.library_roots)
+            except:
+                logging.exception("Error reading the MIDI library.")
+        midi_files = [f for f in os.listdir('.') if f.lower().endswith(('.mid', '.midi'))]
+        midi_files += find_midi_files([self.options.recordings_dir])
+        return [LibraryEntry(os.path.abspath(midi_file)) for midi_file in midi_files]
+
+    def select_midi_entry(self):
+        entries = self.midi_library_entries()
+        scanning = self.library_thread is not None
+        if not entries:
+            self.display_error("Indexing MIDI files, try again in a moment." if scanning else "No MIDI files found.")
             return None
+        prefix = os.path.join(os.getcwd(), '')
+        labels = [f"{entry.path[len(prefix):] if entry.path.startswith(prefix) else entry.path} - {describe_midi_entry(entry)}"
+                  for entry in entries]
+        selected = self.select_item(labels, "Select a MIDI file to play (indexing...):" if scanning else "Select a MIDI file to play:")
+        return entries[selected].path if selected is not None else None
+
+    def start_midi_server(self):
+        if self.audio is not None:
+            server = RemoteServer(self.audio)
+            if server.error:
+                self.display_error(f"Network MIDI server failed: {server.error}"[:self.stdscr.getmaxyx()[1] - 1])
+                self.invalidate_screen()
+                return
+            server.soundfont_id = self.soundfont_id
+            self.midi_server = server
+            return
+        server = MidiNetworkServer(self.fs, self.options.listen_udp, self.options.listen_tcp, self.options.listen_unix,
+                                   note_listener=self.tree_display.pulse)
+        server.soundfont_id = self.soundfont_id
+        server.preset_overrides = self.preset_overrides
+        server.start()
+        if server.error:
+            server.stop()
+            self.display_error(f"Network MIDI server failed: {server.error}"[:self.stdscr.getmaxyx()[1] - 1])
+            self.invalidate_screen()
+            return
+        self.midi_server = server
 
     def initialize_ui_elements(self):
         try:
@@ -623,8 +3548,9 @@ class PianoApp:
             self.stdscr.nodelay(True)
         except:
             pass
+        self.invalidate_screen()
 
-    def select_soundfont(self, soundfonts):
+    def select_item(self, labels, title):
         selected = 0
         start_index = 0
         while True:
@@ -634,7 +3560,7 @@ class PianoApp:
                 key = self.stdscr.getch()
                 time.sleep(0.5)
                 continue
-            if len(soundfonts) == 0:
+            if len(labels) == 0:
                 return None
             if selected < start_index:
                 start_index = selected
@@ -644,310 +3570,1493 @@ class PianoApp:
                 continue
             if selected >= start_index + visible_height:
                 start_index = selected - visible_height + 1
-            display_scrollable_list(self.stdscr, soundfonts, selected, start_index, "Select a SoundFont (.sf2) to use:")
+            display_scrollable_list(self.stdscr, labels, selected, start_index, title)
             key = self.stdscr.getch()
             if key == curses.KEY_UP:
-                selected = (selected - 1) % len(soundfonts)
+                selected = (selected - 1) % len(labels)
             elif key == curses.KEY_DOWN:
-                selected = (selected + 1) % len(soundfonts)
+                selected = (selected + 1) % len(labels)
             elif key == curses.KEY_PPAGE:
                 selected = max(0, selected - visible_height)
             elif key == curses.KEY_NPAGE:
-                selected = min(len(soundfonts) - 1, selected + visible_height)
+                selected = min(len(labels) - 1, selected + visible_height)
             elif key in [10, 13]:
-                return soundfonts[selected]
+                return selected
             elif key in [ord('q'), ord('Q')]:
                 return None
 
-    def select_midi_file(self, midi_files):
-        selected = 0
-        start_index = 0
-        while True:
-            max_y, max_x = self.stdscr.getmaxyx()
-            if max_y < MIN_HEIGHT or max_x < MIN_WIDTH:
-                draw_resize_prompt(self.stdscr, max_y, max_x)
-                key = self.stdscr.getch()
-                time.sleep(0.5)
-                continue
-            if len(midi_files) == 0:
-                return None
-            if selected < start_index:
-                start_index = selected
-            visible_height = max_y - 6
-            if visible_height < 1:
-                time.sleep(0.5)
-                continue
-            if selected >= start_index + visible_height:
-                start_index = selected - visible_height + 1
-            display_scrollable_list(self.stdscr, midi_files, selected, start_index, "Select a MIDI file to play:")
-            key = self.stdscr.getch()
-            if key == curses.KEY_UP:
-                selected = (selected - 1) % len(midi_files)
-            elif key == curses.KEY_DOWN:
-                selected = (selected + 1) % len(midi_files)
-            elif key == curses.KEY_PPAGE:
-                selected = max(0, selected - visible_height)
-            elif key == curses.KEY_NPAGE:
-                selected = min(len(midi_files) - 1, selected + visible_height)
-            elif key in [10, 13]:
-                return midi_files[selected]
-            elif key in [ord('q'), ord('Q')]:
-                return None
+    def soundfont_info(self, path):
+        try:
+            return self.soundfont_index.get(path)
+        except:
+            logging.exception(f"Error scanning SoundFont '{path}'.")
+            return None
+
+    def select_soundfont(self, soundfonts):
+        labels = []
+        for soundfont in soundfonts:
+            info = self.soundfont_info(soundfont)
+            labels.append(f"{soundfont} - {info.describe()}" if info else f"{soundfont} - unreadable")
+        selected = self.select_item(labels, "Select a SoundFont (.sf2) to use:")
+        return soundfonts[selected] if selected is not None else None
+
+    def channel_program(self, channel):
+        if channel in self.preset_overrides:
+            return self.preset_overrides[channel]
+        if self.midi_mode and self.midi_player and channel != 9:
+            return 0, self.midi_player.current_programs()[channel]
+        return 0, 0
+
+    def select_channel_preset(self):
+        active_path = self.soundfont_manager.active_path
+        info = self.soundfont_info(active_path) if active_path else None
+        if info is None or not info.presets:
+            self.display_error("No presets found in the current SoundFont.")
+            return
+        labels = []
+        for channel in range(16):
+            bank, program = self.channel_program(channel)
+            preset = info.preset(bank, program)
+            source = "picked" if channel in self.preset_overrides else "MIDI"
+            labels.append(f"Channel {channel + 1:>2}: {bank:03}:{program:03} {preset.name if preset else '(none)'} [{source}]")
+        channel = self.select_item(labels, f"Select a channel ({info.name}):")
+        if channel is None:
+            return
+        labels = ["Follow MIDI program changes"] + [
+            f"{preset.bank:03}:{preset.program:03} {preset.name} ({preset.sample_bytes / (1024 * 1024):.1f} MB)"
+            for preset in info.presets]
+        selected = self.select_item(labels, f"Select a preset for channel {channel + 1}:")
+        if selected is None:
+            return
+        if selected == 0:
+            self.preset_overrides.pop(channel, None)
+        else:
+            preset = info.presets[selected - 1]
+            self.preset_overrides[channel] = (preset.bank, preset.program)
+        self.share_preset_overrides()
+        bank, program = self.channel_program(channel)
+        try:
+            if self.midi_mode and self.midi_player:
+                with self.midi_player.lock:
+                    self.fs.program_select(channel, self.soundfont_id, bank, program)
+            else:
+                self.fs.program_select(channel, self.soundfont_id, bank, program)
+        except:
+            logging.exception(f"Error selecting preset {bank}:{program} on channel {channel + 1}.")
+            self.display_error(f"Error selecting preset {bank}:{program}.")
+
+    def start_recording(self):
+        take = os.path.join(self.options.recordings_dir, time.strftime("take-%Y%m%d-%H%M%S.mid"))
+        try:
+            self.recording = RecordingBuffer(take)
+        except:
+            logging.exception(f"Error creating recording {take}.")
+            self.display_error(f"Error creating recording {take}.")
+            return
+        self.is_recording = True
+
+    def stop_recording(self, current_time):
+        self.is_recording = False
+        for midi_note in self.key_to_midi_note.values():
+            self.recording.append(('note_off', midi_note, current_time))
+        self.fs.release([(0, midi_note) for midi_note in self.key_to_midi_note.values()])
+        self.key_to_midi_note.clear()
+        try:
+            take = self.recording.close()
+        except:
+            logging.exception(f"Error saving recording {self.recording.path}.")
+            self.display_error(f"Error saving recording {self.recording.path}.")
+            take = None
+        self.recording = None
+        if take:
+            self.last_take = take
+            self.request_library_scan()
 
     def play_recording(self):
-        if not self.recording:
+        if not self.last_take:
             self.display_error("No recording to play.")
             return
-        playback_thread = threading.Thread(target=self.playback_thread, args=(self.recording,))
-        playback_thread.start()
+        self.start_midi_player(self.last_take)
 
-    def playback_thread(self, recording):
-        if not recording:
-            return
-        start_time = recording[0][2]
-        active_notes = set()
-        last_event_time = start_time
-        for event in recording:
-            event_type, midi_note, event_time = event
-            wait_time = (event_time - last_event_time) / self.playback_speed
-            if wait_time > 0:
-                time.sleep(wait_time)
-            last_event_time = event_time
-            adjusted_note = midi_note + (self.octave_shift * 12)
-            if event_type == 'note_on':
-                self.fs.noteon(0, adjusted_note, 127)
-                active_notes.add(adjusted_note)
-                self.active_notes.add(adjusted_note)
-            elif event_type == 'note_off':
-                self.fs.noteoff(0, adjusted_note)
-                if adjusted_note in active_notes:
-                    active_notes.remove(adjusted_note)
-                if adjusted_note in self.active_notes:
-                    self.active_notes.remove(adjusted_note)
-        for note in active_notes:
-            self.fs.noteoff(0, note)
+    def start_midi_player(self, midi_file, timeline=None):
+        if self.midi_player:
+            self.midi_player.stop()
+            self.retired_events += self.midi_player.dispatched
+        if self.audio is not None:
+            self.midi_player = RemotePlayer(self.audio, midi_file, self.octave_shift, self.playback_speed, self.loop_mode,
+                                            self.soundfont_id, self.preset_overrides,
+                                            timeline_cache=self.timeline_cache, timeline=timeline)
+        else:
+            self.midi_player = MIDIPlayer(midi_file, self.octave_shift, self.playback_speed, self.fs, self.active_notes, self.stdscr, self.loop_mode,
+                                          use_scheduler_thread=self.options.scheduler_thread,
+                                          timeline_cache=self.timeline_cache,
+                                          note_listener=self.tree_display.pulse,
+                                          timeline=timeline, soundfont_id=self.soundfont_id,
+                                          preset_overrides=self.preset_overrides)
+        self.midi_mode = True
+
+    def share_preset_overrides(self):
+        if self.audio is not None:
+            self.audio.set_preset_overrides(self.preset_overrides)
+
+    def poll_audio(self, woken):
+        if woken:
+            self.audio.acknowledge()
+        status = self.audio.status()
+        if status.pulses != self.audio_pulses:
+            self.audio_pulses = status.pulses
+            self.tree_display.pulse(status.pulse_velocity)
+
+    def poll_soundfont(self):
+        soundfont_id, evicted, errors = self.soundfont_manager.poll()
+        if soundfont_id is not None and soundfont_id != self.soundfont_id:
+            self.soundfont_id = soundfont_id
+            self.preset_overrides.clear()
+            self.share_preset_overrides()
+            if self.midi_server:
+                self.midi_server.soundfont_id = soundfont_id
+            if self.midi_mode and self.midi_player:
+                self.midi_player.switch_soundfont(soundfont_id)
+            else:
+                select_soundfont_programs(self.fs, soundfont_id)
+        self.soundfont_manager.unload(evicted)
+        for error in errors:
+            self.display_error(error)
+            self.invalidate_screen()
+
+    def midi_status(self):
+        if self.midi_player.paused:
+            return "Paused"
+        elif not self.midi_player.is_playing and not self.midi_player.paused and not self.midi_player.paused_for_soundfont:
+            return "Stopped"
+        return "Playing"
+
+    def frame_signature(self, max_x):
+        signature = (self.octave_shift, self.playback_speed, self.loop_mode, self.is_recording,
+                     self.midi_mode, self.active_notes.snapshot(), self.soundfont_status())
+        if self.midi_server:
+            signature += (self.midi_server.status(),)
+        if self.metrics.overlay:
+            signature += (self.metrics.generation,)
+        if self.midi_mode and self.midi_player:
+            total_time = self.midi_player.get_total_length()
+            current_time = self.midi_player.get_current_logical_time()
+            progress = int(max_x * current_time / total_time) if total_time > 0 else 0
+            signature += (self.midi_status(), int(current_time), progress)
+        return signature
+
+    def invalidate_screen(self):
+        self.frame_governor.invalidate()
+        if hasattr(self, 'tree_display'):
+            self.tree_display.invalidate()
+        if hasattr(self, 'piano_roll'):
+            self.piano_roll.invalidate()
+
+    def draw_piano_roll(self, max_x):
+        player = self.midi_player if self.midi_mode else None
+        cells = self.piano_roll.draw(player, self.tree_display.note_display_start_line - 1, max_x)
+        if self.piano_roll.window is not None:
+            self.piano_roll.window.noutrefresh()
+        return cells
+
+    def collect_metrics(self):
+        player = self.midi_player
+        events = self.key_events + self.retired_events
+        if player is not None:
+            events += player.dispatched
+        if self.midi_server is not None:
+            events += self.midi_server.events
+        frame_stats = self.frame_governor.stats
+        return {
+            'timestamp': time.time(),
+            'frames': {
+                'rendered_total': frame_stats.rendered,
+                'skipped_total': frame_stats.skipped,
+                'render_seconds_total': frame_stats.total,
+                'render_ms_max': frame_stats.max * 1000.0,
+            },
+            'input_latency': self.input_latency.summary(),
+            'scheduler_lateness': (player.lateness if player is not None else LatenessStats()).summary(),
+            'events_dispatched': {'total': events},
+            'synth_calls': {'total': self.fs.calls, 'saved_total': self.fs.saved},
+            'active_voices': self.voice_counter() if self.voice_counter is not None else None,
+            'active_notes': len(self.active_notes),
+            'resident_memory_bytes': resident_memory_bytes(),
+        }
+
+    def toggle_metrics_overlay(self):
+        self.metrics.overlay = not self.metrics.overlay
+        if self.metrics.overlay:
+            self.metrics.sample(time.perf_counter(), self.collect_metrics())
+        self.stdscr.erase()
+        self.invalidate_screen()
+
+    def toggle_waterfall(self):
+        self.waterfall = not self.waterfall
+        self.tree_display.set_tree_visible(not self.waterfall)
+        self.stdscr.erase()
+        self.invalidate_screen()
+
+    def render_frame(self, max_y, max_x):
+        overlays = []
+        if self.waterfall:
+            overlays.append(lambda: self.draw_piano_roll(max_x))
+        if self.metrics.overlay:
+            overlays.append(lambda: self.metrics.draw(self.stdscr, max_x))
+        self.tree_display.update_display(overlays=overlays)
+        start_line = self.tree_display.note_display_start_line + 2
+        for idx, line in enumerate(self.instructions):
+            if start_line + idx >= max_y - 5:
+                break
+            self.stdscr.move(start_line + idx, 2)
+            self.stdscr.clrtoeol()
+            self.stdscr.addstr(start_line + idx, 2, line, curses.color_pair(7))
+        kb_line = start_line + len(self.instructions)
+        if kb_line < max_y:
+            self.stdscr.move(kb_line, 2)
+            self.stdscr.clrtoeol()
+            self.stdscr.addstr(kb_line, 2, self.virtual_keyboard, curses.color_pair(3))
+        oct_line = kb_line + 1
+        if oct_line < max_y:
+            self.stdscr.move(oct_line, 2)
+            self.stdscr.clrtoeol()
+            self.stdscr.addstr(oct_line, 2, f"Octave Shift: {self.octave_shift}", curses.color_pair(6))
+        speed_line = kb_line + 2
+        if speed_line < max_y:
+            self.stdscr.move(speed_line, 2)
+            self.stdscr.clrtoeol()
+            self.stdscr.addstr(speed_line, 2, f"Playback Speed: {self.playback_speed:.1f}x", curses.color_pair(6))
+        loop_line = kb_line + 3
+        if loop_line < max_y:
+            self.stdscr.move(loop_line, 2)
+            self.stdscr.clrtoeol()
+            loop_status = "ON" if self.loop_mode else "OFF"
+            self.stdscr.addstr(loop_line, 2, f"Loop Mode: {loop_status}", curses.color_pair(6))
+        soundfont_line = kb_line + 4
+        if soundfont_line < max_y:
+            self.stdscr.move(soundfont_line, 2)
+            self.stdscr.clrtoeol()
+            self.stdscr.addstr(soundfont_line, 2, f"SoundFont: {self.soundfont_status()}"[:max_x - 3], curses.color_pair(6))
+        for line in range(kb_line + 5, min(kb_line + 9, max_y)):
+            self.stdscr.move(line, 2)
+            self.stdscr.clrtoeol()
+        network_line = kb_line + 8
+        if self.midi_server and network_line < max_y:
+            self.stdscr.addstr(network_line, 2, f"Network MIDI: {self.midi_server.status()}"[:max_x - 3], curses.color_pair(6))
+        if self.is_recording:
+            rec_line = kb_line + 5
+            if rec_line < max_y:
+                self.stdscr.addstr(rec_line, 2, "Recording... (Press 'R' to stop)", curses.color_pair(1))
+        status_line = kb_line + 6 if not self.is_recording else kb_line + 7
+        if self.midi_mode and self.midi_player and status_line < max_y:
+            self.stdscr.addstr(status_line, 2, f"MIDI Status: {self.midi_status()}", curses.color_pair(7))
+        self.stdscr.noutrefresh()
+        if self.midi_mode and self.midi_player:
+            draw_progress_bar(self.stdscr, self.midi_player)
+        curses.doupdate()
 
     def run(self):
         if not self.running:
             return
+        input_fd = sys.stdin.fileno()
         while True:
             try:
                 max_y, max_x = self.stdscr.getmaxyx()
                 if max_y < MIN_HEIGHT or max_x < MIN_WIDTH:
                     draw_resize_prompt(self.stdscr, max_y, max_x)
+                    self.invalidate_screen()
                     key = self.stdscr.getch()
                     time.sleep(0.5)
                     continue
-                self.tree_display.active_notes = self.active_notes
-                self.tree_display.update_display()
-                start_line = self.tree_display.note_display_start_line + 2
-                for idx, line in enumerate(self.instructions):
-                    if start_line + idx >= max_y - 5:
-                        break
-                    self.stdscr.move(start_line + idx, 2)
-                    self.stdscr.clrtoeol()
-                    self.stdscr.addstr(start_line + idx, 2, line, curses.color_pair(7))
-                kb_line = start_line + len(self.instructions)
-                if kb_line < max_y:
-                    self.stdscr.move(kb_line, 2)
-                    self.stdscr.clrtoeol()
-                    self.stdscr.addstr(kb_line, 2, self.virtual_keyboard, curses.color_pair(3))
-                oct_line = kb_line + 1
-                if oct_line < max_y:
-                    self.stdscr.move(oct_line, 2)
-                    self.stdscr.clrtoeol()
-                    self.stdscr.addstr(oct_line, 2, f"Octave Shift: {self.octave_shift}", curses.color_pair(6))
-                speed_line = kb_line + 2
-                if speed_line < max_y:
-                    self.stdscr.move(speed_line, 2)
-                    self.stdscr.clrtoeol()
-                    self.stdscr.addstr(speed_line, 2, f"Playback Speed: {self.playback_speed:.1f}x", curses.color_pair(6))
-                loop_line = kb_line + 3
-                if loop_line < max_y:
-                    self.stdscr.move(loop_line, 2)
-                    self.stdscr.clrtoeol()
-                    loop_status = "ON" if self.loop_mode else "OFF"
-                    self.stdscr.addstr(loop_line, 2, f"Loop Mode: {loop_status}", curses.color_pair(6))
-                if self.is_recording:
-                    rec_line = kb_line + 4
-                    if rec_line < max_y:
-                        self.stdscr.move(rec_line, 2)
-                        self.stdscr.clrtoeol()
-                        self.stdscr.addstr(rec_line, 2, "Recording... (Press 'R' to stop)", curses.color_pair(1))
-                status_line = kb_line + 5 if not self.is_recording else kb_line + 6
-                if self.midi_mode and self.midi_player and status_line < max_y:
-                    self.stdscr.move(status_line, 2)
-                    self.stdscr.clrtoeol()
-                    if self.midi_player.paused:
-                        pause_status = "Paused"
-                    elif not self.midi_player.is_playing and not self.midi_player.paused and not self.midi_player.paused_for_soundfont:
-                        pause_status = "Stopped"
-                    else:
-                        pause_status = "Playing"
-                    self.stdscr.addstr(status_line, 2, f"MIDI Status: {pause_status}", curses.color_pair(7))
-                self.stdscr.noutrefresh()
+                if self.synth_thread is None:
+                    self.poll_download()
+                    self.poll_soundfont()
+                    now = time.perf_counter()
+                    if self.metrics.due(now):
+                        self.metrics.sample(now, self.collect_metrics())
                 if self.midi_mode and self.midi_player:
-                    self.midi_player.update()
+                    if self.midi_player.scheduler_thread is None:
+                        self.midi_player.update()
                     if not self.midi_player.is_playing and not self.midi_player.paused and not self.midi_player.paused_for_soundfont:
                         self.midi_mode = False
-                if self.midi_mode and self.midi_player:
-                    draw_progress_bar(self.stdscr, self.midi_player)
-                curses.doupdate()
-                try:
-                    key = self.stdscr.getch()
-                except:
-                    key = -1
+                self.tree_display.active_notes = self.active_notes
+                frame_start = time.perf_counter()
+                roll_due = self.waterfall and self.midi_mode and self.piano_roll.rows_due(self.midi_player)
+                if self.frame_governor.should_render(frame_start, self.frame_signature(max_x),
+                                                     force=self.tree_display.lights_due() or roll_due):
+                    self.render_frame(max_y, max_x)
+                    self.frame_governor.frame_done(time.perf_counter() - frame_start)
+                    if self.synth_thread is not None:
+                        self.startup_profile.record('first frame', frame_start)
+                if self.synth_thread is not None and not self.finish_startup():
+                    break
+                self.release_keys(time.perf_counter())
+                readers = [input_fd]
+                if self.audio is not None:
+                    readers.append(self.audio.wake_read)
+                elif self.midi_server is not None:
+                    readers.append(self.midi_server.wake_read)
+                ready, _, _ = select.select(readers, [], [], self.next_wakeup())
                 current_time = time.perf_counter()
-                if key != -1:
-                    if key == curses.KEY_RESIZE:
-                        handle_resize(self.stdscr)
-                        continue
+                if self.audio is not None:
+                    self.poll_audio(self.audio.wake_read in ready)
+                elif self.midi_server is not None and self.midi_server.wake_read in ready:
+                    self.midi_server.acknowledge()
+                keep_running = True
+                while keep_running:
                     try:
-                        key_char = chr(key).lower()
-                    except ValueError:
-                        key_char = ''
-                    if key_char == 'q':
-                        if self.midi_mode and self.midi_player:
-                            self.midi_player.stop()
-                            self.midi_mode = False
+                        key = self.stdscr.getch()
+                    except:
+                        key = -1
+                    if key == -1:
                         break
-                    elif key_char == 's':
-                        if self.midi_mode and self.midi_player:
-                            self.midi_player.stop()
-                            self.midi_mode = False
-                    elif key_char == '[':
-                        self.octave_shift -= 1
-                        if self.midi_mode and self.midi_player:
-                            self.midi_player.set_octave_shift(self.octave_shift)
-                    elif key_char == ']':
-                        self.octave_shift += 1
-                        if self.midi_mode and self.midi_player:
-                            self.midi_player.set_octave_shift(self.octave_shift)
-                    elif key_char == '-':
-                        new_speed = max(0.1, self.playback_speed - 0.1)
-                        self.playback_speed = new_speed
-                        if self.midi_mode and self.midi_player:
-                            self.midi_player.set_playback_speed(new_speed)
-                    elif key_char == '+':
-                        new_speed = self.playback_speed + 0.1
-                        self.playback_speed = new_speed
-                        if self.midi_mode and self.midi_player:
-                            self.midi_player.set_playback_speed(new_speed)
-                    elif key_char == '3':
-                        self.loop_mode = not self.loop_mode
-                        if self.midi_mode and self.midi_player:
-                            self.midi_player.loop_mode = self.loop_mode
-                    elif key_char == '4':
-                        if self.midi_mode and self.midi_player:
-                            self.midi_player.toggle_pause()
-                    elif key_char == '<':
-                        if self.midi_mode and self.midi_player:
-                            self.midi_player.seek(-5)
-                    elif key_char == '>':
-                        if self.midi_mode and self.midi_player:
-                            self.midi_player.seek(5)
-                    elif key_char == '2':
-                        soundfonts = [f for f in os.listdir('.') if f.lower().endswith('.sf2')]
-                        if not soundfonts:
-                            self.display_error("No SoundFont (.sf2) files found.")
-                            continue
-                        if self.midi_mode and self.midi_player:
-                            self.midi_player.pause_for_soundfont_change()
-                        new_sf = self.select_soundfont(soundfonts)
-                        self.stdscr.erase()
-                        self.stdscr.refresh()
-                        if new_sf:
-                            with SuppressStderr():
-                                try:
-                                    self.soundfont_id = self.fs.sfload(new_sf, True)
-                                    for channel in range(16):
-                                        self.fs.program_select(channel, self.soundfont_id, 0, 0)
-                                except:
-                                    self.display_error(f"Error loading SoundFont '{new_sf}'.")
-                            if self.midi_mode and self.midi_player:
-                                self.midi_player.resume_after_soundfont_change()
-                        else:
-                            if self.midi_mode and self.midi_player:
-                                self.midi_player.resume_after_soundfont_change()
-                    else:
-                        if not self.midi_mode:
-                            if key_char in NOTE_MIDI_NUMBERS:
-                                midi_note = NOTE_MIDI_NUMBERS[key_char] + (self.octave_shift * 12)
-                                if key_char not in self.key_to_midi_note:
-                                    self.fs.noteon(0, midi_note, 127)
-                                    self.active_notes.add(midi_note)
-                                    self.key_to_midi_note[key_char] = midi_note
-                                self.pressed_keys[key_char] = current_time
-                                if self.is_recording:
-                                    self.recording.append(('note_on', midi_note, current_time))
-                            elif key_char == 'r':
-                                if not self.is_recording:
-                                    self.recording = []
-                                    self.is_recording = True
-                                else:
-                                    self.is_recording = False
-                                    for midi_note in list(self.active_notes):
-                                        self.recording.append(('note_off', midi_note, current_time))
-                                        self.fs.noteoff(0, midi_note)
-                                        self.active_notes.remove(midi_note)
-                                    self.key_to_midi_note.clear()
-                            elif key_char == 'p':
-                                if self.recording:
-                                    self.is_recording = False
-                                    self.play_recording()
-                                else:
-                                    self.display_error("No recording to play.")
-                            elif key_char == '1':
-                                if self.midi_mode and self.midi_player:
-                                    self.midi_player.stop()
-                                    self.midi_mode = False
-                                midi_files = [f for f in os.listdir('.') if f.lower().endswith(('.mid', '.midi'))]
-                                if midi_files:
-                                    selected_midi = self.select_midi_file(midi_files)
-                                    self.stdscr.erase()
-                                    self.stdscr.refresh()
-                                    if selected_midi:
-                                        self.midi_mode = True
-                                        self.midi_player = MIDIPlayer(selected_midi, self.octave_shift, self.playback_speed, self.fs, self.active_notes, self.stdscr, self.loop_mode)
-                                else:
-                                    self.display_error("No MIDI files found.")
+                    keep_running = self.handle_key(key, current_time)
+                if not keep_running:
+                    break
             except:
                 self.display_error("An unexpected error occurred. Check the log.")
                 break
-            keys_to_stop = []
-            for k_char, t in self.pressed_keys.items():
-                if time.perf_counter() - t > 0.1:
-                    keys_to_stop.append(k_char)
-            for k_char in keys_to_stop:
-                if k_char in self.key_to_midi_note:
-                    midi_note = self.key_to_midi_note[k_char]
-                    if self.is_recording:
-                        self.recording.append(('note_off', midi_note, time.perf_counter()))
-                    self.fs.noteoff(0, midi_note)
-                    if midi_note in self.active_notes:
-                        self.active_notes.remove(midi_note)
-                    del self.key_to_midi_note[k_char]
-                del self.pressed_keys[k_char]
-            time.sleep(0.01)
         self.cleanup()
 
+    def handle_key(self, key, current_time):
+        if key == curses.KEY_RESIZE:
+            handle_resize(self.stdscr)
+            self.invalidate_screen()
+            return True
+        try:
+            key_char = chr(key).lower()
+        except ValueError:
+            key_char = ''
+        if key_char == 'q':
+            if self.midi_mode and self.midi_player:
+                self.midi_player.stop()
+                self.midi_mode = False
+            return False
+        elif key_char == 's':
+            if self.midi_mode and self.midi_player:
+                self.midi_player.stop()
+                self.midi_mode = False
+        elif key_char == '[':
+            self.octave_shift -= 1
+            if self.midi_mode and self.midi_player:
+                self.midi_player.set_octave_shift(self.octave_shift)
+        elif key_char == ']':
+            self.octave_shift += 1
+            if self.midi_mode and self.midi_player:
+                self.midi_player.set_octave_shift(self.octave_shift)
+        elif key_char == '-':
+            new_speed = max(0.1, self.playback_speed - 0.1)
+            self.playback_speed = new_speed
+            if self.midi_mode and self.midi_player:
+                self.midi_player.set_playback_speed(new_speed)
+        elif key_char == '+':
+            new_speed = self.playback_speed + 0.1
+            self.playback_speed = new_speed
+            if self.midi_mode and self.midi_player:
+                self.midi_player.set_playback_speed(new_speed)
+        elif key_char == '3':
+            self.loop_mode = not self.loop_mode
+            if self.midi_mode and self.midi_player:
+                self.midi_player.loop_mode = self.loop_mode
+        elif key_char == '4':
+            if self.midi_mode and self.midi_player:
+                self.midi_player.toggle_pause()
+        elif key_char == '5':
+            self.toggle_waterfall()
+        elif key_char == '7':
+            if self.fs is not None:
+                self.toggle_metrics_overlay()
+        elif key_char == '<':
+            if self.midi_mode and self.midi_player:
+                self.midi_player.seek(-5)
+        elif key_char == '>':
+            if self.midi_mode and self.midi_player:
+                self.midi_player.seek(5)
+        elif key_char == '2':
+            soundfonts = [f for f in os.listdir('.') if f.lower().endswith('.sf2')]
+            if not soundfonts:
+                self.display_error("No SoundFont (.sf2) files found.")
+                return True
+            if self.midi_mode and self.midi_player:
+                self.midi_player.pause_for_soundfont_change()
+            new_sf = self.select_soundfont(soundfonts)
+            self.stdscr.erase()
+            self.stdscr.refresh()
+            self.invalidate_screen()
+            if self.midi_mode and self.midi_player:
+                self.midi_player.resume_after_soundfont_change()
+            if new_sf:
+                self.soundfont_manager.request(new_sf)
+        elif key_char == '6':
+            if self.midi_mode and self.midi_player:
+                self.midi_player.pause_for_soundfont_change()
+            self.select_channel_preset()
+            self.stdscr.erase()
+            self.stdscr.refresh()
+            self.invalidate_screen()
+            if self.midi_mode and self.midi_player:
+                self.midi_player.resume_after_soundfont_change()
+        else:
+            if not self.midi_mode:
+                if key == ord('R'):
+                    if not self.is_recording:
+                        self.start_recording()
+                    else:
+                        self.stop_recording(current_time)
+                elif key == ord('P'):
+                    if self.is_recording:
+                        self.stop_recording(current_time)
+                    self.play_recording()
+                elif key_char in NOTE_MIDI_NUMBERS:
+                    midi_note = NOTE_MIDI_NUMBERS[key_char] + (self.octave_shift * 12)
+                    if key_char not in self.key_to_midi_note:
+                        self.fs.noteon(0, midi_note, 127)
+                        self.input_latency.record(time.perf_counter() - current_time)
+                        self.key_events += 1
+                        self.key_to_midi_note[key_char] = midi_note
+                        self.tree_display.pulse(127)
+                    self.pressed_keys[key_char] = current_time
+                    if self.is_recording:
+                        self.recording.append(('note_on', midi_note, current_time))
+                elif key_char == '1':
+                    if self.midi_mode and self.midi_player:
+                        self.midi_player.stop()
+                        self.midi_mode = False
+                    selected_midi = self.select_midi_entry()
+                    self.stdscr.erase()
+                    self.stdscr.refresh()
+                    self.invalidate_screen()
+                    if selected_midi:
+                        self.start_midi_player(selected_midi)
+        return True
+
+    def release_keys(self, now):
+        keys_to_stop = [k_char for k_char, t in self.pressed_keys.items() if now - t > KEY_RELEASE_DELAY]
+        released = []
+        for k_char in keys_to_stop:
+            if k_char in self.key_to_midi_note:
+                midi_note = self.key_to_midi_note[k_char]
+                if self.is_recording:
+                    self.recording.append(('note_off', midi_note, now))
+                released.append((0, midi_note))
+                del self.key_to_midi_note[k_char]
+            del self.pressed_keys[k_char]
+        if released:
+            self.fs.release(released)
+            self.key_events += len(released)
+
+    def next_wakeup(self):
+        now = time.perf_counter()
+        deadlines = [INPUT_IDLE_WAIT]
+        if self.pressed_keys:
+            deadlines.append(min(self.pressed_keys.values()) + KEY_RELEASE_DELAY - now)
+        if self.frame_governor.pending:
+            deadlines.append(self.frame_governor.last_frame + self.frame_governor.frame_interval - now)
+        light_change = self.tree_display.next_light_change()
+        if light_change is not None:
+            deadlines.append(light_change - time.time())
+        player = self.midi_player if self.midi_mode else None
+        if player and player.is_playing and not player.paused and not player.paused_for_soundfont:
+            if player.scheduler_thread is None:
+                deadlines.append(player.time_until_next_event())
+            deadlines.append(self.frame_governor.frame_interval or PLAYBACK_REFRESH)
+        if self.soundfont_download is not None or (self.soundfont_manager and self.soundfont_manager.loading_path):
+            deadlines.append(PLAYBACK_REFRESH)
+        next_sample = self.metrics.next_sample()
+        if next_sample is not None:
+            deadlines.append(next_sample - now)
+        return max(0.0, min(deadlines))
+
     def cleanup(self):
+        midi_player = self.midi_player
+        if midi_player is not None:
+            if midi_player.is_playing:
+                midi_player.stop()
+            scheduler_thread = getattr(midi_player, 'scheduler_thread', None)
+            if scheduler_thread is not None:
+                scheduler_thread.join(timeout=1.0)
+        logging.info(f"Frame times: {self.frame_governor.stats}")
+        logging.info(f"Keypress-to-noteon latency: {self.input_latency}")
+        if isinstance(self.fs, (SynthDispatcher, RemoteSynth)):
+            logging.info(f"Synth dispatch: {self.fs}")
+        if self.is_recording:
+            self.stop_recording(time.perf_counter())
+        if self.midi_server:
+            self.midi_server.stop()
+        self.library_stop.set()
+        library_thread = self.library_thread
+        if library_thread is not None:
+            library_thread.join(timeout=2.0)
+        if self.midi_library is not None:
+            self.midi_library.close()
+        if self.metrics.path and isinstance(self.fs, (SynthDispatcher, RemoteSynth)):
+            self.metrics.sample(time.perf_counter(), self.collect_metrics(), export=True)
         try:
             if self.fs:
                 self.fs.delete()
+            if self.audio is not None:
+                self.audio.stop()
             curses.endwin()
         except:
             pass
 
-def main(stdscr):
-    app = PianoApp(stdscr)
+class NullSynth:
+    def noteon(self, channel, note, velocity):
+        pass
+
+    def noteoff(self, channel, note):
+        pass
+
+    def program_change(self, channel, program):
+        pass
+
+    def cc(self, channel, controller, value):
+        pass
+
+    def pitch_bend(self, channel, value):
+        pass
+
+    def key_pressure(self, channel, note, pressure):
+        pass
+
+    def channel_pressure(self, channel, pressure):
+        pass
+
+BENCHMARK_REPEATS = 5
+BENCHMARK_TOLERANCE = 0.3
+BENCHMARK_SEEKS = 50
+BENCHMARK_FRAMES = 300
+BENCHMARK_SCREEN = (60, 160)
+DEFAULT_BENCHMARK_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench-baseline.json')
+JITTER_MODES = ('ui-loop', 'scheduler-thread', 'audio-process')
+JITTER_MIDI_FILE = 'dense-runs'
+SYNTHETIC_MIDI_FILES = (
+    ('dense-chords', 16, 8, 200, False),
+    ('dense-runs', 4, 1, 6000, False),
+    ('dense-expression', 4, 4, 1500, True),
+)
+
+class RecordingSynth:
+    def __init__(self):
+        self.calls = []
+
+    def noteon(self, channel, note, velocity):
+        self.calls.append(('noteon', channel, note, velocity))
+
+    def noteoff(self, channel, note):
+        self.calls.append(('noteoff', channel, note))
+
+    def program_change(self, channel, program):
+        self.calls.append(('program_change', channel, program))
+
+    def program_select(self, channel, soundfont_id, bank, program):
+        self.calls.append(('program_select', channel, soundfont_id, bank, program))
+
+    def cc(self, channel, controller, value):
+        self.calls.append(('cc', channel, controller, value))
+
+    def pitch_bend(self, channel, value):
+        self.calls.append(('pitch_bend', channel, value))
+
+    def key_pressure(self, channel, note, pressure):
+        self.calls.append(('key_pressure', channel, note, pressure))
+
+    def channel_pressure(self, channel, pressure):
+        self.calls.append(('channel_pressure', channel, pressure))
+
+class VirtualScreen:
+    def __init__(self, height, width):
+        self.height = height
+        self.width = width
+        self.erase()
+
+    def getmaxyx(self):
+        return self.height, self.width
+
+    def erase(self):
+        self.cells = [[(' ', 0)] * self.width for _ in range(self.height)]
+
+    def addstr(self, y, x, text, attr=0):
+        if not 0 <= y < self.height or not 0 <= x < self.width:
+            raise curses.error("addstr outside the screen")
+        row = self.cells[y]
+        for offset, char in enumerate(text):
+            if x + offset >= self.width:
+                raise curses.error("addstr past the right edge")
+            row[x + offset] = (char, attr)
+
+    def addch(self, y, x, char, attr=0):
+        self.addstr(y, x, char, attr)
+
+    def overlay(self, target, source_row, source_column, row, column, max_row, max_column):
+        for y in range(row, max_row + 1):
+            for x in range(column, max_column + 1):
+                cell = self.cells[source_row + y - row][source_column + x - column]
+                if cell[0] != ' ':
+                    target.cells[y][x] = cell
+
+    def move(self, y, x):
+        pass
+
+    def clrtoeol(self):
+        pass
+
+    def noutrefresh(self):
+        pass
+
+    def refresh(self):
+        pass
+
+    def text(self):
+        return "\n".join(''.join(char for char, _ in row) for row in self.cells)
+
+class VirtualCurses:
+    error = curses.error
+    A_BOLD = curses.A_BOLD
+    newpad = VirtualScreen
+
+    @staticmethod
+    def color_pair(number):
+        return number << 8
+
+@contextlib.contextmanager
+def virtual_curses():
+    global curses
+    real_curses = curses
+    curses = VirtualCurses
+    try:
+        yield
+    finally:
+        curses = real_curses
+
+def legacy_dispatch(message_queue, fs):
+    active_notes = set()
+    global_active_notes = set()
+    for message_time, msg in message_queue:
+        if not msg.is_meta:
+            channel = msg.channel if hasattr(msg, 'channel') else 0
+            if msg.type == 'note_on' and msg.velocity > 0:
+                fs.noteon(channel, msg.note, msg.velocity)
+                active_notes.add((channel, msg.note))
+                global_active_notes.add(msg.note)
+            elif (msg.type == 'note_off') or (msg.type == 'note_on' and msg.velocity == 0):
+                fs.noteoff(channel, msg.note)
+                if (channel, msg.note) in active_notes:
+                    active_notes.remove((channel, msg.note))
+                if msg.note in global_active_notes:
+                    global_active_notes.remove(msg.note)
+            elif msg.type == 'program_change':
+                if channel != 9:
+                    fs.program_change(channel, msg.program)
+
+def benchmark_timeline(midi_file):
+    import mido
+    tracemalloc.start()
+    midi = mido.MidiFile(midi_file)
+    message_queue = []
+    absolute_time = 0
+    for msg in midi:
+        absolute_time += msg.time
+        message_queue.append((absolute_time, msg))
+    legacy_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    legacy_seconds = float('inf')
+    for _ in range(BENCHMARK_REPEATS):
+        start = time.perf_counter()
+        legacy_dispatch(message_queue, NullSynth())
+        legacy_seconds = min(legacy_seconds, time.perf_counter() - start)
+    del midi, message_queue
+    tracemalloc.start()
+    timeline = EventTimeline.from_midi_file(midi_file)
+    timeline_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    player = MIDIPlayer(midi_file, 0, 1.0, NullSynth(), None, None)
+    timeline_seconds = float('inf')
+    for _ in range(BENCHMARK_REPEATS):
+        player.current_message_index = 0
+        player.is_playing = True
+        player.active_notes.clear()
+        player.fs.notes.clear()
+        player.start_time = time.perf_counter() - player.total_length - 1.0
+        start = time.perf_counter()
+        player.update()
+        timeline_seconds = min(timeline_seconds, time.perf_counter() - start)
+    return {
+        'file': os.path.basename(midi_file),
+        'events': timeline.length,
+        'legacy_bytes': legacy_bytes,
+        'timeline_bytes': timeline_bytes,
+        'legacy_events_per_second': timeline.length / legacy_seconds if legacy_seconds > 0 else 0.0,
+        'timeline_events_per_second': timeline.length / timeline_seconds if timeline_seconds > 0 else 0.0,
+    }
+
+def legacy_update_lights(light_states, color_pairs, min_delay, max_delay, current_time):
+    for position, state in light_states.items():
+        if current_time >= state['next_change']:
+            available_colors = [cp for cp in color_pairs if cp != state['color']]
+            if not available_colors:
+                available_colors = color_pairs
+            state['color'] = random.choice(available_colors)
+            state['next_change'] = current_time + random.uniform(min_delay, max_delay)
+
+def benchmark_lights(light_count, frames=600, fps=60.0):
+    display = ChristmasTreeDisplay(['O' * light_count], [1, 2, 3, 5, 6], None)
+    legacy_states = {position: {'color': state['color'], 'next_change': state['next_change']}
+                     for position, state in display.light_states.items()}
+    base_time = time.time()
+    legacy_seconds = 0.0
+    heap_seconds = 0.0
+    for frame in range(frames):
+        current_time = base_time + frame / fps
+        start = time.perf_counter()
+        legacy_update_lights(legacy_states, display.color_pairs, display.min_delay, display.max_delay, current_time)
+        legacy_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        display.update_lights(current_time)
+        heap_seconds += time.perf_counter() - start
+        display.dirty_lights.clear()
+    return {
+        'lights': light_count,
+        'legacy_us_per_frame': legacy_seconds / frames * 1e6,
+        'heap_us_per_frame': heap_seconds / frames * 1e6,
+    }
+
+def run_benchmark_lights(options):
+    print(f"{'Lights':>8} {'Full scan us/frame':>19} {'Heap us/frame':>14} {'Speedup':>8}")
+    for light_count in options.counts:
+        result = benchmark_lights(light_count)
+        speedup = result['legacy_us_per_frame'] / result['heap_us_per_frame'] if result['heap_us_per_frame'] else 0.0
+        print(f"{result['lights']:>8} {result['legacy_us_per_frame']:>19.1f} {result['heap_us_per_frame']:>14.1f} {speedup:>7.1f}x")
+    return 0
+
+def run_benchmark_timeline(options):
+    midi_files = options.files or sorted(f for f in os.listdir('.') if f.lower().endswith(('.mid', '.midi')))
+    print(f"{'File':<48} {'Events':>8} {'Legacy KB':>10} {'Timeline KB':>12} {'Ratio':>6} {'Legacy ev/s':>12} {'Timeline ev/s':>14}")
+    for midi_file in midi_files:
+        try:
+            result = benchmark_timeline(midi_file)
+        except:
+            logging.exception(f"Error benchmarking {midi_file}.")
+            print(f"{os.path.basename(midi_file)[:48]:<48} failed, see pianomancer.log")
+            continue
+        ratio = result['legacy_bytes'] / result['timeline_bytes'] if result['timeline_bytes'] else 0.0
+        print(f"{result['file'][:48]:<48} {result['events']:>8} {result['legacy_bytes'] / 1024:>10.1f} "
+              f"{result['timeline_bytes'] / 1024:>12.1f} {ratio:>5.1f}x "
+              f"{result['legacy_events_per_second']:>12.0f} {result['timeline_events_per_second']:>14.0f}")
+    return 0
+
+def write_synthetic_midi(path, channels, chord_size, steps, expression=False, seed=0):
+    import mido
+    rng = random.Random(seed)
+    midi = mido.MidiFile(ticks_per_beat=480)
+    for channel in range(channels):
+        track = mido.MidiTrack()
+        track.append(mido.Message('program_change', channel=channel, program=rng.randrange(128), time=0))
+        for step in range(steps):
+            notes = rng.sample(range(36, 96), chord_size)
+            for index, note in enumerate(notes):
+                track.append(mido.Message('note_on', channel=channel, note=note, velocity=rng.randrange(40, 128),
+                                          time=0 if index else rng.randrange(1, 24)))
+            if step % 16 == 0:
+                track.append(mido.Message('control_change', channel=channel, control=7, value=rng.randrange(128)))
+            if expression:
+                track.append(mido.Message('control_change', channel=channel, control=64, value=127))
+                for bend in range(-2048, 2049, 1024):
+                    track.append(mido.Message('pitchwheel', channel=channel, pitch=bend, time=rng.randrange(0, 4)))
+                    track.append(mido.Message('aftertouch', channel=channel, value=rng.randrange(128)))
+                track.append(mido.Message('polytouch', channel=channel, note=notes[0], value=rng.randrange(128)))
+                track.append(mido.Message('control_change', channel=channel, control=64, value=0))
+            for index, note in enumerate(notes):
+                track.append(mido.Message('note_off', channel=channel, note=note, time=0 if index else rng.randrange(1, 24)))
+        midi.tracks.append(track)
+    midi.save(path)
+    return path
+
+def best_time(function, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def benchmark_calibration(repeats=BENCHMARK_REPEATS):
+    def workload():
+        values = [(index * 7919) % 10007 for index in range(100000)]
+        counts = {}
+        for value in values:
+            counts[value & 0xFF] = counts.get(value & 0xFF, 0) + 1
+        sorted(values)
+    return best_time(workload, repeats)
+
+def benchmark_player(midi_file, repeats=BENCHMARK_REPEATS):
+    synth = RecordingSynth()
+    clock = [0.0]
+    player = MIDIPlayer(midi_file, 0, 1.0, synth, None, None, clock=lambda: clock[0])
+    if getattr(player, 'timeline', None) is None:
+        raise RuntimeError(f"Error reading MIDI file '{midi_file}'.")
+    name = os.path.basename(midi_file)
+
+    def prepare():
+        player.timeline = None
+        player.prepare_messages()
+    results = {f"prepare_messages[{name}]": best_time(prepare, repeats)}
+    rng = random.Random(0)
+    targets = [rng.uniform(0, player.total_length) for _ in range(BENCHMARK_SEEKS)]
+
+    def seek_all():
+        for target in targets:
+            player.seek(target - player.get_current_logical_time())
+    results[f"seek[{name}]"] = best_time(seek_all, repeats)
+
+    def dispatch_all():
+        player.stop()
+        player.current_message_index = 0
+        player.is_playing = True
+        player.interrupted = False
+        synth.calls.clear()
+        player.start_time = clock[0] - player.total_length - 1.0
+        player.update()
+    results[f"update[{name}]"] = best_time(dispatch_all, repeats)
+    if player.current_message_index != player.total_messages or not synth.calls:
+        raise RuntimeError(f"Dispatch of '{midi_file}' stopped at event {player.current_message_index} of {player.total_messages}.")
+    return results
+
+def benchmark_display(repeats=BENCHMARK_REPEATS):
+    height, width = BENCHMARK_SCREEN
+    rng = random.Random(0)
+    chords = []
+    for _ in range(16):
+        chord = NoteState()
+        for note in rng.sample(list(PIANO_NOTE_RANGE), 10):
+            chord.press(0, note, 100)
+        chords.append(chord)
+    with virtual_curses():
+        screen = VirtualScreen(height, width)
+        display = ChristmasTreeDisplay([], [curses.color_pair(pair) for pair in (1, 2, 3, 5, 6)], screen, procedural=True,
+                                       light_pulse=True, reserved_rows=20)
+        display.update_display()
+        base_time = time.time()
+
+        def frames():
+            for frame in range(BENCHMARK_FRAMES):
+                display.active_notes = chords[frame % len(chords)]
+                display.pulse(100)
+                display.update_lights(base_time + frame / 60.0)
+                display.update_display()
+            display.invalidate()
+
+        def notes():
+            for frame in range(BENCHMARK_FRAMES):
+                display.active_notes = chords[frame % len(chords)]
+                display.draw_active_notes()
+        return {
+            'update_display': best_time(frames, repeats),
+            'draw_active_notes': best_time(notes, repeats),
+        }
+
+def run_benchmark_suite(options):
+    midi_files = options.files
+    if not midi_files:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        midi_files = sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.lower().endswith(('.mid', '.midi')))
+    calibration = benchmark_calibration(options.repeats)
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='pianomancer-bench-') as directory:
+        for name, channels, chord_size, steps, expression in SYNTHETIC_MIDI_FILES:
+            midi_files.append(write_synthetic_midi(os.path.join(directory, name + '.mid'), channels, chord_size, steps, expression))
+        for midi_file in midi_files:
+            try:
+                results.update(benchmark_player(midi_file, options.repeats))
+            except:
+                logging.exception(f"Error benchmarking {midi_file}.")
+                print(f"{os.path.basename(midi_file)}: failed, see pianomancer.log")
+                return 1
+    results.update(benchmark_display(options.repeats))
+    baseline = None
+    if os.path.exists(options.baseline) and not options.save_baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+    regressions = []
+    print(f"{'Benchmark':<72} {'ms':>9} {'Baseline ms':>12} {'Change':>8}")
+    for name, seconds in results.items():
+        line = f"{name[:72]:<72} {seconds * 1000:>9.3f}"
+        if baseline is not None and name in baseline['results']:
+            expected = baseline['results'][name] * calibration / baseline['calibration']
+            change = seconds / expected - 1.0 if expected > 0 else 0.0
+            line += f" {expected * 1000:>12.3f} {change * 100:>+7.0f}%"
+            if change > options.tolerance:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+    print(f"Calibration workload: {calibration * 1000:.1f} ms (baseline timings are scaled by it)")
+    if options.save_baseline:
+        with open(options.baseline, 'w') as f:
+            json.dump({'calibration': calibration, 'results': results}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Saved baseline to {options.baseline}")
+    elif baseline is None:
+        print(f"No baseline at {options.baseline}; run with --save-baseline to create one.")
+    if regressions:
+        print(f"{len(regressions)} benchmarks regressed by more than {options.tolerance * 100:.0f}%.")
+        return 1
+    return 0
+
+def simulate_ui_load(seconds, fps, load, player=None):
+    interval = 1.0 / fps
+    end = time.perf_counter() + seconds
+    next_frame = time.perf_counter()
+    while True:
+        now = time.perf_counter()
+        if now >= end:
+            return
+        if player is not None:
+            player.update()
+        if now >= next_frame:
+            busy_until = now + interval * load
+            while time.perf_counter() < busy_until:
+                for _ in range(100):
+                    pass
+            next_frame += interval
+        delay = next_frame - time.perf_counter()
+        if player is not None:
+            delay = min(delay, player.time_until_next_event())
+        time.sleep(max(0.0, min(delay, end - time.perf_counter())))
+
+def benchmark_jitter(midi_file, mode, seconds, fps, load, timeline_cache):
+    timeline = timeline_cache.get(midi_file)
+    if mode != 'audio-process':
+        player = MIDIPlayer(midi_file, 0, 1.0, NullSynth(), None, None, use_scheduler_thread=mode == 'scheduler-thread',
+                            timeline=timeline)
+        simulate_ui_load(seconds, fps, load, player if mode == 'ui-loop' else None)
+        player.stop()
+        return player.lateness.summary()
+    audio = AudioProcess(synth_factory=NullSynth, timeline_cache=timeline_cache).start()
+    if audio is None:
+        return None
+    try:
+        error = audio.wait_ready()
+        if error:
+            raise RuntimeError(error)
+        player = RemotePlayer(audio, midi_file, 0, 1.0, False, None, {}, timeline=timeline)
+        simulate_ui_load(seconds, fps, load)
+        player.stop()
+        deadline = time.perf_counter() + 2.0
+        while time.perf_counter() < deadline:
+            status = player.state()
+            if status is not None and not status.flags & AUDIO_PLAYING:
+                break
+            time.sleep(0.01)
+        return player.lateness.summary()
+    finally:
+        audio.stop()
+
+def run_benchmark_jitter(options):
+    with tempfile.TemporaryDirectory(prefix='pianomancer-bench-') as directory:
+        midi_file = options.file
+        if midi_file is None:
+            synthetic = {entry[0]: entry[1:] for entry in SYNTHETIC_MIDI_FILES}
+            midi_file = write_synthetic_midi(os.path.join(directory, JITTER_MIDI_FILE + '.mid'), *synthetic[JITTER_MIDI_FILE])
+        timeline_cache = TimelineCache(directory)
+        print(f"UI load: {options.ui_load * 100:.0f}% of every frame at {options.fps:g} fps, {options.seconds:g}s per mode")
+        print(f"{'Mode':<18} {'Events':>8} {'Mean ms':>8} {'p50 ms':>8} {'p99 ms':>8} {'Max ms':>8}")
+        for mode in JITTER_MODES:
+            try:
+                summary = benchmark_jitter(midi_file, mode, options.seconds, options.fps, options.ui_load, timeline_cache)
+            except:
+                logging.exception(f"Error measuring scheduler jitter in {mode} mode.")
+                print(f"{mode:<18} failed, see pianomancer.log")
+                continue
+            if summary is None:
+                print(f"{mode:<18} not available on this platform")
+                continue
+            print(f"{mode:<18} {summary['count']:>8} {summary['mean_ms']:>8.2f} {summary['p50_ms']:>8.2f} "
+                  f"{summary['p99_ms']:>8.2f} {summary['max_ms']:>8.2f}")
+    return 0
+
+def open_timeline_cache(options):
+    return TimelineCache(options.cache_dir, int(options.cache_size * 1024 * 1024))
+
+def create_timeline_cache(options):
+    if getattr(options, 'no_cache', False):
+        return None
+    return open_timeline_cache(options)
+
+def find_midi_files(directories, recursive=False):
+    midi_files = []
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(('.mid', '.midi')):
+                    midi_files.append(os.path.join(root, name))
+            if not recursive:
+                break
+    return midi_files
+
+def library_roots(directories, recursive=False):
+    return [(os.path.abspath(directory), recursive) for directory in directories]
+
+def run_library_scan(options):
+    library = MidiLibrary(options.library_db)
+    try:
+        stats = library.scan(library_roots(options.directories, options.recursive), options.jobs)
+    finally:
+        library.close()
+    print(describe_library_scan(stats))
+    return 1 if stats['failed'] else 0
+
+def run_library_list(options):
+    library = MidiLibrary(options.library_db)
+    try:
+        entries = library.entries(library_roots(options.directories, options.recursive))
+    finally:
+        library.close()
+    for entry in entries:
+        print(f"{entry.path} - {describe_midi_entry(entry)}")
+    print(f"{len(entries)} files in {options.library_db}")
+    return 0
+
+def run_cache_warm(options):
+    cache = open_timeline_cache(options)
+    midi_files = find_midi_files(options.directories, options.recursive)
+    failures = 0
+    start = time.perf_counter()
+    for midi_file in midi_files:
+        file_start = time.perf_counter()
+        misses = cache.misses
+        try:
+            timeline = cache.get(midi_file)
+        except:
+            logging.exception(f"Error warming timeline cache for {midi_file}.")
+            print(f"failed    {midi_file}")
+            failures += 1
+            continue
+        status = "compiled" if cache.misses > misses else "hit     "
+        print(f"{status}  {midi_file} ({timeline.length} events, {(time.perf_counter() - file_start) * 1000:.1f} ms)")
+    print(f"{len(midi_files)} files, {cache.misses} compiled, {cache.hits} already cached, "
+          f"{failures} failed in {time.perf_counter() - start:.2f}s")
+    return 1 if failures else 0
+
+def run_cache_clear(options):
+    cache = open_timeline_cache(options)
+    entries = cache.entries()
+    cache.clear()
+    print(f"Removed {len(entries)} cached timelines from {cache.directory}")
+    return 0
+
+def find_soundfonts(directories, recursive=False):
+    soundfonts = []
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            soundfonts.extend(os.path.join(root, name) for name in sorted(files) if name.lower().endswith('.sf2'))
+            if not recursive:
+                break
+    return soundfonts
+
+def run_soundfonts(options):
+    failures = 0
+    start = time.perf_counter()
+    soundfonts = find_soundfonts(options.directories, options.recursive)
+    for path in soundfonts:
+        scan_start = time.perf_counter()
+        try:
+            info = SoundFontInfo.scan(path)
+        except:
+            logging.exception(f"Error scanning SoundFont '{path}'.")
+            print(f"unreadable  {path}")
+            failures += 1
+            continue
+        print(f"{path}: {info.describe()}, {info.sample_count} samples ({(time.perf_counter() - scan_start) * 1000:.2f} ms)")
+        if options.presets:
+            for preset in info.presets:
+                print(f"    {preset.bank:03}:{preset.program:03}  {preset.name:<20} {preset.sample_bytes / (1024 * 1024):>8.1f} MB")
+    print(f"{len(soundfonts)} SoundFonts scanned in {(time.perf_counter() - start) * 1000:.1f} ms")
+    return 1 if failures else 0
+
+def run_download(options):
+    download = SoundFontDownload(options.url, options.output, options.sha256).start()
+    while not download.done:
+        progress = download.progress()
+        detail = f"{progress * 100:5.1f}%" if progress is not None else f"{download.downloaded // 1024} KB"
+        print(f"\rDownloading {options.url}: {detail}", end='', file=sys.stderr, flush=True)
+        time.sleep(0.2)
+    print(file=sys.stderr)
+    if download.error:
+        print(f"Download failed: {download.error}")
+        return 1
+    print(f"Saved {download.downloaded} bytes to {options.output}")
+    return 0
+
+def run_netsend(options):
+    import socket
+    if options.unix:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(options.unix)
+        target = options.unix
+    elif options.tcp:
+        sock = socket.create_connection(options.tcp)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        target = f"tcp://{options.tcp[0]}:{options.tcp[1]}"
+    else:
+        address = options.udp or (DEFAULT_NET_HOST, DEFAULT_NET_PORT)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect(address)
+        target = f"udp://{address[0]}:{address[1]}"
+    scale = [60, 62, 64, 65, 67, 69, 71, 72]
+    total = int(options.rate * options.seconds)
+    interval = options.batch / options.rate
+    sent = 0
+    start = next_send = time.perf_counter()
+    try:
+        while sent < total:
+            count = min(options.batch, total - sent)
+            payload = bytearray()
+            for index in range(sent, sent + count):
+                note = scale[(index // 2) % len(scale)]
+                payload += bytes((0x90 | options.channel, note, 0 if index % 2 else options.velocity))
+            if not options.raw:
+                payload[:0] = NET_FRAME_HEADER.pack(NET_FRAME_MAGIC, len(payload), time.monotonic_ns())
+            sock.send(payload)
+            sent += count
+            next_send += interval
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    except OSError as e:
+        print(f"Send failed after {sent} events: {e}")
+        return 1
+    finally:
+        sock.close()
+    elapsed = time.perf_counter() - start
+    print(f"Sent {sent} events to {target} in {elapsed:.2f}s ({sent / elapsed:.0f} events/s). "
+          f"The receiving app logs its latency percentiles to pianomancer.log.")
+    return 0
+
+def run_render(options):
+    output_path = options.output or os.path.splitext(os.path.basename(options.midi_file))[0] + '.wav'
+    try:
+        renderer = OfflineRenderer(options.sf2, options.sample_rate, options.gain)
+    except:
+        logging.exception("Error initializing offline renderer.")
+        print(f"Error loading SoundFont '{options.sf2}'. Check the pianomancer.log file for more details.")
+        return 1
+    try:
+        start = time.perf_counter()
+        seconds = renderer.render_to_file(options.midi_file, output_path, options.format,
+                                          octave_shift=options.octave, playback_speed=options.speed,
+                                          tail_seconds=options.tail, timeline_cache=create_timeline_cache(options))
+        elapsed = time.perf_counter() - start
+    except:
+        logging.exception(f"Error rendering {options.midi_file}.")
+        print(f"Error rendering '{options.midi_file}'. Check the pianomancer.log file for more details.")
+        return 1
+    finally:
+        renderer.delete()
+    realtime_factor = seconds / elapsed if elapsed > 0 else float('inf')
+    print(f"Rendered {format_time(seconds)} of audio to {output_path} in {elapsed:.2f}s ({realtime_factor:.1f}x realtime)")
+    return 0
+
+batch_renderer = None
+batch_timeline_cache = None
+
+def init_batch_worker(soundfont, sample_rate, gain, cache_dir, cache_size, no_cache):
+    global batch_renderer, batch_timeline_cache
+    batch_renderer = OfflineRenderer(soundfont, sample_rate, gain)
+    batch_timeline_cache = create_timeline_cache(argparse.Namespace(cache_dir=cache_dir, cache_size=cache_size, no_cache=no_cache))
+
+def render_batch_job(midi_file, output_path, output_format, octave_shift, playback_speed, tail_seconds):
+    result = {'file': midi_file, 'output': output_path, 'worker': os.getpid()}
+    start = time.perf_counter()
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        seconds = batch_renderer.render_to_file(midi_file, output_path, output_format,
+                                                octave_shift=octave_shift, playback_speed=playback_speed,
+                                                tail_seconds=tail_seconds, timeline_cache=batch_timeline_cache)
+    except Exception as e:
+        logging.exception(f"Error rendering {midi_file}.")
+        result.update(status='failed', error=str(e), render_seconds=time.perf_counter() - start)
+        return result
+    elapsed = time.perf_counter() - start
+    result.update(status='rendered', audio_seconds=seconds, render_seconds=elapsed,
+                  realtime_factor=seconds / elapsed if elapsed > 0 else None)
+    return result
+
+def batch_output_path(midi_file, directory, output_directory, output_format):
+    relative = os.path.relpath(midi_file, directory)
+    return os.path.join(output_directory, os.path.splitext(relative)[0] + ('.raw' if output_format == 'raw' else '.wav'))
+
+def batch_render_settings(options, output_format):
+    return {'soundfont': os.path.abspath(options.sf2), 'format': output_format, 'sample_rate': options.sample_rate,
+            'gain': options.gain, 'speed': options.speed, 'octave': options.octave, 'tail': options.tail}
+
+def load_batch_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_batch_manifest(path, manifest):
+    temp_path = path + '.part'
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(temp_path, path)
+    except OSError as e:
+        logging.warning(f"Error writing batch manifest {path}: {e}")
+
+def is_up_to_date(output_path, *inputs):
+    try:
+        output_mtime = os.stat(output_path).st_mtime
+        return all(os.stat(path).st_mtime <= output_mtime for path in inputs)
+    except OSError:
+        return False
+
+def run_batch(options):
+    output_format = options.format or 'wav'
+    settings = batch_render_settings(options, output_format)
+    manifest_path = os.path.join(options.output_dir, BATCH_MANIFEST)
+    manifest = load_batch_manifest(manifest_path)
+    jobs = []
+    results = []
+    for directory in options.directories:
+        for midi_file in find_midi_files([directory], options.recursive):
+            output_path = batch_output_path(midi_file, directory, options.output_dir, output_format)
+            if (not options.force and manifest.get(os.path.relpath(output_path, options.output_dir)) == settings
+                    and is_up_to_date(output_path, midi_file, options.sf2)):
+                results.append({'file': midi_file, 'output': output_path, 'status': 'skipped'})
+            else:
+                jobs.append((midi_file, output_path))
+    workers = options.jobs or os.cpu_count() or 1
+    start = time.perf_counter()
+    if jobs:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=min(workers, len(jobs)), initializer=init_batch_worker,
+                initargs=(options.sf2, options.sample_rate, options.gain,
+                          options.cache_dir, options.cache_size, options.no_cache)) as executor:
+            futures = [executor.submit(render_batch_job, midi_file, output_path, output_format,
+                                       options.octave, options.speed, options.tail)
+                       for midi_file, output_path in jobs]
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logging.exception("Batch render worker failed.")
+                    result = {'status': 'failed', 'error': str(e)}
+                results.append(result)
+                print(f"{result['status']:<9} {result.get('file', '?')}", file=sys.stderr)
+        for result in results:
+            if 'output' in result and result['status'] != 'skipped':
+                key = os.path.relpath(result['output'], options.output_dir)
+                if result['status'] == 'rendered':
+                    manifest[key] = settings
+                else:
+                    manifest.pop(key, None)
+        save_batch_manifest(manifest_path, manifest)
+    wall_seconds = time.perf_counter() - start
+    audio_seconds = sum(result.get('audio_seconds', 0.0) for result in results)
+    summary = {
+        'soundfont': options.sf2,
+        'workers': min(workers, len(jobs)) if jobs else 0,
+        'files': len(results),
+        'rendered': sum(1 for result in results if result['status'] == 'rendered'),
+        'skipped': sum(1 for result in results if result['status'] == 'skipped'),
+        'failed': sum(1 for result in results if result['status'] == 'failed'),
+        'audio_seconds': audio_seconds,
+        'wall_seconds': wall_seconds,
+        'realtime_factor': audio_seconds / wall_seconds if wall_seconds > 0 else None,
+        'results': sorted(results, key=lambda result: result.get('file', '')),
+    }
+    report = json.dumps(summary, indent=2)
+    if options.summary:
+        with open(options.summary, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+    return 1 if summary['failed'] else 0
+
+def add_render_arguments(parser):
+    parser.add_argument('--sf2', default=DEFAULT_SOUNDFONT, help=f"SoundFont to render with (default: {DEFAULT_SOUNDFONT})")
+    parser.add_argument('--sample-rate', type=int, default=DEFAULT_SAMPLE_RATE, help="output sample rate in Hz")
+    parser.add_argument('--gain', type=float, default=DEFAULT_GAIN, help="synth master gain")
+    parser.add_argument('--format', choices=['wav', 'raw'], help="output format (default: from the file extension)")
+    parser.add_argument('--speed', type=float, default=1.0, help="playback speed multiplier")
+    parser.add_argument('--octave', type=int, default=0, help="octave shift")
+    parser.add_argument('--tail', type=float, default=RENDER_TAIL_SECONDS, help="seconds of release tail after the last event")
+
+def parse_fps(value):
+    if value == 'change':
+        return None
+    try:
+        fps = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a number of frames per second or 'change'")
+    if fps <= 0:
+        raise argparse.ArgumentTypeError("frame rate must be positive")
+    return fps
+
+def parse_address(value):
+    host, _, port = value.rpartition(':')
+    try:
+        return (host or DEFAULT_NET_HOST, int(port))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected PORT or HOST:PORT")
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Pianomancer - Transform your keyboard into a piano!")
+    parser.add_argument('--scheduler-thread', action='store_true',
+                        help="dispatch MIDI events from a dedicated scheduler thread instead of the UI loop")
+    parser.add_argument('--audio-process', action='store_true',
+                        help="run the synthesizer and MIDI scheduling in a separate process so UI work cannot delay notes")
+    parser.add_argument('--fps', type=parse_fps, default=30.0,
+                        help="maximum redraw rate, or 'change' to redraw only when something changed (default: 30)")
+    parser.add_argument('--procedural-tree', action='store_true',
+                        help="grow the Christmas tree to fit the terminal instead of the classic 10-line tree")
+    parser.add_argument('--light-density', type=float, default=DEFAULT_LIGHT_DENSITY,
+                        help=f"fraction of procedural tree cells that are lights (default: {DEFAULT_LIGHT_DENSITY})")
+    parser.add_argument('--light-pulse', action='store_true', help="make the tree lights pulse with note velocity")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="print a phase-by-phase startup timing breakdown on exit")
+    parser.add_argument('--recordings-dir', default=DEFAULT_RECORDINGS_DIR,
+                        help=f"directory where recorded takes are saved as MIDI files (default: {DEFAULT_RECORDINGS_DIR})")
+    parser.add_argument('--soundfont-url', default=DEFAULT_SOUNDFONT_URL,
+                        help=f"where to download {DEFAULT_SOUNDFONT} from when it is missing")
+    parser.add_argument('--soundfont-sha256', help=f"expected SHA-256 of the downloaded {DEFAULT_SOUNDFONT}")
+    parser.add_argument('--waterfall', action='store_true', help="start with the falling-notes view instead of the tree")
+    parser.add_argument('--lookahead', type=float, default=DEFAULT_LOOKAHEAD,
+                        help=f"seconds of upcoming notes shown by the falling-notes view (default: {DEFAULT_LOOKAHEAD:g})")
+    parser.add_argument('--cache-dir', default=os.environ.get('PIANOMANCER_CACHE_DIR', DEFAULT_CACHE_DIR),
+                        help="directory for compiled MIDI timelines")
+    parser.add_argument('--cache-size', type=float, default=DEFAULT_CACHE_BYTES / (1024 * 1024),
+                        help="maximum size of the timeline cache in MB")
+    parser.add_argument('--no-cache', action='store_true', help="always parse MIDI files instead of using the timeline cache")
+    parser.add_argument('--library-root', action='append', metavar='DIR',
+                        help="directory indexed recursively for the MIDI picker, can be repeated "
+                             "(default: the current and recordings directories, top level only)")
+    parser.add_argument('--library-db', default=os.environ.get('PIANOMANCER_LIBRARY_DB', DEFAULT_LIBRARY_DB),
+                        help="SQLite file holding the MIDI library index")
+    parser.add_argument('--soundfont-budget', type=float, default=DEFAULT_SOUNDFONT_BUDGET / (1024 * 1024),
+                        help="memory budget in MB for SoundFonts kept loaded for instant switching (default: 512)")
+    parser.add_argument('--metrics-file', metavar='PATH',
+                        help="periodically write performance metrics to this file (Prometheus text for .prom/.txt, JSON otherwise)")
+    parser.add_argument('--metrics-interval', type=float, default=DEFAULT_METRICS_INTERVAL,
+                        help=f"seconds between metrics file updates (default: {DEFAULT_METRICS_INTERVAL:g})")
+    parser.add_argument('--listen-udp', type=parse_address, metavar='[HOST:]PORT',
+                        help=f"accept MIDI from other processes over UDP (host defaults to {DEFAULT_NET_HOST})")
+    parser.add_argument('--listen-tcp', type=parse_address, metavar='[HOST:]PORT', help="accept MIDI streams over TCP")
+    parser.add_argument('--listen-unix', metavar='PATH', help="accept MIDI streams on a Unix socket")
+    subparsers = parser.add_subparsers(dest='command')
+    render_parser = subparsers.add_parser('render', help="render a MIDI file to WAV or raw PCM without an audio device")
+    render_parser.add_argument('midi_file', help="MIDI file to render")
+    render_parser.add_argument('-o', '--output', help="output file (default: <song>.wav)")
+    add_render_arguments(render_parser)
+    render_parser.set_defaults(handler=run_render)
+    batch_parser = subparsers.add_parser('batch', help="render every MIDI file in a directory across a process pool")
+    batch_parser.add_argument('directories', nargs='*', default=['.'], help="directories to render (default: current directory)")
+    batch_parser.add_argument('-o', '--output-dir', default='renders', help="directory for rendered files (default: renders)")
+    batch_parser.add_argument('-j', '--jobs', type=int, help="number of worker processes (default: one per CPU)")
+    batch_parser.add_argument('-r', '--recursive', action='store_true', help="descend into subdirectories")
+    batch_parser.add_argument('--force', action='store_true', help="render even if the output is up to date")
+    batch_parser.add_argument('--summary', help="write the JSON summary to this file instead of stdout")
+    add_render_arguments(batch_parser)
+    batch_parser.set_defaults(handler=run_batch)
+    cache_parser = subparsers.add_parser('cache', help="manage the compiled MIDI timeline cache")
+    cache_subparsers = cache_parser.add_subparsers(dest='cache_command', required=True)
+    warm_parser = cache_subparsers.add_parser('warm', help="compile and cache every MIDI file in the given directories")
+    warm_parser.add_argument('directories', nargs='*', default=['.'], help="directories to scan (default: current directory)")
+    warm_parser.add_argument('-r', '--recursive', action='store_true', help="descend into subdirectories")
+    warm_parser.set_defaults(handler=run_cache_warm)
+    clear_parser = cache_subparsers.add_parser('clear', help="remove every cached timeline")
+    clear_parser.set_defaults(handler=run_cache_clear)
+    library_parser = subparsers.add_parser('library', help="manage the indexed MIDI library shown by the '1' picker")
+    library_subparsers = library_parser.add_subparsers(dest='library_command', required=True)
+    library_scan_parser = library_subparsers.add_parser('scan', help="index new and changed MIDI files in the given directories")
+    library_scan_parser.add_argument('directories', nargs='*', default=['.'], help="directories to scan (default: current directory)")
+    library_scan_parser.add_argument('-r', '--recursive', action='store_true', help="descend into subdirectories")
+    library_scan_parser.add_argument('-j', '--jobs', type=int, help="number of worker processes (default: one per CPU)")
+    library_scan_parser.set_defaults(handler=run_library_scan)
+    library_list_parser = library_subparsers.add_parser('list', help="list indexed MIDI files with their duration and tempo")
+    library_list_parser.add_argument('directories', nargs='*', default=['.'], help="directories to list (default: current directory)")
+    library_list_parser.add_argument('-r', '--recursive', action='store_true', help="include subdirectories")
+    library_list_parser.set_defaults(handler=run_library_list)
+    download_parser = subparsers.add_parser('download', help="download a SoundFont with resume and checksum verification")
+    download_parser.add_argument('url', nargs='?', default=DEFAULT_SOUNDFONT_URL, help="SoundFont URL (default: the Arachno SoundFont)")
+    download_parser.add_argument('-o', '--output', default=DEFAULT_SOUNDFONT, help=f"output file (default: {DEFAULT_SOUNDFONT})")
+    download_parser.add_argument('--sha256', help="expected SHA-256 of the file")
+    download_parser.set_defaults(handler=run_download)
+    soundfonts_parser = subparsers.add_parser('soundfonts', help="list SoundFonts and their presets without loading sample data")
+    soundfonts_parser.add_argument('directories', nargs='*', default=['.'], help="directories to scan (default: current directory)")
+    soundfonts_parser.add_argument('-r', '--recursive', action='store_true', help="descend into subdirectories")
+    soundfonts_parser.add_argument('-p', '--presets', action='store_true', help="list every preset with its sample size")
+    soundfonts_parser.set_defaults(handler=run_soundfonts)
+    netsend_parser = subparsers.add_parser('netsend', help="send a stream of test notes to a running app's network MIDI server")
+    netsend_parser.add_argument('--udp', type=parse_address, metavar='[HOST:]PORT',
+                                help=f"send datagrams to this address (default: {DEFAULT_NET_HOST}:{DEFAULT_NET_PORT})")
+    netsend_parser.add_argument('--tcp', type=parse_address, metavar='[HOST:]PORT', help="send over a TCP connection instead")
+    netsend_parser.add_argument('--unix', metavar='PATH', help="send over a Unix socket instead")
+    netsend_parser.add_argument('--rate', type=float, default=2000, help="events per second (default: 2000)")
+    netsend_parser.add_argument('--seconds', type=float, default=5, help="how long to send for (default: 5)")
+    netsend_parser.add_argument('--batch', type=int, default=1, help="events per frame or datagram (default: 1)")
+    netsend_parser.add_argument('--channel', type=int, default=0, choices=range(16), metavar='0-15', help="MIDI channel (default: 0)")
+    netsend_parser.add_argument('--velocity', type=int, default=100, help="note-on velocity (default: 100)")
+    netsend_parser.add_argument('--raw', action='store_true', help="send bare MIDI bytes instead of timestamped frames")
+    netsend_parser.set_defaults(handler=run_netsend)
+    bench_parser = subparsers.add_parser('bench', help="run performance benchmarks")
+    bench_subparsers = bench_parser.add_subparsers(dest='benchmark', required=True)
+    timeline_parser = bench_subparsers.add_parser('timeline', help="compare the compiled event timeline with mido messages")
+    timeline_parser.add_argument('files', nargs='*', help="MIDI files to measure (default: all in the current directory)")
+    timeline_parser.set_defaults(handler=run_benchmark_timeline)
+    lights_parser = bench_subparsers.add_parser('lights', help="measure tree light update cost against light count")
+    lights_parser.add_argument('counts', nargs='*', type=int, default=[8, 100, 1000, 5000, 20000],
+                               help="light counts to measure")
+    lights_parser.set_defaults(handler=run_benchmark_lights)
+    suite_parser = bench_subparsers.add_parser('suite', help="time the playback and display hot paths against stored baselines")
+    suite_parser.add_argument('files', nargs='*', help="MIDI files to use (default: the bundled ones), plus generated dense files")
+    suite_parser.add_argument('--baseline', default=DEFAULT_BENCHMARK_BASELINE,
+                              help="baseline results file (default: bench-baseline.json next to the script)")
+    suite_parser.add_argument('--save-baseline', action='store_true', help="store these results as the new baseline")
+    suite_parser.add_argument('--tolerance', type=float, default=BENCHMARK_TOLERANCE,
+                              help=f"fail when a benchmark is this much slower than its baseline (default: {BENCHMARK_TOLERANCE})")
+    suite_parser.add_argument('--repeats', type=int, default=BENCHMARK_REPEATS,
+                              help=f"runs per benchmark, the fastest counts (default: {BENCHMARK_REPEATS})")
+    suite_parser.set_defaults(handler=run_benchmark_suite)
+    jitter_parser = bench_subparsers.add_parser('jitter', help="compare scheduler lateness in and out of the UI process under UI load")
+    jitter_parser.add_argument('file', nargs='?', help=f"MIDI file to play (default: a generated {JITTER_MIDI_FILE} file)")
+    jitter_parser.add_argument('--seconds', type=float, default=5.0, help="playback time per mode (default: 5)")
+    jitter_parser.add_argument('--fps', type=float, default=30.0, help="simulated UI frame rate (default: 30)")
+    jitter_parser.add_argument('--ui-load', type=float, default=0.75,
+                               help="fraction of every frame the simulated UI keeps the interpreter busy (default: 0.75)")
+    jitter_parser.set_defaults(handler=run_benchmark_jitter)
+    return parser.parse_args(argv)
+
+def main(stdscr, options=None, startup_profile=None, audio=None):
+    app = PianoApp(stdscr, options, startup_profile, audio)
     app.run()
 
 if __name__ == "__main__":
+    startup_profile = StartupProfile()
+    startup_profile.lap('imports')
+    options = parse_arguments()
+    if options.command:
+        sys.exit(options.handler(options))
+    startup_profile.lap('parse arguments')
+    audio = None
+    if options.audio_process:
+        audio = AudioProcess(timeline_cache=create_timeline_cache(options),
+                             listen=(options.listen_udp, options.listen_tcp, options.listen_unix)).start()
+        startup_profile.lap('audio process fork')
     try:
-        curses.wrapper(main)
+        curses.wrapper(main, options, startup_profile, audio)
     except:
         logging.exception("Error in main application execution.")
         print("An error occurred. Check the pianomancer.log file for more details.")
+    if audio is not None:
+        audio.stop()
+    if options.profile_startup:
+        print(startup_profile.report())
 
 